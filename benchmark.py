@@ -0,0 +1,428 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+import http.client
+import numpy as np
+from pathlib import Path
+from collections import Counter
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+# query endpoints replayed with the query log, and POST endpoints replayed
+# with batches of doc ids.
+QUERY_ENDPOINTS = ('/search', '/search_body', '/search_title', '/search_anchor')
+IDS_ENDPOINTS = ('/get_pagerank', '/get_pageview')
+IDS_PER_REQUEST = 100
+# /batch_search is replayed with the query log in batches of /search_body
+# queries, its qps counts queries
+BATCH_ENDPOINTS = ('/batch_search',)
+QUERIES_PER_BATCH = 100
+# /search_body ranking modes compared by `quality`
+BODY_MODES = ('cosine', 'cosine_full', 'tfidf', 'bm25')
+CONSONANTS = 'bdfgklmnprstvz'
+VOWELS = 'aeiou'
+
+
+def make_vocabulary(size):
+    """ `size` distinct pronounceable synthetic words of at least two syllables,
+        skipping stopwords and the words of the synonyms table.
+    """
+    from consts import ALL_STOPWORDS, synonyms_dict
+    reserved = set(ALL_STOPWORDS) | set(synonyms_dict.keys()) | set(synonyms_dict.values())
+    syllables = [c + v for c in CONSONANTS for v in VOWELS]
+    words = []
+    rank = len(syllables)
+    while len(words) < size:
+        n, word = rank, ''
+        while n:
+            n, i = divmod(n, len(syllables))
+            word = syllables[i] + word
+        if word not in reserved:
+            words.append(word)
+        rank += 1
+    return words
+
+
+def zipf_probabilities(n, s):
+    p = 1.0 / np.arange(1, n + 1) ** s
+    return p / p.sum()
+
+
+def generate_corpus(path, n_docs=20000, vocab_size=50000, doc_length=200, seed=0):
+    """ Writes a synthetic JSONL corpus (see index_builder.iter_jsonl) whose
+        words follow Zipf's law. Titles draw from the same vocabulary, and
+        documents link to targets chosen with a Zipfian popularity, using a
+        part of the target's title as anchor text.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(make_vocabulary(vocab_size))
+    word_p = zipf_probabilities(vocab_size, 1.07)
+    doc_ids = np.sort(rng.choice(np.arange(1, 20 * n_docs), size=n_docs, replace=False))
+    popularity = rng.permutation(zipf_probabilities(n_docs, 0.9))
+    titles = [' '.join(rng.choice(vocabulary, size=rng.integers(1, 6), p=word_p)) for _ in range(n_docs)]
+    with open(path, 'w', encoding='utf-8') as f:
+        for i, doc_id in enumerate(doc_ids.tolist()):
+            length = max(1, int(rng.lognormal(np.log(doc_length), 0.6)))
+            text = ' '.join(rng.choice(vocabulary, size=length, p=word_p))
+            targets = rng.choice(n_docs, size=rng.poisson(8), p=popularity)
+            anchor_text = [[int(doc_ids[target]), ' '.join(titles[target].split()[:rng.integers(1, 4)])]
+                           for target in targets.tolist()]
+            f.write(json.dumps({'id': doc_id, 'title': titles[i], 'text': text,
+                                'anchor_text': anchor_text}) + '\n')
+    return vocabulary, word_p
+
+
+def generate_query_log(path, vocabulary, word_p, n_queries=2000, n_distinct=500, seed=0):
+    """ Writes a query log of `n_queries` lines drawn from `n_distinct` queries
+        of 1 to 4 Zipfian words, repeated with a Zipfian popularity like a real
+        log.
+    """
+    rng = np.random.default_rng(seed + 1)
+    distinct = [' '.join(rng.choice(vocabulary, size=rng.integers(1, 5), p=word_p)) for _ in range(n_distinct)]
+    log = rng.choice(n_distinct, size=n_queries, p=zipf_probabilities(n_distinct, 1.0))
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in log.tolist():
+            f.write(distinct[i] + '\n')
+
+
+def build(bench_dir, processes=None):
+    """ Builds the title, text and anchor indexes and the doc and title stores
+        of the corpus in `bench_dir`, laid out like the postings_gcp folder.
+    """
+    import index_builder
+    from doc_store import DocStore
+    from title_store import TitleStore
+    bench_dir = Path(bench_dir)
+    corpus = bench_dir / 'corpus.jsonl'
+    for field in index_builder.FIELDS:
+        index_builder.build_index(index_builder.iter_field(corpus, field), bench_dir / field,
+                                  f'index_{field}', processes=processes,
+                                  impact_name='impact_text' if field == 'text' else None)
+    titles, in_links = {}, {}
+    for doc in index_builder.iter_jsonl(corpus):
+        titles[doc['id']] = doc['title']
+        for target, anchor in doc['anchor_text']:
+            in_links[target] = in_links.get(target, 0) + 1
+    n_links = max(sum(in_links.values()), 1)
+    # in-links share stands in for PageRank, page views follow it
+    pagerank = {doc_id: in_links.get(doc_id, 0) / n_links for doc_id in titles}
+    pageviews = {doc_id: int(1000000 * share) for doc_id, share in pagerank.items()}
+    DocStore.from_dicts({'pagerank': pagerank, 'pageviews': pageviews},
+                        dtypes={'pagerank': np.float64, 'pageviews': np.int64}).write(bench_dir / 'other' / 'doc_store')
+    TitleStore.from_dict(titles).write(bench_dir / 'other' / 'title_store')
+
+
+def prepare(bench_dir, n_docs, vocab_size, doc_length, n_queries, seed, processes=None):
+    """ Generates the corpus, query log and indexes, unless `bench_dir` already
+        has them from a run with the same parameters.
+    """
+    bench_dir = Path(bench_dir)
+    params = {'n_docs': n_docs, 'vocab_size': vocab_size, 'doc_length': doc_length,
+              'n_queries': n_queries, 'seed': seed}
+    params_path = bench_dir / 'params.json'
+    if params_path.exists() and json.loads(params_path.read_text()) == params:
+        return params
+    bench_dir.mkdir(parents=True, exist_ok=True)
+    vocabulary, word_p = generate_corpus(bench_dir / 'corpus.jsonl', n_docs, vocab_size, doc_length, seed)
+    generate_query_log(bench_dir / 'queries.txt', vocabulary, word_p, n_queries, seed=seed)
+    build(bench_dir, processes)
+    params_path.write_text(json.dumps(params))
+    return params
+
+
+def percentiles(latencies):
+    latencies = np.array(latencies) * 1000
+    return {'p50_ms': float(np.percentile(latencies, 50)), 'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99)), 'mean_ms': float(latencies.mean())}
+
+
+def io_read_bytes():
+    """ Bytes this process read from storage, 0 where /proc is unavailable. """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('read_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def requests_of(endpoint, queries, doc_ids, rng):
+    """ (method, path, json body) of each request of an endpoint. """
+    if endpoint in BATCH_ENDPOINTS:
+        return [('POST', endpoint, json.dumps({'queries': queries[i:i + QUERIES_PER_BATCH],
+                                               'endpoint': 'search_body'}))
+                for i in range(0, len(queries), QUERIES_PER_BATCH)]
+    if endpoint in IDS_ENDPOINTS:
+        return [('POST', endpoint, json.dumps(rng.choice(doc_ids, IDS_PER_REQUEST).tolist()))
+                for _ in queries]
+    return [('GET', f'{endpoint}?query={quote(query)}', None) for query in queries]
+
+
+def replay(bench_dir, mode='inprocess', concurrency=1, warmup=100, result_cache=True):
+    """ Replays the query log of `bench_dir` against every endpoint, in-process
+        through the Flask test client or over HTTP against a server thread,
+        with `concurrency` clients. Runs in a fresh process (see `run`), so
+        that its peak RSS is that of serving only.
+    """
+    os.environ['POSTINGS_FOLDER'] = os.path.join(str(bench_dir), '')
+    import search_frontend
+    if not result_cache:
+        search_frontend.result_cache.maxsize = 0
+    queries = Path(bench_dir, 'queries.txt').read_text(encoding='utf-8').splitlines()
+    doc_ids = np.asarray(search_frontend.helper.DOCS.doc_ids)
+    rng = np.random.default_rng(0)
+    server = None
+    if mode == 'http':
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', 0, search_frontend.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        local = threading.local()
+
+        def send(method, path, body):
+            if not hasattr(local, 'conn'):
+                local.conn = http.client.HTTPConnection('127.0.0.1', server.server_port)
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            local.conn.request(method, path, body=body, headers=headers)
+            response = local.conn.getresponse()
+            response.read()
+            return response.status
+    else:
+        client = search_frontend.app.test_client()
+
+        def send(method, path, body):
+            if method == 'POST':
+                return client.post(path, data=body, content_type='application/json').status_code
+            return client.get(path).status_code
+
+    def timed(req):
+        start = time.perf_counter()
+        status = send(*req)
+        return time.perf_counter() - start, status
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for endpoint in QUERY_ENDPOINTS + IDS_ENDPOINTS + BATCH_ENDPOINTS:
+            reqs = requests_of(endpoint, queries, doc_ids, rng)
+            list(executor.map(timed, reqs[:warmup if endpoint not in BATCH_ENDPOINTS else 1]))
+            bytes_before, io_before = search_frontend.helper.reader.bytes_read, io_read_bytes()
+            start = time.perf_counter()
+            timings = list(executor.map(timed, reqs))
+            elapsed = time.perf_counter() - start
+            latencies = [latency for latency, status in timings]
+            n_queries = len(queries) if endpoint in BATCH_ENDPOINTS else len(reqs)
+            results[endpoint] = dict(requests=len(reqs), errors=sum(status != 200 for latency, status in timings),
+                                     qps=n_queries / elapsed, posting_bytes_read=search_frontend.helper.reader.bytes_read - bytes_before,
+                                     io_read_bytes=io_read_bytes() - io_before, **percentiles(latencies))
+    if server is not None:
+        server.shutdown()
+    return {'endpoints': results, 'peak_rss_mb': peak_rss_mb(), 'mode': mode, 'concurrency': concurrency,
+            'result_cache': result_cache}
+
+
+def known_item_queries(bench_dir, n_queries=200, terms=3, seed=0):
+    """ Known-item queries of the corpus of `bench_dir`: each query is `terms`
+        distinct words of a random document, drawn with the probability of
+        their tf in it, like a user recalling a page, and the document is its
+        only relevant document.
+    Returns:
+    --------
+      a {query: [relevant doc ids]} dict.
+    """
+    import index_builder
+    from helper import tokenize
+    docs = list(index_builder.iter_jsonl(Path(bench_dir) / 'corpus.jsonl'))
+    rng = np.random.default_rng(seed + 2)
+    qrels = {}
+    for i in rng.choice(len(docs), size=min(n_queries, len(docs)), replace=False).tolist():
+        tf = Counter(tokenize(docs[i]['text']))
+        if len(tf) >= terms:
+            words = list(tf)
+            p = np.array([tf[w] for w in words], dtype=np.float64)
+            qrels[' '.join(rng.choice(words, size=terms, replace=False, p=p / p.sum()))] = [docs[i]['id']]
+    return qrels
+
+
+def quality(bench_dir, qrels=None, modes=BODY_MODES, k=10):
+    """ Ranking quality of the /search_body modes: MRR, precision and MAP at
+        `k` over `qrels` ({query: [relevant doc ids]}), known-item queries of
+        the corpus by default. Modes the indexes cannot serve are skipped.
+    """
+    os.environ['POSTINGS_FOLDER'] = os.path.join(str(bench_dir), '')
+    import search_frontend
+    qrels = qrels or known_item_queries(bench_dir)
+    results = {}
+    for mode in modes:
+        rr, precision, ap = [], [], []
+        try:
+            for query, relevant in qrels.items():
+                query_tokens = search_frontend.helper.analyzer.analyze(query).tokens
+                ranking, stats = search_frontend.body_ranking(query_tokens, mode, k)
+                hits = [doc_id in set(relevant) for doc_id, score in ranking[:k]]
+                ranks = [i + 1 for i, hit in enumerate(hits) if hit]
+                rr.append(1 / ranks[0] if ranks else 0.0)
+                precision.append(len(ranks) / k)
+                ap.append(sum((j + 1) / rank for j, rank in enumerate(ranks)) / min(len(relevant), k))
+        except ValueError:
+            continue
+        results[mode] = {'mrr': float(np.mean(rr)), 'p_at_k': float(np.mean(precision)),
+                         'map': float(np.mean(ap))}
+    return {'k': k, 'queries': len(qrels), 'modes': results}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run(bench_dir, results_path, modes=('inprocess', 'http'), concurrency=1, result_cache=True, **params):
+    """ Prepares the benchmark data, replays the log in a fresh process per
+        mode and writes the results as JSON to `results_path`.
+    """
+    params = prepare(bench_dir, **params)
+    runs = {}
+    for mode in modes:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), 'replay', str(bench_dir), '--mode', mode,
+                              '--concurrency', str(concurrency)] + ([] if result_cache else ['--no-result-cache']),
+                             capture_output=True, text=True, check=True)
+        runs[mode] = json.loads(out.stdout.strip().splitlines()[-1])
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), 'quality', str(bench_dir)],
+                         capture_output=True, text=True, check=True)
+    results = {'meta': {'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+                        'machine': platform.machine(), 'cpus': os.cpu_count(), 'time': time.time(), **params},
+               'runs': runs, 'quality': json.loads(out.stdout.strip().splitlines()[-1])}
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=1)
+    return results
+
+
+def compare(baseline, current, threshold=0.1):
+    """ Compares two results files. A latency percentile or the peak RSS
+        higher, or a throughput or ranking quality metric lower, than the
+        baseline by more than `threshold` is a regression.
+    Returns:
+    --------
+      a list of (run, endpoint, metric, baseline, current, change, regression)
+      rows.
+    """
+    rows = []
+    for mode, run_results in current['runs'].items():
+        base_run = baseline['runs'].get(mode)
+        if base_run is None:
+            continue
+        for endpoint, metrics in run_results['endpoints'].items():
+            base_metrics = base_run['endpoints'].get(endpoint)
+            if base_metrics is None:
+                continue
+            for metric in ('qps', 'p50_ms', 'p95_ms', 'p99_ms'):
+                base, cur = base_metrics[metric], metrics[metric]
+                change = (cur - base) / base if base else 0.0
+                regression = change < -threshold if metric == 'qps' else change > threshold
+                rows.append((mode, endpoint, metric, base, cur, change, regression))
+        base, cur = base_run['peak_rss_mb'], run_results['peak_rss_mb']
+        change = (cur - base) / base if base else 0.0
+        rows.append((mode, '', 'peak_rss_mb', base, cur, change, change > threshold))
+    base_quality = baseline.get('quality', {}).get('modes', {})
+    for mode, metrics in current.get('quality', {}).get('modes', {}).items():
+        for metric, cur in metrics.items():
+            base = base_quality.get(mode, {}).get(metric)
+            if base is None:
+                continue
+            change = (cur - base) / base if base else 0.0
+            rows.append(('quality', mode, metric, base, cur, change, change < -threshold))
+    return rows
+
+
+def print_results(results):
+    for mode, run_results in results['runs'].items():
+        print(f"{mode} (concurrency {run_results['concurrency']}, peak RSS {run_results['peak_rss_mb']:.0f} MB)")
+        print(f"  {'endpoint':16}{'qps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'posting MB':>12}{'errors':>8}")
+        for endpoint, m in run_results['endpoints'].items():
+            print(f"  {endpoint:16}{m['qps']:10.1f}{m['p50_ms']:10.2f}{m['p95_ms']:10.2f}{m['p99_ms']:10.2f}"
+                  f"{m['posting_bytes_read'] / 1024 ** 2:12.1f}{m['errors']:8}")
+    if 'quality' in results:
+        print_quality(results['quality'])
+
+
+def print_quality(quality_results):
+    k = quality_results['k']
+    print(f"ranking quality ({quality_results['queries']} queries)")
+    print(f"  {'mode':16}{f'MRR@{k}':>10}{f'P@{k}':>10}{f'MAP@{k}':>10}")
+    for mode, m in quality_results['modes'].items():
+        print(f"  {mode:16}{m['mrr']:10.3f}{m['p_at_k']:10.3f}{m['map']:10.3f}")
+
+
+if __name__ == '__main__':
+    # usage: python benchmark.py run bench results.json [--docs 20000] [--concurrency 4]
+    #        python benchmark.py compare baseline.json results.json [--threshold 0.1]
+    #        python benchmark.py quality bench [--qrels qrels.json] [--k 10]
+    parser = argparse.ArgumentParser(description='Benchmark of the search engine endpoints.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('bench_dir')
+    run_parser.add_argument('results')
+    run_parser.add_argument('--docs', type=int, default=20000)
+    run_parser.add_argument('--vocab', type=int, default=50000)
+    run_parser.add_argument('--doc-length', type=int, default=200)
+    run_parser.add_argument('--queries', type=int, default=2000)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--processes', type=int, default=None)
+    run_parser.add_argument('--modes', default='inprocess,http')
+    run_parser.add_argument('--concurrency', type=int, default=1)
+    run_parser.add_argument('--no-result-cache', action='store_true')
+    replay_parser = commands.add_parser('replay')
+    replay_parser.add_argument('bench_dir')
+    replay_parser.add_argument('--mode', default='inprocess')
+    replay_parser.add_argument('--concurrency', type=int, default=1)
+    replay_parser.add_argument('--no-result-cache', action='store_true')
+    quality_parser = commands.add_parser('quality')
+    quality_parser.add_argument('bench_dir')
+    quality_parser.add_argument('--qrels', default=None, help='a JSON {query: [relevant doc ids]} file')
+    quality_parser.add_argument('--k', type=int, default=10)
+    quality_parser.add_argument('--modes', default=','.join(BODY_MODES))
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+    if args.command == 'run':
+        results = run(args.bench_dir, args.results, modes=args.modes.split(','), concurrency=args.concurrency,
+                      result_cache=not args.no_result_cache, n_docs=args.docs, vocab_size=args.vocab,
+                      doc_length=args.doc_length, n_queries=args.queries, seed=args.seed, processes=args.processes)
+        print_results(results)
+    elif args.command == 'replay':
+        print(json.dumps(replay(args.bench_dir, args.mode, args.concurrency, result_cache=not args.no_result_cache)))
+    elif args.command == 'quality':
+        qrels = None
+        if args.qrels:
+            with open(args.qrels) as f:
+                qrels = json.load(f)
+        quality_results = quality(args.bench_dir, qrels, args.modes.split(','), args.k)
+        print_quality(quality_results)
+        print(json.dumps(quality_results))
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        rows = compare(baseline, current, args.threshold)
+        for mode, endpoint, metric, base, cur, change, regression in rows:
+            print(f"{'REGRESSION' if regression else '':10} {mode:10} {endpoint:16} {metric:12} "
+                  f"{base:10.2f} {cur:10.2f} {change:+8.1%}")
+        sys.exit(1 if any(row[-1] for row in rows) else 0)
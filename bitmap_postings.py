@@ -0,0 +1,244 @@
+import sys
+import numpy as np
+
+# posting format version of bitmap posting lists, stored as their first byte.
+FORMAT_VERSION = 3
+# doc ids sharing their high 16 bits form a container: a sorted array of their
+# low 16 bits up to ARRAY_MAX doc ids, a bitmap of CONTAINER_WORDS words above.
+ARRAY_MAX = 4096
+CONTAINER_WORDS = 1024
+# container keys holding more doc ids than this in all the lists of a query are
+# counted with bitmaps, fewer are sorted
+DENSE_CARD = ARRAY_MAX
+HEADER_SIZE = 8
+KEY_DTYPE = np.dtype('<u2')
+WORD_DTYPE = np.dtype('<u8')
+
+
+def _bits(lows):
+    # the bit of each low 16 bits in its 64 bit word
+    return np.left_shift(np.uint64(1), (lows & 63).astype(np.uint64))
+
+
+def _unpack(words):
+    # the bits of uint64 words, lowest bit first
+    return np.unpackbits(words.astype(WORD_DTYPE).view(np.uint8), bitorder='little')
+
+
+def encode_bitmap(doc_ids):
+    """ Encodes a set of doc ids Roaring style, dropping the padding doc id 0:
+          version byte, 3 padding bytes, n_containers        (uint32)
+          keys: high 16 bits of the doc ids of each container (uint16)
+          cardinalities - 1 of the containers                 (uint16)
+          containers: the low 16 bits of the doc ids          (uint16)
+                      or a 65536 bit bitmap                   (1024 uint64)
+        All little-endian. Tfs are not kept, see Bitmap.
+    """
+    doc_ids = np.unique(np.asarray(doc_ids, dtype=np.uint64))
+    doc_ids = doc_ids[doc_ids != 0]
+    high = (doc_ids >> np.uint64(16)).astype(np.int64)
+    low = (doc_ids & np.uint64(0xffff)).astype(np.int64)
+    keys, starts, cards = np.unique(high, return_index=True, return_counts=True)
+    containers = []
+    for start, card in zip(starts.tolist(), cards.tolist()):
+        lows = low[start:start + card]
+        if card <= ARRAY_MAX:
+            containers.append(lows.astype(KEY_DTYPE).tobytes())
+        else:
+            words = np.zeros(CONTAINER_WORDS, dtype=WORD_DTYPE)
+            word_ids = lows >> 6
+            first = np.flatnonzero(np.diff(word_ids, prepend=-1))
+            words[word_ids[first]] = np.add.reduceat(_bits(lows), first)
+            containers.append(words.tobytes())
+    header = bytes([FORMAT_VERSION, 0, 0, 0]) + np.uint32(len(keys)).astype('<u4').tobytes()
+    return header + keys.astype(KEY_DTYPE).tobytes() + (cards - 1).astype(KEY_DTYPE).tobytes() + b''.join(containers)
+
+
+class Bitmap:
+    """ Read-only view of an encoded bitmap posting list: its container keys,
+        cardinalities and the byte offset of every container in `b`.
+    """
+    __slots__ = ('b', 'keys', 'cards', 'offsets')
+
+    def __init__(self, b):
+        if b[0] != FORMAT_VERSION:
+            raise ValueError(f'unsupported posting list format version {b[0]}')
+        n = int(np.frombuffer(b, dtype='<u4', count=1, offset=4)[0])
+        self.b = b
+        self.keys = np.frombuffer(b, dtype=KEY_DTYPE, count=n, offset=HEADER_SIZE).astype(np.int64)
+        self.cards = np.frombuffer(b, dtype=KEY_DTYPE, count=n, offset=HEADER_SIZE + 2 * n).astype(np.int64) + 1
+        sizes = np.where(self.cards <= ARRAY_MAX, 2 * self.cards, 8 * CONTAINER_WORDS)
+        self.offsets = HEADER_SIZE + 4 * n + np.cumsum(sizes) - sizes
+
+    def __len__(self):
+        return int(self.cards.sum())
+
+    def _array_lows(self, selected):
+        """ The container index and low 16 bits of every doc id of the array
+            containers where `selected`, gathered at once.
+        """
+        containers = np.flatnonzero(selected & (self.cards <= ARRAY_MAX))
+        cards = self.cards[containers]
+        if len(containers) and containers[-1] - containers[0] + 1 == len(containers):
+            # consecutive array containers are one slice of `b`
+            lows = np.frombuffer(self.b, dtype=KEY_DTYPE, count=int(cards.sum()), offset=int(self.offsets[containers[0]]))
+            return np.repeat(containers, cards), lows.astype(np.int64)
+        starts = np.cumsum(cards) - cards
+        positions = np.arange(int(cards.sum())) + np.repeat(self.offsets[containers] // 2 - starts, cards)
+        return np.repeat(containers, cards), np.frombuffer(self.b, dtype=KEY_DTYPE)[positions].astype(np.int64)
+
+    def _bitmap_words(self, selected):
+        """ The indexes and (n, CONTAINER_WORDS) words of the bitmap containers
+            where `selected`.
+        """
+        containers = np.flatnonzero(selected & (self.cards > ARRAY_MAX))
+        positions = self.offsets[containers][:, None] + np.arange(WORD_DTYPE.itemsize * CONTAINER_WORDS)
+        return containers, np.frombuffer(self.b, dtype=np.uint8)[positions].view(WORD_DTYPE)
+
+    def array_doc_ids(self, selected):
+        """ The sorted doc ids of the array containers where `selected`. """
+        containers, lows = self._array_lows(selected)
+        return (self.keys[containers] << 16) + lows
+
+    def doc_ids(self):
+        """ The doc ids as a sorted NumPy uint64 array. """
+        everything = np.ones(len(self.keys), dtype=bool)
+        containers, words = self._bitmap_words(everything)
+        positions = np.flatnonzero(_unpack(words.reshape(-1)))
+        bitmap_doc_ids = (self.keys[containers][positions >> 16] << 16) + (positions & 0xffff)
+        return np.sort(np.concatenate([self.array_doc_ids(everything), bitmap_doc_ids])).astype(np.uint64)
+
+    def fill(self, dense, rows):
+        """ ORs the containers into `dense`, a (n_rows, CONTAINER_WORDS) uint64
+            array, container i into row rows[i], skipping rows of -1.
+        """
+        selected = rows >= 0
+        containers, words = self._bitmap_words(selected)
+        dense[rows[containers]] |= words
+        containers, lows = self._array_lows(selected)
+        if len(lows):
+            # one word per distinct (row, low // 64)
+            word_ids = rows[containers] * CONTAINER_WORDS + (lows >> 6)
+            first = np.flatnonzero(np.diff(word_ids, prepend=-1))
+            dense.reshape(-1)[word_ids[first]] |= np.add.reduceat(_bits(lows), first)
+
+
+def _rows(keys, bitmap_keys):
+    # position of each container key of a bitmap in `keys`, -1 when absent
+    if len(keys) == 0:
+        return np.full(len(bitmap_keys), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(keys, bitmap_keys), len(keys) - 1)
+    return np.where(keys[positions] == bitmap_keys, positions, -1)
+
+
+def count_matches(bitmaps, min_match=1):
+    """ Binary retrieval over bitmap posting lists: the docs that appear in at
+        least `min_match` of them and in how many, evaluated container key by
+        container key. Only the keys of at least `min_match` lists can hold
+        such docs. Keys whose containers hold few doc ids in all are counted
+        by sorting them; the others are summed into bit slices (slice j holds
+        bit j of the count of every doc) by a ripple-carry adder over whole
+        bitmaps, a few vectorized AND/XOR per list instead of a sort.
+    Returns:
+    --------
+      two aligned NumPy int64 arrays, sorted doc ids and their number of lists.
+    """
+    empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    min_match = max(min_match, 1)
+    if len(bitmaps) < min_match:
+        return empty
+    keys, key_counts = np.unique(np.concatenate([bitmap.keys for bitmap in bitmaps]), return_counts=True)
+    keys = keys[key_counts >= min_match]
+    if len(keys) == 0:
+        return empty
+    rows = [_rows(keys, bitmap.keys) for bitmap in bitmaps]
+    key_cards = np.zeros(len(keys), dtype=np.int64)
+    for bitmap, bitmap_rows in zip(bitmaps, rows):
+        key_cards[bitmap_rows[bitmap_rows >= 0]] += bitmap.cards[bitmap_rows >= 0]
+    is_dense = key_cards > DENSE_CARD
+    results = []
+    # sparse keys only have array containers
+    doc_ids = np.concatenate([bitmap.array_doc_ids((bitmap_rows >= 0) & ~is_dense[bitmap_rows])
+                              for bitmap, bitmap_rows in zip(bitmaps, rows)])
+    doc_ids, counts = np.unique(doc_ids, return_counts=True)
+    matches = counts >= min_match
+    results.append((doc_ids[matches], counts[matches]))
+    if is_dense.any():
+        results.append(_count_dense(bitmaps, rows, keys, is_dense, min_match))
+    doc_ids = np.concatenate([doc_ids for doc_ids, counts in results])
+    counts = np.concatenate([counts for doc_ids, counts in results])
+    order = np.argsort(doc_ids, kind='stable')
+    return doc_ids[order], counts[order]
+
+
+def _count_dense(bitmaps, rows, keys, is_dense, min_match):
+    """ The bit-sliced counting of count_matches over the keys where `is_dense`. """
+    dense_rows = np.where(is_dense, np.cumsum(is_dense) - 1, -1)
+    keys = keys[is_dense]
+    slices = np.zeros((len(bitmaps).bit_length(), len(keys), CONTAINER_WORDS), dtype=np.uint64)
+    dense = np.empty((len(keys), CONTAINER_WORDS), dtype=np.uint64)
+    for bitmap, bitmap_rows in zip(bitmaps, rows):
+        dense[:] = 0
+        bitmap.fill(dense, np.where(bitmap_rows >= 0, dense_rows[bitmap_rows], -1))
+        carry = dense
+        for counts_bit in slices:
+            next_carry = counts_bit & carry
+            counts_bit ^= carry
+            carry = next_carry
+            if not carry.any():
+                break
+    words = np.bitwise_or.reduce(slices, axis=0).reshape(-1)
+    word_ids = np.flatnonzero(words)
+    # positions of the set bits among the bits of the non-zero words
+    positions = np.flatnonzero(_unpack(words[word_ids]))
+    counts = np.zeros(len(positions), dtype=np.int64)
+    for j, counts_bit in enumerate(slices):
+        counts += _unpack(counts_bit.reshape(-1)[word_ids])[positions].astype(np.int64) << j
+    matches = counts >= min_match
+    positions, counts = positions[matches], counts[matches]
+    word_ids = word_ids[positions >> 6]
+    doc_ids = (keys[word_ids // CONTAINER_WORDS] << 16) + (word_ids % CONTAINER_WORDS) * 64 + (positions & 63)
+    return doc_ids, counts
+
+
+def check_bitmap_index(inverted_index, bitmap_index, folder, n_queries=1000, seed=0):
+    """ Equivalence check of a bitmap index against the posting lists it was
+        built from: random queries of index terms get the same docs and counts
+        from Helper.frequency_ranking and from the bitmaps, with min_match 1
+        and for conjunctive queries.
+    Returns:
+    --------
+      the number of queries whose results differ.
+    """
+    from helper import Helper
+    helper = Helper(folder=None)
+    terms = sorted(inverted_index.df.keys())
+    rng = np.random.default_rng(seed)
+    mismatches = 0
+    for _ in range(n_queries):
+        tokens = [terms[i] for i in rng.integers(0, len(terms), rng.integers(1, 5))]
+        expected = helper.frequency_ranking(tokens, inverted_index, folder)
+        doc_ids, counts = helper.bitmap_frequency_scores(tokens, bitmap_index, folder)
+        mismatches += expected != list(zip(doc_ids.tolist(), counts.tolist()))
+        n_terms = len(set(tokens))
+        expected = [(doc_id, count) for doc_id, count in expected if count >= n_terms]
+        doc_ids, counts = helper.bitmap_frequency_scores(tokens, bitmap_index, folder, n_terms)
+        mismatches += expected != list(zip(doc_ids.tolist(), counts.tolist()))
+    return mismatches
+
+
+if __name__ == '__main__':
+    # usage: python bitmap_postings.py postings_gcp
+    # writes postings_gcp/<field>/bitmap_<field>.pkl and bitmap_<field>_XXX.bin for the title and anchor
+    # indexes, served by /search_title, /search_anchor and /search once they exist
+    from pathlib import Path
+    from helper import Helper
+    for field in ('title', 'anchor'):
+        folder = Path(sys.argv[1]) / field
+        inverted_index = Helper(folder=None).get_index(f'{folder}/', f'index_{field}')
+        bitmap_index = inverted_index.convert_bitmaps(f'{folder}/', folder, f'bitmap_{field}')
+        if hasattr(inverted_index, 'lexicon'):
+            bitmap_index.write_lexicon(folder, f'bitmap_{field}')
+        else:
+            bitmap_index.write_index(folder, f'bitmap_{field}')
+        print(field, 'mismatches:', check_bitmap_index(inverted_index, bitmap_index, f'{folder}/'))
@@ -0,0 +1,107 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ Thread-safe least-recently-used cache of up to `maxsize` entries, whose
+        entries optionally expire `ttl` seconds after they were stored.
+        Hits, misses, evictions and expirations are counted.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic())
+            self._added(key, value)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def _added(self, key, value):
+        pass
+
+    def _remove(self, key):
+        del self._entries[key]
+
+    def _full(self):
+        return len(self._entries) > self.maxsize
+
+    def _evict(self):
+        while self._entries and self._full():
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations}
+
+
+class SizedLRUCache(LRUCache):
+    """ LRU cache bounded by the total size in bytes of its values instead of
+        their number. `sizeof` returns the size of a value; values larger than
+        the whole budget are not cached.
+    """
+    def __init__(self, max_bytes, sizeof=sys.getsizeof, ttl=None):
+        super().__init__(maxsize=None, ttl=ttl)
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.n_bytes = 0
+        self._sizes = {}
+
+    def put(self, key, value):
+        if self.sizeof(value) > self.max_bytes:
+            return
+        super().put(key, value)
+
+    def _added(self, key, value):
+        size = self.sizeof(value)
+        self._sizes[key] = size
+        self.n_bytes += size
+
+    def _remove(self, key):
+        super()._remove(key)
+        self.n_bytes -= self._sizes.pop(key)
+
+    def _full(self):
+        return self.n_bytes > self.max_bytes
+
+    def stats(self):
+        stats = super().stats()
+        stats['bytes'] = self.n_bytes
+        stats['max_bytes'] = self.max_bytes
+        return stats
@@ -0,0 +1,124 @@
+import numpy as np
+
+# posting format versions, stored as the first byte of every compressed posting list.
+FORMAT_VERSION = 2
+# number of postings in a block, the unit the skip table points to.
+BLOCK_POSTINGS = 128
+
+
+def encode_varints(values):
+    """ Encodes a NumPy array of non-negative integers as LEB128 varints (7 bits
+        per byte, high bit set on all but the last byte of a value).
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        n_bytes += values >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(n_bytes) - n_bytes
+    out = np.empty(int(n_bytes.sum()), dtype=np.uint8)
+    for k in range(int(n_bytes.max(initial=0))):
+        sel = n_bytes > k
+        chunk = (values[sel] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (n_bytes[sel] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[sel] + k] = chunk | more
+    return out.tobytes()
+
+
+def _decode_varints(raw, ends):
+    """ Decodes the varints of a uint8 array that end at `ends`, one pass per
+        byte of the longest varint instead of one per byte of the input.
+    """
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    values = (raw[starts] & 0x7f).astype(np.uint64)
+    for k in range(1, int(lengths.max(initial=1))):
+        sel = np.flatnonzero(lengths > k)
+        values[sel] |= (raw[starts[sel] + k] & 0x7f).astype(np.uint64) << np.uint64(7 * k)
+    return values
+
+
+def decode_varints(b):
+    """ Decodes a bytes-like object of concatenated varints into a NumPy uint64
+        array, without a Python-level loop over the values.
+    """
+    raw = np.frombuffer(b, dtype=np.uint8)
+    is_last = raw < 0x80
+    if is_last.all():
+        # single byte varints, e.g. the tfs and gaps of dense lists
+        return raw.astype(np.uint64)
+    return _decode_varints(raw, np.flatnonzero(is_last))
+
+
+def _read_varints(raw, pos, count):
+    """ Reads `count` varints of a uint8 array starting at `pos`, returns them
+        and the position right after them. A varint is at most 10 bytes long,
+        so only that many bytes are searched for their ends.
+    """
+    if count == 0:
+        return np.empty(0, dtype=np.uint64), pos
+    ends = np.flatnonzero(raw[pos:pos + 10 * count] < 0x80)[:count]
+    return _decode_varints(raw[pos:], ends), pos + int(ends[-1]) + 1
+
+
+def encode_posting_list(doc_ids, tfs):
+    """ Encodes a posting list to the compressed format:
+          version byte, n_postings, n_blocks          (varints)
+          skip table: (last_doc_id, block_size) per block (varints)
+          blocks: doc id gaps followed by tfs          (varints)
+        Doc ids are sorted first; gaps are taken over the whole list, so a block
+        is decoded relative to the last doc id of the previous block.
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.uint64)
+    tfs = np.asarray(tfs, dtype=np.uint64)
+    order = np.argsort(doc_ids, kind='stable')
+    doc_ids, tfs = doc_ids[order], tfs[order]
+    gaps = np.diff(doc_ids, prepend=np.uint64(0))
+    blocks, skip_table = [], []
+    for start in range(0, len(doc_ids), BLOCK_POSTINGS):
+        end = min(start + BLOCK_POSTINGS, len(doc_ids))
+        block = encode_varints(gaps[start:end]) + encode_varints(tfs[start:end])
+        blocks.append(block)
+        skip_table.extend((int(doc_ids[end - 1]), len(block)))
+    header = bytes([FORMAT_VERSION]) + encode_varints([len(doc_ids), len(blocks)] + skip_table)
+    return header + b''.join(blocks)
+
+
+def read_skip_table(b):
+    """ Parses the header of a compressed posting list.
+    Returns:
+    --------
+      n_postings, array of block last doc ids, array of block byte offsets
+      (relative to `b`) and the byte offset where the blocks end.
+    """
+    raw = np.frombuffer(b, dtype=np.uint8)
+    if raw[0] != FORMAT_VERSION:
+        raise ValueError(f'unsupported posting list format version {raw[0]}')
+    (n_postings, n_blocks), pos = _read_varints(raw, 1, 2)
+    skip_table, pos = _read_varints(raw, pos, 2 * int(n_blocks))
+    offsets = np.zeros(int(n_blocks) + 1, dtype=np.int64)
+    np.cumsum(skip_table[1::2], out=offsets[1:])
+    offsets += pos
+    return int(n_postings), skip_table[0::2], offsets[:-1], int(offsets[-1])
+
+
+def decode_posting_list(b, min_doc_id=0):
+    """ Decodes a compressed posting list into (doc_ids, tfs) NumPy arrays.
+        Blocks whose last doc id is smaller than `min_doc_id` are skipped
+        through the skip table without being decoded.
+    """
+    n_postings, last_doc_ids, offsets, end = read_skip_table(b)
+    first_block = int(np.searchsorted(last_doc_ids, np.uint64(min_doc_id), side='left'))
+    if first_block == len(last_doc_ids):
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+    values = decode_varints(b[int(offsets[first_block]):end])
+    # every block holds its gaps followed by its tfs, only the last block is not full
+    n_full = len(last_doc_ids) - 1 - first_block
+    last_size = n_postings - BLOCK_POSTINGS * (len(last_doc_ids) - 1)
+    full = values[:2 * BLOCK_POSTINGS * n_full].reshape(n_full, 2, BLOCK_POSTINGS)
+    last = values[2 * BLOCK_POSTINGS * n_full:]
+    gaps = np.concatenate([full[:, 0].ravel(), last[:last_size]])
+    tfs = np.concatenate([full[:, 1].ravel(), last[last_size:]])
+    base = last_doc_ids[first_block - 1] if first_block > 0 else np.uint64(0)
+    return np.cumsum(gaps, dtype=np.uint64) + base, tfs
@@ -1,3 +1,4 @@
+import os
 import re
 import nltk
 from nltk.stem.porter import *
@@ -18,4 +19,49 @@ ALL_STOPWORDS = english_stopwords.union(corpus_stopwords)
 top_title_words = ["district","house","season","football","amara","disambiguation","station","2008","school","list","team","ban","carolina","john","boston","east","pirates","celtics","album","historic","council","county","new","island","light","league","united","college","national","farm","film","community","toyota","corolla","george","2007","louis","men's","footballer","baseball","lee","mill","william","championship","states","david","university","election","american","sports","hill","club","site","park","blues","international","baltimore","european","charles","series","cup","henry","wrestling","summer","olympics","trox","company","church","thomas","martin","arnold","south","james","high","khan","musician","1992","york","maryland","williams","jim","bill","street","war","open","north","surname","metro","railway","group","rhode","regiment","black","1920","greco-roman","rules","discography","paraguay","destinations","people"]
 synonyms = ["region","home","period","soccer","","","stop","","college","","group","prohibit","","","","","Caribbean","","music","historical","board","state","latest","isle","","leagues","usa","university","","","movie","public","","","","","","men","player","","","","","","county","","college","vote","","sport","hill","","location","garden","","global","","europa","","","world","","tussle","","olympic","","firm","","","","","","","top","","music","","new","","","","","road","battle","","","name","subway","rail","team","","unit","","","","rule","","Asuncin","destination","nation"]
 
-synonyms_dict = dict(zip(top_title_words, synonyms))
\ No newline at end of file
+synonyms_dict = dict(zip(top_title_words, synonyms))
+
+# root folder of the title, text, anchor and other folders, overridable for e.g. benchmark.py
+POSTINGS_FOLDER = os.environ.get('POSTINGS_FOLDER', '/home/igalfernand/postings_gcp/')
+
+# query result cache: number of cached responses and their time to live in seconds
+RESULT_CACHE_SIZE = 10000
+RESULT_CACHE_TTL = 3600
+# query analysis caches: analyzed query strings and per index idf of query terms
+QUERY_CACHE_SIZE = 10000
+QUERY_TERM_CACHE_SIZE = 100000
+# posting list cache: budget in bytes of decoded posting lists kept in memory
+POSTING_CACHE_BYTES = 1024 ** 3
+# number of threads fetching the posting lists of a query concurrently
+POSTING_FETCH_THREADS = 8
+# conjunctive title/anchor queries: candidates looked up per galloping step in a longer posting list
+GALLOP_BLOCK = 256
+# serve /search_title, /search_anchor and the title field of /search from the bitmap indexes built by
+# bitmap_postings.py when they exist. They read half the bytes of the posting lists, but counting matches is
+# slower than on decoded posting lists that are already in memory.
+BITMAP_POSTINGS = False
+# /suggest, see suggest.py: completions kept per prefix (the maximal limit), and the number of titles above
+# which the completions of a prefix are precomputed when building instead of selected at query time
+SUGGEST_TOP_K = 10
+SUGGEST_SCAN_TITLES = 256
+# streamed /search_title and /search_anchor responses: results encoded per chunk
+STREAM_CHUNK = 1000
+# POST /batch_search: maximal number of queries per request
+MAX_BATCH_QUERIES = 10000
+# /search?fields=title,body,anchor: weights of the fields and of PageRank when fusing their scores
+FIELD_WEIGHTS = {'title': 0.4, 'body': 0.3, 'anchor': 0.2, 'pagerank': 0.1}
+# sharded mode: (host, port) of the shard workers, see sharding.py. Empty to load the indexes locally.
+# The workers and the frontend read their shared secret from the SHARD_AUTHKEY (or SHARD_AUTHKEY_FILE)
+# environment variable, see sharding.load_authkey; shards must only be reachable on a trusted network.
+SHARD_ADDRESSES = []
+# incremental indexing: folder of the segments added to each index since it was built, see segments.py, e.g.
+# os.path.join(POSTINGS_FOLDER, 'segments/') to enable /index_documents. None to serve the indexes as built.
+SEGMENTS_FOLDER = None
+# pre-fork serving, see prefork.py: number of worker processes (None for one per core), and the most frequent
+# terms of each index whose posting lists are decoded before forking, so that all the workers share them
+PREFORK_WORKERS = None
+PREFORK_WARMUP_TERMS = 100
+# requests slower than this many seconds are logged with their per-stage breakdown, see metrics.py.
+# SLOW_QUERY_LOG is the log file, None to log to stderr.
+SLOW_QUERY_SECONDS = 1.0
+SLOW_QUERY_LOG = None
\ No newline at end of file
@@ -0,0 +1,187 @@
+import sys
+import json
+import pickle
+import numpy as np
+from pathlib import Path
+from collections.abc import Mapping
+
+
+class DocStore:
+    """ Per-document attributes (PageRank, page views, ...) stored as dense
+        NumPy columns aligned with a sorted array of wiki ids. A document's
+        position in that array is its compact internal doc number, and a batch
+        of wiki ids is resolved with a single vectorized binary search.
+        A store written to disk is opened with mmap.
+    """
+    def __init__(self, doc_ids, columns):
+        self.doc_ids = doc_ids
+        self.columns = columns
+
+    @staticmethod
+    def open(path):
+        path = Path(path)
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+        doc_ids = np.load(path / 'doc_ids.npy', mmap_mode='r')
+        columns = {name: np.load(path / f'{name}.npy', mmap_mode='r') for name in meta['columns']}
+        return DocStore(doc_ids, columns)
+
+    @staticmethod
+    def from_dicts(columns, dtypes=None):
+        """ Builds an in-memory store from {column name: {wiki_id: value}}
+            mappings. Documents missing from a column get 0.
+        """
+        dtypes = dtypes or {}
+        doc_ids = set()
+        for values in columns.values():
+            doc_ids.update(values.keys())
+        doc_ids = np.array(sorted(doc_ids), dtype=np.int64)
+        arrays = {}
+        for name, values in columns.items():
+            arrays[name] = np.fromiter((values.get(doc_id, 0) for doc_id in doc_ids.tolist()),
+                                       dtype=dtypes.get(name, np.float64), count=len(doc_ids))
+        return DocStore(doc_ids, arrays)
+
+    def write(self, path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / 'doc_ids.npy', np.asarray(self.doc_ids, dtype=np.int64))
+        for name, values in self.columns.items():
+            np.save(path / f'{name}.npy', np.asarray(values))
+        with open(path / 'meta.json', 'w') as f:
+            json.dump({'columns': list(self.columns.keys())}, f)
+
+    def positions(self, doc_ids):
+        """ Maps an array of wiki ids to internal doc numbers.
+        Returns:
+        --------
+          positions array and a boolean array telling which ids were found.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(self.doc_ids) == 0:
+            return np.zeros(len(doc_ids), dtype=np.int64), np.zeros(len(doc_ids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.doc_ids, doc_ids), len(self.doc_ids) - 1)
+        return positions, self.doc_ids[positions] == doc_ids
+
+    def lookup(self, column, doc_ids, default=0):
+        """ Vectorized lookup of a column for an array of wiki ids. """
+        positions, found = self.positions(doc_ids)
+        values = self.columns[column]
+        if len(values) == 0:
+            return np.full(len(positions), default, dtype=values.dtype)
+        return np.where(found, values[positions], default).astype(values.dtype)
+
+    def get(self, column, doc_id, default=0):
+        return self.lookup(column, [doc_id], default)[0].item()
+
+    def column(self, name):
+        return DocColumn(self.doc_ids, self.columns[name])
+
+
+class DocColumn(Mapping):
+    """ dict-like view of one column of doc attributes, stored as two aligned
+        arrays: sorted doc ids and their values. `lookup` resolves a whole array
+        of doc ids in one vectorized call.
+    """
+    def __init__(self, doc_ids, values):
+        self._doc_ids = doc_ids
+        self._values = values
+
+    def lookup(self, doc_ids, default=0):
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(self._doc_ids) == 0:
+            return np.full(len(doc_ids), default, dtype=np.float64)
+        positions = np.minimum(np.searchsorted(self._doc_ids, doc_ids), len(self._doc_ids) - 1)
+        found = self._doc_ids[positions] == doc_ids
+        return np.where(found, self._values[positions], default).astype(np.float64)
+
+    def _position(self, doc_id):
+        position = int(np.searchsorted(self._doc_ids, doc_id))
+        if position < len(self._doc_ids) and self._doc_ids[position] == doc_id:
+            return position
+        return -1
+
+    def __getitem__(self, doc_id):
+        position = self._position(doc_id)
+        if position < 0:
+            raise KeyError(doc_id)
+        return self._values[position].item()
+
+    def __contains__(self, doc_id):
+        return self._position(doc_id) >= 0
+
+    def __iter__(self):
+        return iter(self._doc_ids.tolist())
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+
+class DocMap:
+    """ Mapping between wiki ids and the internal doc ids of indexes renumbered
+        by reorder.py: internal id i (from 1, as doc id 0 pads posting lists
+        and is mapped to itself) is the wiki id at position i - 1 of
+        `wiki_ids`, in descending PageRank order. Documents indexed after the
+        renumbering keep their wiki id offset by the number of renumbered
+        documents, so that both directions stay a lookup without any state to
+        persist.
+    """
+    def __init__(self, wiki_ids, order=None):
+        self.wiki_ids = wiki_ids
+        # positions in wiki_ids of the sorted wiki ids
+        self.order = order if order is not None else np.argsort(wiki_ids, kind='stable')
+        self.sorted_wiki_ids = np.asarray(wiki_ids)[self.order]
+
+    @staticmethod
+    def open(path):
+        path = Path(path)
+        return DocMap(np.load(path / 'wiki_ids.npy', mmap_mode='r'), np.load(path / 'order.npy', mmap_mode='r'))
+
+    def write(self, path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / 'wiki_ids.npy', np.asarray(self.wiki_ids, dtype=np.int64))
+        np.save(path / 'order.npy', np.asarray(self.order, dtype=np.int64))
+
+    def to_internal(self, wiki_ids):
+        """ Vectorized mapping of wiki ids to internal doc ids. """
+        wiki_ids = np.asarray(wiki_ids, dtype=np.int64)
+        n = len(self.wiki_ids)
+        if n == 0:
+            return wiki_ids
+        positions = np.minimum(np.searchsorted(self.sorted_wiki_ids, wiki_ids), n - 1)
+        found = self.sorted_wiki_ids[positions] == wiki_ids
+        internal_ids = np.where(found, np.asarray(self.order)[positions] + 1, wiki_ids + n)
+        # the padding doc id 0 of posting lists is not a document
+        return np.where(wiki_ids == 0, 0, internal_ids)
+
+    def to_wiki(self, doc_ids):
+        """ Vectorized mapping of internal doc ids back to wiki ids. """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        n = len(self.wiki_ids)
+        if n == 0:
+            return doc_ids
+        renumbered = (doc_ids >= 1) & (doc_ids <= n)
+        wiki_ids = np.where(renumbered, np.asarray(self.wiki_ids)[np.clip(doc_ids - 1, 0, n - 1)], doc_ids - n)
+        return np.where(doc_ids == 0, 0, wiki_ids)
+
+    def __len__(self):
+        return len(self.wiki_ids)
+
+
+def convert_pickles(pagerank_path, pageviews_path, path):
+    """ One-shot converter of the PageRank and page views pickles to a doc
+        store directory at `path`.
+    """
+    with open(pagerank_path, 'rb') as f:
+        pagerank = pickle.load(f)
+    with open(pageviews_path, 'rb') as f:
+        pageviews = pickle.load(f)
+    store = DocStore.from_dicts({'pagerank': pagerank, 'pageviews': pageviews},
+                                dtypes={'pagerank': np.float64, 'pageviews': np.int64})
+    store.write(path)
+
+
+if __name__ == '__main__':
+    # usage: python doc_store.py pr.pkl pageviews-202108-user.pkl doc_store
+    convert_pickles(*sys.argv[1:4])
@@ -1,9 +1,53 @@
+import os
 import math
+import heapq
 import pickle
+import metrics
 import numpy as np
 import pandas as pd
 from consts import *
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from cache import SizedLRUCache
+from doc_store import DocStore, DocMap
+from title_store import TitleStore
+from query_analyzer import QueryAnalyzer
+from bitmap_postings import count_matches
+from inverted_index_gcp import InvertedIndex, MappedFileReader, TUPLE_SIZE
+
+# ranking modes of Helper.body_ranking
+BODY_MODES = ('cosine', 'cosine_full', 'tfidf', 'maxscore', 'bm25')
+
+
+def owned_nbytes(arrays):
+    """
+    bytes of memory owned by the arrays of a posting list: arrays that are views of a memory-mapped posting
+    file own none, and arrays sharing a buffer (e.g. the doc ids and tfs of the same records) count it once.
+    :param arrays: NumPy arrays.
+    :return: number of bytes.
+    """
+    buffers = {}
+    for array in arrays:
+        base = array
+        while isinstance(base, np.ndarray) and base.base is not None:
+            base = base.base
+        if isinstance(base, memoryview):
+            base = base.obj
+        if isinstance(base, np.ndarray):
+            buffers[id(base)] = base.nbytes
+        elif isinstance(base, (bytes, bytearray)):
+            buffers[id(base)] = len(base)
+    return sum(buffers.values())
+
+
+def tokenize(text):
+    """
+    simple tokenization based on assignment 3, shared by the queries and the index builder.
+    :param text: a given text string.
+    :return: a list of processed tokens.
+    """
+    return [token.group() for token in RE_WORD.finditer(text.lower()) if
+            token.group() not in ALL_STOPWORDS]
 
 
 class Helper:
@@ -11,13 +55,27 @@ class Helper:
     A class that contains helper functions for search_frontend.py interface.
     """
 
-    def __init__(self):
+    def __init__(self, folder=os.path.join(POSTINGS_FOLDER, 'other/')):
         """
         initialize variables and import pickle files.
+        :param folder: folder of the PageRank, page views and titles files, None to skip loading them
+                       (e.g. in a shard worker, which only scores).
         """
-        self.PAGERANK = self.get_pickle('/home/igalfernand/postings_gcp/other/pr.pkl')
-        self.PAGEVIEWS = self.get_pickle('/home/igalfernand/postings_gcp/other/pageviews-202108-user.pkl')
-        self.TITLES = dict(self.get_pickle('/home/igalfernand/postings_gcp/other/doctitles.pkl'))
+        # wiki id <-> internal doc id mapping of indexes renumbered by reorder.py, None when doc ids are wiki ids
+        self.DOC_MAP = None
+        if folder is not None:
+            self.DOCS = self.get_doc_store(folder)
+            self.TITLES = self.get_title_store(folder)
+            self.DOC_MAP = self.get_doc_map(folder)
+        # memory-mapped posting files, shared by all the indexes
+        self.reader = MappedFileReader()
+        # decoded posting lists of hot terms, keyed by (index folder, index name, index generation, term). Only
+        # the bytes the cached arrays own are charged, views of the mapped posting files are not cached.
+        self.posting_cache = SizedLRUCache(POSTING_CACHE_BYTES, sizeof=owned_nbytes)
+        # fetches the posting lists of a query in parallel
+        self.executor = ThreadPoolExecutor(max_workers=POSTING_FETCH_THREADS)
+        # tokenization, synonyms and per-index term lookups of queries, see query_analyzer.py
+        self.analyzer = QueryAnalyzer(synonyms_dict, self.get_tokens, self.get_idf, QUERY_CACHE_SIZE, QUERY_TERM_CACHE_SIZE)
 
     def get_pickle(self, pickle_name):
         """
@@ -28,15 +86,83 @@ class Helper:
         with open(pickle_name, 'rb') as file:
             return pickle.load(file)
 
+    def get_doc_store(self, folder):
+        """
+        loads the PageRank and page views of all documents, from the memory-mapped doc store when
+        it was converted to one, otherwise from the pickle files.
+        :param folder: the folder of the doc store and of the pickle files.
+        :return: DocStore with 'pagerank' and 'pageviews' columns.
+        """
+        if os.path.isdir(os.path.join(folder, 'doc_store')):
+            return DocStore.open(os.path.join(folder, 'doc_store'))
+        return DocStore.from_dicts({'pagerank': self.get_pickle(os.path.join(folder, 'pr.pkl')),
+                                    'pageviews': self.get_pickle(os.path.join(folder, 'pageviews-202108-user.pkl'))},
+                                   dtypes={'pagerank': np.float64, 'pageviews': np.int64})
+
+    def get_title_store(self, folder):
+        """
+        loads the titles of all documents, from the memory-mapped title store when it was converted
+        to one, otherwise from the pickle file.
+        :param folder: the folder of the title store and of the pickle file.
+        :return: TitleStore.
+        """
+        if os.path.isdir(os.path.join(folder, 'title_store')):
+            return TitleStore.open(os.path.join(folder, 'title_store'))
+        return TitleStore.from_dict(dict(self.get_pickle(os.path.join(folder, 'doctitles.pkl'))))
+
+    def get_doc_map(self, folder):
+        """
+        loads the doc id mapping written by reorder.py.
+        :param folder: the folder of the doc store.
+        :return: DocMap, or None when the indexes were not renumbered.
+        """
+        if os.path.isdir(os.path.join(folder, 'doc_map')):
+            return DocMap.open(os.path.join(folder, 'doc_map'))
+        return None
+
+    def to_internal_ids(self, wiki_ids):
+        """
+        translates wiki ids of a request to the doc ids of the indexes and stores.
+        :param wiki_ids: list of wiki ids.
+        :return: NumPy array of doc ids, the wiki ids themselves when the indexes were not renumbered.
+        """
+        if self.DOC_MAP is None:
+            return np.asarray(wiki_ids, dtype=np.int64)
+        return self.DOC_MAP.to_internal(wiki_ids)
+
+    def to_wiki_ids(self, doc_ids):
+        """
+        translates doc ids of the indexes back to wiki ids, see to_internal_ids.
+        :param doc_ids: list of doc ids.
+        :return: NumPy array of wiki ids.
+        """
+        if self.DOC_MAP is None:
+            return np.asarray(doc_ids, dtype=np.int64)
+        return self.DOC_MAP.to_wiki(doc_ids)
+
+    def get_index(self, folder, name):
+        """
+        loads an inverted index, from its memory-mapped lexicon when it was converted to one.
+        :param folder: the index folder.
+        :param name: the index name, e.g. index_text.
+        :return: the inverted index.
+        """
+        if os.path.isdir(os.path.join(folder, f'{name}_lexicon')):
+            inverted_index = InvertedIndex.read_lexicon(folder, name)
+        else:
+            inverted_index = self.get_pickle(os.path.join(folder, f'{name}.pkl'))
+        # the posting cache keys, see get_posting_key
+        inverted_index.name = name
+        return inverted_index
+
     def get_tokens(self, text):
         """
         simple tokenization based on assignment 3.
         :param text: a given text string.
         :return: a list of processed tokens.
         """
-        list_of_tokens = [token.group() for token in RE_WORD.finditer(text.lower()) if
-                          token.group() not in ALL_STOPWORDS]
-        return list_of_tokens
+        with metrics.stage('tokenize'):
+            return tokenize(text)
 
     def get_page_rank_by_id(self, doc_id):
         """
@@ -44,10 +170,16 @@ class Helper:
         :param doc_id: a given wikipedia document id
         :return: a list of page rank scores the fits the given id.
         """
-        try:
-            return float(self.PAGERANK.get(doc_id, 0))
-        except Exception as ex:
-            raise ex
+        return float(self.DOCS.get('pagerank', doc_id))
+
+    def get_page_ranks(self, doc_ids):
+        """
+        batch version of get_page_rank_by_id, resolves all the ids in one vectorized lookup.
+        :param doc_ids: list or array of wikipedia document ids.
+        :return: NumPy float array of page rank scores, aligned with doc_ids.
+        """
+        with metrics.stage('pagerank'):
+            return self.DOCS.lookup('pagerank', doc_ids).astype(np.float64)
 
     def get_page_view_by_id(self, doc_id):
         """
@@ -55,10 +187,16 @@ class Helper:
          :param doc_id: a given wikipedia document id
          :return: a list of page view scores the fits the given id.
          """
-        try:
-            return int(self.PAGEVIEWS.get(doc_id, 0))
-        except Exception as ex:
-            raise ex
+        return int(self.DOCS.get('pageviews', doc_id))
+
+    def get_page_views(self, doc_ids):
+        """
+        batch version of get_page_view_by_id, resolves all the ids in one vectorized lookup.
+        :param doc_ids: list or array of wikipedia document ids.
+        :return: NumPy int array of page view numbers, aligned with doc_ids.
+        """
+        with metrics.stage('pageviews'):
+            return self.DOCS.lookup('pageviews', doc_ids).astype(np.int64)
 
     def frequency_ranking(self, tokens, inverted_index, folder):
         """
@@ -68,25 +206,226 @@ class Helper:
         :param folder: origin folder.
         :return: a list of ranked ids.
         """
-        index_terms = set(inverted_index.df.keys())
-        # how many terms from the query, exists in each doc?
-        terms_in_doc = {}
-        distinct_tokens = set(tokens)
-        # take only terms that in the index
-        query_tokens_that_exists_in_index = [term for term in distinct_tokens if
-                                             term in index_terms]
-        if len(query_tokens_that_exists_in_index) == 0:
-            return []
-        words, pls = self.get_posting_iter(inverted_index, folder, query_tokens_that_exists_in_index)
-        for term in query_tokens_that_exists_in_index:
-            try:
-                term_posting_list = pls[words.index(term)]
-                for doc_id, freq in term_posting_list:
-                    if doc_id != 0:
-                        terms_in_doc[doc_id] = terms_in_doc.get(doc_id, 0) + 1
-            except Exception as ex:
-                raise ex
-        return list(terms_in_doc.items())
+        doc_ids, terms_in_doc = self.frequency_scores(tokens, inverted_index, folder)
+        return list(zip(doc_ids.tolist(), terms_in_doc.tolist()))
+
+    def frequency_scores(self, tokens, inverted_index, folder, min_match=1):
+        """
+        array version of frequency_ranking.
+        :param tokens: list of tokens.
+        :param inverted_index: .pkl inverted index.
+        :param folder: origin folder.
+        :param min_match: minimal number of distinct tokens a doc must have, the number of distinct tokens for
+                          a conjunctive (AND) query. See min_match_scores.
+        :return: two aligned NumPy arrays, sorted doc ids and the number of distinct tokens in each.
+        """
+        return self.batch_frequency_scores([tokens], inverted_index, folder, [min_match])[0]
+
+    def batch_frequency_scores(self, queries, inverted_index, folder, min_matches=None):
+        """
+        frequency_scores of many queries at once, reading the posting list of every distinct term of the
+        batch once.
+        :param queries: list of lists of tokens.
+        :param inverted_index: .pkl inverted index.
+        :param folder: origin folder.
+        :param min_matches: the min_match of every query, 1 for all of them by default.
+        :return: a list of (doc ids, counts) NumPy array pairs, one per query, see frequency_scores.
+        """
+        min_matches = min_matches or [1] * len(queries)
+        inverted_index = self.get_snapshot(inverted_index)
+        with metrics.stage('lexicon'):
+            # take only terms that in the index
+            queries_terms = [self.analyzer.bind(tokens, inverted_index).terms for tokens in queries]
+        queries_terms = [terms if len(terms) >= max(min_match, 1) else []
+                         for terms, min_match in zip(queries_terms, min_matches)]
+        postings = self.get_batch_postings(inverted_index, folder, queries_terms)
+        results = []
+        with metrics.stage('score'):
+            for terms, min_match in zip(queries_terms, min_matches):
+                if len(terms) == 0:
+                    results.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)))
+                elif min_match > 1:
+                    results.append(self.min_match_scores([postings[term][0] for term in terms], min_match))
+                else:
+                    # how many terms from the query, exists in each doc?
+                    doc_ids = np.concatenate([postings[term][0] for term in terms]).astype(np.int64)
+                    results.append(np.unique(doc_ids[doc_ids != 0], return_counts=True))
+        return results
+
+    def top_k_by_count(self, tokens, inverted_index, folder, k=100):
+        """
+        the top k docs by number of distinct matched tokens, then doc id. When doc ids are in descending
+        PageRank order (see reorder.py) this is the title ranking of /search, and the docs that match all the
+        tokens come first, in doc id order: they are found by intersecting the lists from their start and
+        stopping at the k-th one, without reading the rest of the lists. Falls back to counting all the
+        matches when fewer than k docs match all the tokens.
+        :param tokens: list of tokens.
+        :param inverted_index: .pkl inverted index.
+        :param folder: origin folder.
+        :param k: number of docs.
+        :return: NumPy array of at most k doc ids.
+        """
+        inverted_index = self.get_snapshot(inverted_index)
+        with metrics.stage('lexicon'):
+            terms = self.analyzer.bind(tokens, inverted_index).terms
+        if len(terms) == 0:
+            return np.empty(0, dtype=np.int64)
+        postings = self.get_batch_postings(inverted_index, folder, [terms])
+        with metrics.stage('score'):
+            # native int64 arrays, so that searching them does not convert the big-endian posting views; the
+            # padding doc id 0 can only come first
+            lists = sorted((np.asarray(doc_ids[1:] if len(doc_ids) and doc_ids[0] == 0 else doc_ids, dtype=np.int64)
+                            for doc_ids, tfs in (postings[term] for term in terms)), key=len)
+            top = self.first_in_all(lists, k)
+            if len(top) >= k:
+                return top
+            doc_ids = np.concatenate(lists)
+            doc_ids, counts = np.unique(doc_ids, return_counts=True)
+            return doc_ids[np.lexsort((doc_ids, -counts))][:k]
+
+    def first_in_all(self, lists, k, block=GALLOP_BLOCK):
+        """
+        the k smallest doc ids common to all the lists: blocks of the shortest list are galloped into the
+        other lists (see gallop_members) from the position the previous block reached, until k are found.
+        :param lists: sorted NumPy doc id arrays, shortest first.
+        :param k: number of doc ids.
+        :param block: number of doc ids of the shortest list checked at once.
+        :return: sorted NumPy array of at most k doc ids.
+        """
+        # searches must not copy the rest of a list on every block, as they do on big-endian posting views
+        lists = [np.asarray(doc_ids, dtype=np.int64) for doc_ids in lists]
+        found, n_found = [], 0
+        positions = [0] * len(lists)
+        for start in range(0, len(lists[0]), block):
+            chunk = lists[0][start:start + block]
+            for j in range(1, len(lists)):
+                # the part of list j up to the end of the chunk, from where the previous chunk stopped
+                end = positions[j] + int(np.searchsorted(lists[j][positions[j]:], chunk[-1], side='right'))
+                chunk = chunk[self.gallop_members(chunk, lists[j][positions[j]:end])]
+                positions[j] = end
+                if len(chunk) == 0:
+                    break
+            found.append(chunk)
+            n_found += len(chunk)
+            if n_found >= k:
+                break
+        return np.concatenate(found)[:k] if found else np.empty(0, dtype=np.int64)
+
+    def bitmap_frequency_scores(self, tokens, bitmap_index, folder, min_match=1):
+        """
+        frequency_scores over an index converted by InvertedIndex.convert_bitmaps: the match counts come
+        from bit-sliced additions of the bitmaps of the tokens, without decoding any posting list.
+        :param tokens: list of tokens.
+        :param bitmap_index: .pkl inverted index with bitmap posting lists.
+        :param folder: origin folder.
+        :param min_match: minimal number of distinct tokens a doc must have.
+        :return: two aligned NumPy arrays, sorted doc ids and the number of distinct tokens in each.
+        """
+        with metrics.stage('lexicon'):
+            terms = self.analyzer.bind(tokens, bitmap_index).terms
+        bitmaps = [bitmap for w, bitmap in bitmap_index.posting_bitmaps_iter(folder, terms, self.reader)]
+        with metrics.stage('score'):
+            return count_matches(bitmaps, min_match)
+
+    def page_by_count(self, doc_ids, counts, limit, offset=0, after=None):
+        """
+        a page of the frequency ranking (by count, descending, then doc id) by partial selection: only the
+        offset + limit best results are selected (np.argpartition) and sorted, not the whole candidate set.
+        :param doc_ids: sorted NumPy array of doc ids, as returned by frequency_scores.
+        :param counts: aligned NumPy array of their number of distinct tokens.
+        :param limit: page size.
+        :param offset: number of results to skip.
+        :param after: a (count, doc_id) cursor, only the results ranked after it are paged.
+        :return: the doc ids of the page, and the (count, doc_id) cursor of its last result or None if it is
+                 the last page.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+        if after is not None:
+            count, doc_id = after
+            remaining = (counts < count) | ((counts == count) & (doc_ids > doc_id))
+            doc_ids, counts = doc_ids[remaining], counts[remaining]
+        if len(doc_ids) == 0:
+            return np.empty(0, dtype=np.int64), None
+        # one sortable key: count descending, then doc id (postings hold 32 bits doc ids)
+        keys = (counts.max() - counts) * 2 ** 32 + doc_ids
+        n = min(offset + limit, len(keys))
+        best = np.argpartition(keys, n - 1)[:n] if n < len(keys) else np.arange(len(keys))
+        page = best[np.argsort(keys[best])][offset:]
+        if len(page) == 0 or offset + limit >= len(keys):
+            return doc_ids[page], None
+        return doc_ids[page], (int(counts[page[-1]]), int(doc_ids[page[-1]]))
+
+    def iter_by_count(self, doc_ids, counts, chunk_size):
+        """
+        the whole frequency ranking (by count, descending, then doc id) in chunks, without sorting: counts
+        are small integers, so the results are selected one count at a time, already in doc id order.
+        :param doc_ids: sorted NumPy array of doc ids, as returned by frequency_scores.
+        :param counts: aligned NumPy array of their number of distinct tokens.
+        :param chunk_size: maximal number of doc ids per chunk.
+        :return: generator of NumPy arrays of doc ids.
+        """
+        for count in np.unique(counts)[::-1].tolist():
+            matches = doc_ids[counts == count]
+            for start in range(0, len(matches), chunk_size):
+                yield matches[start:start + chunk_size]
+
+    def min_match_scores(self, posting_doc_ids, min_match):
+        """
+        ranked boolean retrieval: the docs that appear in at least min_match of the posting lists, without
+        materializing their union. A doc may miss at most len(lists) - min_match lists, so it appears in one
+        of that many + 1 shortest lists: only those are merged into candidates (just the shortest list for
+        AND). The candidates are then looked up in the longer lists, shortest first, by galloping search,
+        and dropped as soon as the lists left cannot bring them to min_match.
+        :param posting_doc_ids: list of sorted NumPy doc id arrays, one per distinct term.
+        :param min_match: minimal number of lists a doc must appear in.
+        :return: two aligned NumPy arrays, sorted doc ids and the number of lists each one appears in.
+        """
+        # lists are sorted, so the padding doc id 0 can only come first; slicing does not copy long lists
+        lists = sorted((doc_ids[1:] if len(doc_ids) and doc_ids[0] == 0 else doc_ids for doc_ids in posting_doc_ids),
+                       key=len)
+        slack = len(lists) - min_match
+        if slack < 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        if slack == 0:
+            candidates, counts = lists[0].astype(np.int64), np.ones(len(lists[0]), dtype=np.int64)
+        else:
+            candidates, counts = np.unique(np.concatenate(lists[:slack + 1]).astype(np.int64), return_counts=True)
+        for j in range(slack + 1, len(lists)):
+            alive = counts + (len(lists) - j) >= min_match
+            candidates, counts = candidates[alive], counts[alive]
+            if len(candidates) == 0:
+                break
+            counts = counts + self.gallop_members(candidates, lists[j])
+        matches = counts >= min_match
+        return candidates[matches], counts[matches]
+
+    def gallop_members(self, candidates, doc_ids, block=GALLOP_BLOCK):
+        """
+        galloping (exponential search) intersection of two sorted doc id arrays, vectorized by blocks of
+        candidates: from the position reached by the previous block, the window of doc_ids that can hold the
+        block is found by doubling steps, then the block is binary searched in that window only. Stops when
+        doc_ids is exhausted, so a few candidates cost O(log) lookups in a long list.
+        :param candidates: sorted NumPy array of doc ids, usually the shorter one.
+        :param doc_ids: sorted NumPy array of doc ids.
+        :return: boolean NumPy array, whether each candidate is in doc_ids.
+        """
+        found = np.zeros(len(candidates), dtype=bool)
+        position, n = 0, len(doc_ids)
+        for start in range(0, len(candidates), block):
+            if position >= n:
+                break
+            chunk = candidates[start:start + block]
+            step, end = 1, position
+            while end < n and doc_ids[end] < chunk[-1]:
+                end = position + step
+                step *= 2
+            end = min(end + 1, n)
+            window = doc_ids[position:end]
+            positions = np.minimum(np.searchsorted(window, chunk), len(window) - 1)
+            found[start:start + block] = window[positions] == chunk
+            position += int(np.searchsorted(window, chunk[-1], side='right'))
+        return found
 
     def generate_query_tfidf_vector(self, original_query_to_search, processed_query_to_search, inverted_index):
         """
@@ -109,18 +448,38 @@ class Helper:
         vectorized query with tfidf scores
         """
 
-        epsilon = .0000001
         Q = {}
         counter = Counter(original_query_to_search)
         for token in processed_query_to_search:
             # term frequency divided by the length of the query
             tf = counter[token] / len(original_query_to_search)
-            df = inverted_index.df[token]
-            # smoothing
-            idf = math.log((len(inverted_index.DL)) / (df + epsilon), 10)
-            Q[token] = tf * idf
+            Q[token] = tf * self.get_idf(inverted_index, token)
         return Q
 
+    def get_idf(self, inverted_index, term):
+        """
+        idf of a term, with log base 10 and smoothing. A shard of a sharded index carries the
+        collection-wide N and df, so its scores are comparable with the other shards.
+        :param inverted_index: .pkl inverted index.
+        :param term: a term of the index.
+        :return: the idf of the term.
+        """
+        epsilon = .0000001
+        n_docs = getattr(inverted_index, 'N', None) or len(inverted_index.DL)
+        df = getattr(inverted_index, 'global_df', inverted_index.df)[term]
+        return math.log(n_docs / (df + epsilon), 10)
+
+    def get_snapshot(self, inverted_index):
+        """
+        the view of an index that a whole query runs against: the current snapshot of a segmented index
+        (see segments.py), so that documents added or deleted meanwhile do not affect the query.
+        :param inverted_index: .pkl inverted index or segments.SegmentedIndex.
+        :return: an index with a fixed content.
+        """
+        if hasattr(inverted_index, 'snapshot'):
+            return inverted_index.snapshot()
+        return inverted_index
+
     def get_posting_iter(self, inverted_index, folder, query_tokens):
         """
         This function returning the iterator working with posting list.
@@ -128,9 +487,103 @@ class Helper:
         Parameters:
         ----------
         index: inverted index
+
+        Returns:
+        -----------
+        words: tuple of terms.
+        pls: tuple of (doc_ids, tfs) NumPy array pairs, one per term.
         """
-        words, pls = zip(*inverted_index.posting_lists_iter(folder, query_tokens))
-        return words, pls
+        postings = {}
+        missing = []
+        index_key = self.get_posting_key(inverted_index, folder)
+        for w in query_tokens:
+            posting_list = self.posting_cache.get(index_key + (w,)) if index_key is not None else None
+            if posting_list is None:
+                missing.append(w)
+            else:
+                postings[w] = posting_list
+        if len(missing) > 1:
+            # reads and decoding release the GIL, fetch the terms concurrently
+            fetch = metrics.propagate(lambda w: next(inverted_index.posting_lists_iter_arrays(folder, [w], self.reader)))
+            fetched = self.executor.map(fetch, missing)
+        else:
+            fetched = inverted_index.posting_lists_iter_arrays(folder, missing, self.reader)
+        index_name = os.path.basename(os.path.normpath(folder)) if folder else ''
+        for w, doc_ids, tfs in fetched:
+            postings[w] = (doc_ids, tfs)
+            if index_key is not None and owned_nbytes(postings[w]) > 0:
+                self.posting_cache.put(index_key + (w,), postings[w])
+            metrics.count_postings(index_name, len(doc_ids), self.get_posting_bytes(inverted_index, w))
+        words = tuple(query_tokens)
+        return words, tuple(postings[w] for w in words)
+
+    def cache_postings(self, inverted_index, folder, query_tokens):
+        """
+        decodes posting lists into native arrays owned by the posting cache, also those of the raw format, whose
+        views of the posting files get_posting_iter does not cache. E.g. prefork.py fills the cache of the parent
+        process this way, so that forked workers share the decoded arrays.
+        :param inverted_index: .pkl inverted index.
+        :param folder: origin folder.
+        :param query_tokens: terms.
+        """
+        inverted_index = self.get_snapshot(inverted_index)
+        index_key = self.get_posting_key(inverted_index, folder)
+        if index_key is None:
+            return
+        for w, doc_ids, tfs in inverted_index.posting_lists_iter_arrays(folder, query_tokens, self.reader):
+            posting_list = tuple(np.array(a, dtype=a.dtype.newbyteorder('=')) for a in (doc_ids, tfs))
+            self.posting_cache.put(index_key + (w,), posting_list)
+
+    def get_posting_key(self, inverted_index, folder):
+        """
+        the part of the posting cache keys that identifies an index: posting lists of a segmented index change
+        with its generation, and indexes of the same folder (e.g. the body index and its impact index) have
+        different posting lists.
+        :param inverted_index: .pkl inverted index, named by get_index.
+        :param folder: origin folder.
+        :return: a tuple, None for an index without a name, whose posting lists are not cached.
+        """
+        name = getattr(inverted_index, 'name', None)
+        if name is None:
+            return None
+        return folder, name, getattr(inverted_index, 'generation', None)
+
+    def get_posting_bytes(self, inverted_index, term):
+        """
+        size in bytes of the posting list of a term in the posting files.
+        :param inverted_index: .pkl inverted index.
+        :param term: a term of the index.
+        :return: number of bytes.
+        """
+        if getattr(inverted_index, 'posting_format', 1) == 2:
+            return inverted_index.posting_sizes[term]
+        return inverted_index.df[term] * TUPLE_SIZE
+
+    def get_doc_lengths(self, inverted_index, doc_ids):
+        """
+        vectorized lookup of document lengths.
+        :param inverted_index: .pkl inverted index.
+        :param doc_ids: NumPy array of doc ids.
+        :return: NumPy float array of document lengths, aligned with doc_ids.
+        """
+        DL = inverted_index.DL
+        if hasattr(DL, 'lookup'):
+            return DL.lookup(doc_ids)
+        return np.fromiter((DL.get(doc_id, 0) for doc_id in doc_ids.tolist()), dtype=np.float64,
+                           count=len(doc_ids))
+
+    def get_doc_norms(self, inverted_index, doc_ids):
+        """
+        vectorized lookup of the index-time norms of the full tfidf vectors of documents.
+        :param inverted_index: .pkl inverted index with doc_norms.
+        :param doc_ids: NumPy array of doc ids.
+        :return: NumPy float array of document norms, aligned with doc_ids.
+        """
+        doc_norms = inverted_index.doc_norms
+        if hasattr(doc_norms, 'lookup'):
+            return doc_norms.lookup(doc_ids)
+        return np.fromiter((doc_norms.get(doc_id, 0) for doc_id in doc_ids.tolist()), dtype=np.float64,
+                           count=len(doc_ids))
 
     def get_candidate_documents_and_scores(self, query_to_search, inverted_index, words, pls):
         """
@@ -155,15 +608,16 @@ class Helper:
                                                                    key: pair (doc_id,term)
                                                                    value: tfidf score.
         """
-        epsilon = .0000001
         candidates = {}
         for term in np.unique(query_to_search):
             if term in words:
-                list_of_doc = pls[words.index(term)]
-                normalized_tfidf = [(doc_id, (freq / inverted_index.DL[doc_id]) * math.log(len(inverted_index.DL) / (inverted_index.df[term] + epsilon), 10)) for
-                                   doc_id, freq in list_of_doc if doc_id != 0]
+                doc_ids, tfs = pls[words.index(term)]
+                mask = doc_ids != 0
+                doc_ids, tfs = doc_ids[mask], tfs[mask]
+                idf = self.get_idf(inverted_index, term)
+                normalized_tfidf = tfs / self.get_doc_lengths(inverted_index, doc_ids) * idf
 
-                for doc_id, tfidf in normalized_tfidf:
+                for doc_id, tfidf in zip(doc_ids.tolist(), normalized_tfidf.tolist()):
                     candidates[(doc_id, term)] = candidates.get((doc_id, term), 0) + tfidf
 
         return candidates
@@ -200,7 +654,7 @@ class Helper:
         for key in candidates_scores:
             tfidf = candidates_scores[key]
             doc_id, term = key
-            D.loc[doc_id][term] = tfidf
+            D.loc[doc_id, term] = tfidf
 
         return D
 
@@ -235,6 +689,413 @@ class Helper:
 
         return ans
 
+    def get_term_weights(self, query_to_search, inverted_index, words, pls, term_weights=None):
+        """
+        Computes the normalized tfidf weights of every posting of the query terms as flat arrays.
+        For calculation of IDF, use log with base 10.
+        tf will be normalized based on the length of the document.
+
+        Parameters:
+        -----------
+        query_to_search: list of distinct query terms that exist in the index.
+
+        index:           inverted index loaded from the corresponding files.
+
+        words,pls: iterator for working with posting.
+
+        term_weights: optional dictionary of the (doc ids, weights) of terms, which does not depend on the
+                      query, filled and reused across the queries of a batch.
+
+        Returns:
+        -----------
+        three aligned arrays: doc ids, term position in query_to_search, tfidf weight.
+        """
+        all_doc_ids, all_terms, all_weights = [], [], []
+        for j, term in enumerate(query_to_search):
+            if term in words:
+                if term_weights is not None and term in term_weights:
+                    doc_ids, weights = term_weights[term]
+                else:
+                    doc_ids, tfs = pls[words.index(term)]
+                    mask = doc_ids != 0
+                    doc_ids, tfs = doc_ids[mask].astype(np.int64), tfs[mask]
+                    idf = self.get_idf(inverted_index, term)
+                    weights = tfs / self.get_doc_lengths(inverted_index, doc_ids) * idf
+                    if term_weights is not None:
+                        term_weights[term] = (doc_ids, weights)
+                all_doc_ids.append(doc_ids)
+                all_terms.append(np.full(len(doc_ids), j, dtype=np.int64))
+                all_weights.append(weights)
+        if len(all_doc_ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(all_doc_ids), np.concatenate(all_terms), np.concatenate(all_weights)
+
+    def cosine_similarity_top_n(self, query_to_search, Q, inverted_index, words, pls, N=100, term_weights=None):
+        """
+        Term-at-a-time equivalent of generate_document_tfidf_matrix + cosine_similarity + get_top_n.
+        Scores are accumulated per candidate document in arrays instead of a DataFrame, and only
+        the best N are sorted.
+
+        Parameters:
+        -----------
+        query_to_search: list of distinct query terms that exist in the index.
+
+        Q: vectorized query with tfidf scores
+
+        index:           inverted index loaded from the corresponding files.
+
+        words,pls: iterator for working with posting.
+
+        N: Integer (how many documents to retrieve).
+
+        Returns:
+        -----------
+        a ranked list of pairs (doc_id, score) in the length of N.
+        """
+        candidates, scores = self.cosine_similarity_scores(query_to_search, Q, inverted_index, words, pls,
+                                                           term_weights)
+        if len(candidates) == 0:
+            return []
+        return self.get_top_n_from_arrays(candidates, scores, N)
+
+    def cosine_similarity_scores(self, query_to_search, Q, inverted_index, words, pls, term_weights=None):
+        """
+        Cosine similarity of every candidate document, see cosine_similarity_top_n.
+        :return: two aligned NumPy arrays, sorted candidate doc ids and their cosine similarity.
+        """
+        doc_ids, terms, weights = self.get_term_weights(query_to_search, inverted_index, words, pls, term_weights)
+        if len(doc_ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        q = np.array([Q[term] for term in query_to_search])
+        candidates, doc_index = np.unique(doc_ids, return_inverse=True)
+        # accumulators, one cell per candidate document
+        dot = np.bincount(doc_index, weights=weights * q[terms], minlength=len(candidates))
+        squared_norm = np.bincount(doc_index, weights=weights * weights, minlength=len(candidates))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = dot / (np.sqrt(squared_norm) * np.linalg.norm(q))
+        return candidates, scores
+
+    def tfidf_top_n(self, query_to_search, Q, inverted_index, words, pls, N=100, term_weights=None):
+        """
+        Exhaustive tfidf ranking: a document's score is the dot product of its tfidf vector and
+        the query vector, without cosine normalization. This is the ranking maxscore_top_n prunes.
+
+        Parameters:
+        -----------
+        query_to_search: list of distinct query terms that exist in the index.
+
+        Q: vectorized query with tfidf scores
+
+        index:           inverted index loaded from the corresponding files.
+
+        words,pls: iterator for working with posting.
+
+        N: Integer (how many documents to retrieve).
+
+        Returns:
+        -----------
+        a ranked list of pairs (doc_id, score) in the length of N, and a dictionary of statistics.
+        """
+        doc_ids, terms, weights = self.get_term_weights(query_to_search, inverted_index, words, pls, term_weights)
+        stats = {'postings': len(doc_ids), 'postings_skipped': 0}
+        if len(doc_ids) == 0:
+            return [], stats
+        q = np.array([Q[term] for term in query_to_search])
+        candidates, doc_index = np.unique(doc_ids, return_inverse=True)
+        scores = np.bincount(doc_index, weights=weights * q[terms], minlength=len(candidates))
+        return self.get_top_n_from_arrays(candidates, scores, N), stats
+
+    def cosine_full_top_n(self, query_to_search, Q, inverted_index, words, pls, N=100, term_weights=None):
+        """
+        Cosine similarity against the full tfidf vector of every document: the dot product of
+        tfidf_top_n divided by the index-time norm of the document (`doc_norms`), instead of the
+        norm of its query terms only as in cosine_similarity_top_n.
+
+        Parameters:
+        -----------
+        query_to_search: list of distinct query terms that exist in the index.
+
+        Q: vectorized query with tfidf scores
+
+        index:           inverted index loaded from the corresponding files, with doc_norms.
+
+        words,pls: iterator for working with posting.
+
+        N: Integer (how many documents to retrieve).
+
+        Returns:
+        -----------
+        a ranked list of pairs (doc_id, score) in the length of N, and a dictionary of statistics.
+        """
+        doc_ids, terms, weights = self.get_term_weights(query_to_search, inverted_index, words, pls, term_weights)
+        stats = {'postings': len(doc_ids), 'postings_skipped': 0}
+        if len(doc_ids) == 0:
+            return [], stats
+        q = np.array([Q[term] for term in query_to_search])
+        candidates, doc_index = np.unique(doc_ids, return_inverse=True)
+        dot = np.bincount(doc_index, weights=weights * q[terms], minlength=len(candidates))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.nan_to_num(dot / (self.get_doc_norms(inverted_index, candidates) * np.linalg.norm(q)))
+        return self.get_top_n_from_arrays(candidates, scores, N), stats
+
+    def bm25_top_n(self, query_to_search, query_tf, impact_index, words, pls, N=100):
+        """
+        BM25 ranking over an impact index: the postings hold the quantized BM25 score of every
+        term in every document (see ImpactQuantizer in inverted_index_gcp.py), so a document's
+        score is the sum of its impacts, weighted by the query tf, and nothing but the posting
+        lists is read at query time.
+
+        Parameters:
+        -----------
+        query_to_search: list of distinct query terms that exist in the index.
+
+        query_tf: dictionary of the query tf of every term.
+
+        impact_index:    impact inverted index loaded from the corresponding files.
+
+        words,pls: iterator for working with posting.
+
+        N: Integer (how many documents to retrieve).
+
+        Returns:
+        -----------
+        a ranked list of pairs (doc_id, score) in the length of N, and a dictionary of statistics.
+        """
+        all_doc_ids, all_impacts = [], []
+        for term in query_to_search:
+            if term in words:
+                doc_ids, impacts = pls[words.index(term)]
+                all_doc_ids.append(doc_ids.astype(np.int64))
+                all_impacts.append(impacts * query_tf[term])
+        stats = {'postings': sum(len(doc_ids) for doc_ids in all_doc_ids), 'postings_skipped': 0}
+        if stats['postings'] == 0:
+            return [], stats
+        candidates, doc_index = np.unique(np.concatenate(all_doc_ids), return_inverse=True)
+        scores = np.bincount(doc_index, weights=np.concatenate(all_impacts), minlength=len(candidates))
+        return self.get_top_n_from_arrays(candidates, scores / impact_index.impact_scale, N), stats
+
+    def maxscore_top_n(self, query_to_search, Q, inverted_index, words, pls, N=100):
+        """
+        MaxScore dynamic pruning over the tfidf ranking of tfidf_top_n, returns the same top N.
+        Every term gets an upper bound on its score contribution from the index-time
+        `max_normalized_tf`. A threshold is estimated by fully scoring the documents of the shortest
+        posting list. Terms whose accumulated upper bounds cannot reach the threshold are
+        non-essential: they never produce candidates, and their postings are only looked up (by
+        binary search) for candidates that can still reach the threshold.
+
+        Parameters:
+        -----------
+        query_to_search: list of distinct query terms that exist in the index.
+
+        Q: vectorized query with tfidf scores
+
+        index:           inverted index loaded from the corresponding files.
+
+        words,pls: iterator for working with posting.
+
+        N: Integer (how many documents to retrieve).
+
+        Returns:
+        -----------
+        a ranked list of pairs (doc_id, score) in the length of N, and a dictionary of statistics.
+        """
+        max_normalized_tf = getattr(inverted_index, 'max_normalized_tf', {})
+        lists = []
+        for term in query_to_search:
+            if term in words:
+                doc_ids, tfs = pls[words.index(term)]
+                mask = doc_ids != 0
+                doc_ids, tfs = doc_ids[mask].astype(np.int64), tfs[mask]
+                if len(doc_ids) == 0:
+                    continue
+                if np.any(doc_ids[1:] < doc_ids[:-1]):
+                    order = np.argsort(doc_ids, kind='stable')
+                    doc_ids, tfs = doc_ids[order], tfs[order]
+                idf = self.get_idf(inverted_index, term)
+                factor = Q[term] * idf
+                # tf / DL never exceeds 1, which is the bound of indexes built without max_normalized_tf
+                bound = max(factor * max_normalized_tf.get(term, 1.0), 0.0)
+                lists.append((bound, doc_ids, tfs, factor))
+        stats = {'postings': sum(len(doc_ids) for _, doc_ids, _, _ in lists), 'postings_skipped': 0}
+        if len(lists) == 0:
+            return [], stats
+        # ascending upper bounds, the non-essential terms are a prefix
+        lists.sort(key=lambda x: x[0])
+        accumulated_bounds = np.cumsum([bound for bound, _, _, _ in lists])
+
+        def contribution(j, positions):
+            bound, doc_ids, tfs, factor = lists[j]
+            return tfs[positions] / self.get_doc_lengths(inverted_index, doc_ids[positions]) * factor
+
+        def lookup(j, candidates):
+            doc_ids = lists[j][1]
+            positions = np.minimum(np.searchsorted(doc_ids, candidates), len(doc_ids) - 1)
+            found = doc_ids[positions] == candidates
+            return positions[found], found
+
+        # estimate the threshold from the shortest posting list
+        shortest = int(np.argmin([len(doc_ids) for _, doc_ids, _, _ in lists]))
+        sample = lists[shortest][1]
+        sample_scores = np.zeros(len(sample))
+        for j in range(len(lists)):
+            positions, found = lookup(j, sample)
+            sample_scores[found] += contribution(j, positions)
+        if len(sample_scores) >= N:
+            # scores are rounded to 5 digits when ranked, keep a margin so ties are not pruned
+            threshold = np.partition(sample_scores, len(sample_scores) - N)[len(sample_scores) - N] - 1e-5
+        else:
+            threshold = -np.inf
+        n_non_essential = min(int(np.searchsorted(accumulated_bounds, threshold, side='left')), len(lists) - 1)
+
+        # candidates come from the essential lists only
+        essential_doc_ids = np.concatenate([lists[j][1] for j in range(n_non_essential, len(lists))])
+        essential_scores = np.concatenate([contribution(j, np.arange(len(lists[j][1])))
+                                           for j in range(n_non_essential, len(lists))])
+        candidates, doc_index = np.unique(essential_doc_ids, return_inverse=True)
+        scores = np.bincount(doc_index, weights=essential_scores, minlength=len(candidates))
+
+        # complete the scores with the non-essential lists, from the highest bound down
+        scored = 0
+        for j in range(n_non_essential - 1, -1, -1):
+            keep = scores + accumulated_bounds[j] >= threshold
+            candidates, scores = candidates[keep], scores[keep]
+            positions, found = lookup(j, candidates)
+            scores[found] += contribution(j, positions)
+            scored += len(positions)
+        non_essential_postings = sum(len(lists[j][1]) for j in range(n_non_essential))
+        stats['postings_skipped'] = non_essential_postings - scored
+        return self.get_top_n_from_arrays(candidates, scores, N), stats
+
+    def body_ranking(self, query_tokens, inverted_index, folder, mode='cosine', N=100):
+        """
+        ranks documents by their body, see search_body in search_frontend.py.
+        :param query_tokens: list of query tokens.
+        :param inverted_index: the body inverted index.
+        :param folder: origin folder.
+        :param mode: 'cosine', 'cosine_full', 'tfidf', 'maxscore' or 'bm25' (inverted_index is then
+                     the BM25 impact index).
+        :param N: how many documents to retrieve, None for all the candidates (cosine only).
+        :return: a ranked list of pairs (doc_id, score) and a dictionary of postings statistics.
+        """
+        return self.batch_body_ranking([query_tokens], inverted_index, folder, mode, N)[0]
+
+    def batch_body_ranking(self, queries, inverted_index, folder, mode='cosine', N=100):
+        """
+        body_ranking of many queries at once: the posting list of every distinct term of the batch is read
+        once, then each query is scored from the shared posting lists.
+        :param queries: list of lists of query tokens.
+        :param inverted_index: the body inverted index.
+        :param folder: origin folder.
+        :param mode: see body_ranking.
+        :param N: how many documents to retrieve per query.
+        :return: a list of (ranking, postings statistics) pairs, one per query, see body_ranking.
+        """
+        if mode not in BODY_MODES:
+            raise ValueError(f'unknown ranking mode {mode}, expected one of {", ".join(BODY_MODES)}')
+        inverted_index = self.get_snapshot(inverted_index)
+        # index-time statistics only exist for built indexes, not for documents indexed since
+        if mode == 'bm25' and not hasattr(inverted_index, 'impact_scale'):
+            raise ValueError('bm25 ranking requires an impact index')
+        if mode == 'cosine_full' and not hasattr(inverted_index, 'doc_norms'):
+            raise ValueError('cosine_full ranking requires an index with doc_norms')
+        with metrics.stage('lexicon'):
+            bound_queries = [self.analyzer.bind(query_tokens, inverted_index) for query_tokens in queries]
+        postings = self.get_batch_postings(inverted_index, folder, [bound_query.terms for bound_query in bound_queries])
+        # the tfidf weights of a term's postings are computed once for the whole batch
+        term_weights = {} if len(queries) > 1 else None
+        with metrics.stage('score'):
+            return [self.score_body(bound_query, inverted_index, tuple(bound_query.terms),
+                                    tuple(postings[term] for term in bound_query.terms), mode, N, term_weights)
+                    for bound_query in bound_queries]
+
+    def get_batch_postings(self, inverted_index, folder, queries_terms):
+        """
+        the posting lists of all the terms of a batch of queries, each read once.
+        :param queries_terms: list of lists of terms that exist in the index.
+        :return: a dictionary of term to (doc_ids, tfs) NumPy arrays.
+        """
+        terms = list(dict.fromkeys(term for terms in queries_terms for term in terms))
+        if len(terms) == 0:
+            return {}
+        words, pls = self.get_posting_iter(inverted_index, folder, query_tokens=terms)
+        return dict(zip(words, pls))
+
+    def score_body(self, bound_query, inverted_index, words, pls, mode='cosine', N=100, term_weights=None):
+        """
+        scores the posting lists of a query bound to the body index, see body_ranking.
+        :param bound_query: the query_analyzer.BoundQuery of the query.
+        :param term_weights: see get_term_weights.
+        :return: a ranked list of pairs (doc_id, score) and a dictionary of postings statistics.
+        """
+        query_tokens_that_exists_in_index = bound_query.terms
+        if len(query_tokens_that_exists_in_index) == 0:
+            return [], {'postings': 0, 'postings_skipped': 0}
+        Q = bound_query.tfidf_vector()
+        if mode == 'maxscore':
+            return self.maxscore_top_n(query_tokens_that_exists_in_index, Q, inverted_index, words, pls, N)
+        if mode == 'bm25':
+            return self.bm25_top_n(query_tokens_that_exists_in_index, bound_query.tf, inverted_index, words, pls, N)
+        if mode == 'cosine_full':
+            return self.cosine_full_top_n(query_tokens_that_exists_in_index, Q, inverted_index, words, pls, N,
+                                          term_weights)
+        if mode == 'tfidf':
+            return self.tfidf_top_n(query_tokens_that_exists_in_index, Q, inverted_index, words, pls, N, term_weights)
+        if mode != 'cosine':
+            raise ValueError(f'unknown ranking mode {mode}')
+        stats = {'postings': sum(len(doc_ids) for doc_ids, tfs in pls), 'postings_skipped': 0}
+        if N is None:
+            candidates, scores = self.cosine_similarity_scores(query_tokens_that_exists_in_index, Q, inverted_index,
+                                                               words, pls, term_weights)
+            return list(zip(candidates.tolist(), scores.tolist())), stats
+        return self.cosine_similarity_top_n(query_tokens_that_exists_in_index, Q, inverted_index, words, pls, N,
+                                            term_weights), stats
+
+    def fuse_scores(self, field_scores, weights, N=100):
+        """
+        Merges the scores of several fields (e.g. title, body and anchor) and PageRank into one
+        ranking. Each field's scores are scaled to [0, 1] by their maximum, PageRank is scaled by
+        log(1 + pagerank) over the candidates, and a document's score is the weighted sum.
+        :param field_scores: dictionary of field name: (doc_ids, scores) NumPy arrays.
+        :param weights: dictionary of field name (and 'pagerank'): weight.
+        :param N: how many documents to retrieve.
+        :return: a ranked list of pairs (doc_id, score) in the length of N.
+        """
+        all_doc_ids, all_scores = [], []
+        for field, (doc_ids, scores) in field_scores.items():
+            if len(doc_ids) == 0 or weights.get(field, 0) == 0:
+                continue
+            scores = np.asarray(scores, dtype=np.float64)
+            max_score = scores.max()
+            all_doc_ids.append(np.asarray(doc_ids, dtype=np.int64))
+            all_scores.append(weights[field] * scores / max_score if max_score > 0 else np.zeros(len(scores)))
+        if len(all_doc_ids) == 0:
+            return []
+        candidates, doc_index = np.unique(np.concatenate(all_doc_ids), return_inverse=True)
+        scores = np.bincount(doc_index, weights=np.concatenate(all_scores), minlength=len(candidates))
+        if weights.get('pagerank', 0) > 0:
+            pagerank = np.log1p(self.get_page_ranks(candidates))
+            if pagerank.max() > 0:
+                scores += weights['pagerank'] * pagerank / pagerank.max()
+        return self.get_top_n_from_arrays(candidates, scores, N)
+
+    def get_top_n_from_arrays(self, doc_ids, scores, N=100):
+        """
+        Array version of get_top_n, selects the best N with a partial partition before sorting.
+        Ties are broken by ascending doc id, like the stable sort of get_top_n over sorted ids.
+        :param doc_ids: NumPy array of doc ids.
+        :param scores: NumPy array of scores, aligned with doc_ids.
+        :param N: how many documents to retrieve.
+        :return: a ranked list of pairs (doc_id, score) in the length of N.
+        """
+        scores = np.round(scores, 5)
+        if len(scores) > N:
+            kth = len(scores) - N
+            threshold = np.partition(scores, kth)[kth]
+            mask = scores >= threshold
+            doc_ids, scores = doc_ids[mask], scores[mask]
+        order = np.lexsort((doc_ids, -scores))[:N]
+        return list(zip(doc_ids[order].tolist(), scores[order].tolist()))
+
     def get_top_n(self, sim_dict, N=100):
         """
         Sort and return the highest N documents according to the cosine similarity score.
@@ -253,8 +1114,8 @@ class Helper:
         a ranked list of pairs (doc_id, score) in the length of N.
         """
 
-        return sorted([(doc_id, round(score, 5)) for doc_id, score in sim_dict.items()], key=lambda x: x[1],
-                      reverse=True)[:N]
+        return heapq.nlargest(N, [(doc_id, round(score, 5)) for doc_id, score in sim_dict.items()],
+                              key=lambda x: x[1])
 
     def get_doc_title_pairs_from_items(self, res):
         """
@@ -270,4 +1131,13 @@ class Helper:
         :param res: list of doc ids.
         :return: list of tuples, (wiki id, title).
         """
-        return [(id, self.TITLES.get(id, 0)) for id in res]
\ No newline at end of file
+        return [(id, self.TITLES.get(id, 0)) for id in res]
+
+    def get_doc_title_json(self, res):
+        """
+        maps doc ids to wiki titles, directly as a JSON response body.
+        :param res: list of doc ids.
+        :return: bytes of a JSON list of [wiki id, title] pairs.
+        """
+        with metrics.stage('titles'):
+            return self.TITLES.json_pairs(res)
\ No newline at end of file
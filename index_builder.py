@@ -0,0 +1,283 @@
+import os
+import re
+import sys
+import bz2
+import json
+import heapq
+import pickle
+import tempfile
+import itertools
+import numpy as np
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from collections import deque, defaultdict, Counter
+from contextlib import closing
+from multiprocessing import Pool
+from helper import tokenize
+from doc_store import DocColumn
+from inverted_index_gcp import InvertedIndex, MultiFileWriter, DocNorms, ImpactQuantizer, POSTING_DTYPE, TF_MASK
+
+# documents tokenized by a worker per run, which bounds the memory of a worker.
+CHUNK_DOCS = 10000
+# maximal number of runs merged at once, more runs are first merged in rounds.
+MAX_FAN_IN = 128
+FIELDS = ('title', 'text', 'anchor')
+RE_LINK = re.compile(r'\[\[([^\[\]|#]+)(?:#[^\[\]|]*)?(?:\|([^\[\]]*))?\]\]')
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_dump(path):
+    """ Streams the articles of a Wikipedia XML dump (optionally bz2 compressed)
+        as {'id', 'title', 'text', 'links'} dicts, where links are the
+        (target title, anchor text) pairs of the article's wiki links. Parsed
+        elements are cleared so memory does not grow with the dump.
+    """
+    opener = bz2.open if str(path).endswith('.bz2') else open
+    with opener(path, 'rb') as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or _local_name(elem.tag) != 'page':
+                continue
+            page = {_local_name(child.tag): child for child in elem}
+            ns = page.get('ns')
+            if (ns is None or ns.text == '0') and 'redirect' not in page:
+                revision = {_local_name(child.tag): child for child in page['revision']}
+                text = (revision['text'].text or '') if 'text' in revision else ''
+                links = [(target.strip(), anchor or target)
+                         for target, anchor in RE_LINK.findall(text)]
+                yield {'id': int(page['id'].text), 'title': page['title'].text or '',
+                       'text': text, 'links': links}
+            root.clear()
+
+
+def iter_jsonl(path):
+    """ Streams the documents of a JSONL corpus, one {'id', 'title', 'text',
+        'anchor_text'} object per line. anchor_text lists the outgoing links of
+        the document as {'id': target id, 'text': anchor text} objects or
+        [target id, anchor text] pairs.
+    """
+    opener = bz2.open if str(path).endswith('.bz2') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _normalize_title(title):
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+def iter_links(path):
+    """ (source id, target id, anchor text) triples of the wiki links of a
+        corpus, in document order. The links of a dump point to titles,
+        resolved with a first pass over the dump that collects all titles.
+    """
+    if str(path).endswith(('.xml', '.xml.bz2')):
+        title_ids = {_normalize_title(doc['title']): doc['id'] for doc in iter_dump(path)}
+        for doc in iter_dump(path):
+            for target, anchor in doc['links']:
+                target_id = title_ids.get(_normalize_title(target))
+                if target_id is not None:
+                    yield doc['id'], target_id, anchor
+        return
+    for doc in iter_jsonl(path):
+        for link in doc.get('anchor_text') or []:
+            if isinstance(link, dict):
+                yield int(doc['id']), int(link['id']), link.get('text') or ''
+            else:
+                yield int(doc['id']), int(link[0]), link[1] or ''
+
+
+def iter_field(path, field):
+    """ (doc_id, text) pairs of one field of a corpus. The anchor field of a
+        document is the anchor text of the links pointing to it, so its pairs
+        are keyed by the link target (see iter_links).
+    """
+    if field == 'anchor':
+        for source_id, target_id, anchor in iter_links(path):
+            yield target_id, anchor
+        return
+    if str(path).endswith(('.xml', '.xml.bz2')):
+        for doc in iter_dump(path):
+            yield doc['id'], doc[field]
+        return
+    for doc in iter_jsonl(path):
+        yield int(doc['id']), doc.get(field) or ''
+
+
+def _write_run(postings, path):
+    with open(path, 'wb') as f:
+        for w in sorted(postings):
+            doc_ids, tfs = zip(*postings[w])
+            pickle.dump((w, doc_ids, tfs), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _index_chunk(args):
+    """ Worker: tokenizes a chunk of (doc_id, text) pairs and writes its
+        postings as a run sorted by term.
+    Returns:
+    --------
+      the run path and the token count of every doc of the chunk.
+    """
+    pairs, run_path = args
+    doc_tokens = defaultdict(Counter)
+    dl = Counter()
+    for doc_id, text in pairs:
+        tokens = tokenize(text)
+        doc_tokens[doc_id].update(tokens)
+        dl[doc_id] += len(tokens)
+    postings = defaultdict(list)
+    for doc_id in sorted(doc_tokens):
+        for w, tf in doc_tokens[doc_id].items():
+            postings[w].append((doc_id, tf))
+    _write_run(postings, run_path)
+    return run_path, dl
+
+
+def _merge_runs(run_paths):
+    """ k-way merge of runs: yields (term, doc_ids, tfs) in term order, with
+        the postings of a term from all the runs sorted by doc id. Postings of
+        the same doc from different runs (anchor text) are summed.
+    """
+    runs = [_read_run(path) for path in run_paths]
+    merged = heapq.merge(*runs, key=lambda record: record[0])
+    for w, records in itertools.groupby(merged, key=lambda record: record[0]):
+        records = list(records)
+        doc_ids = np.concatenate([np.asarray(r[1], dtype=np.int64) for r in records])
+        tfs = np.concatenate([np.asarray(r[2], dtype=np.int64) for r in records])
+        if len(records) > 1:
+            doc_ids, inverse = np.unique(doc_ids, return_inverse=True)
+            tfs = np.bincount(inverse, weights=tfs).astype(np.int64)
+        yield w, doc_ids, tfs
+
+
+def _reduce_runs(run_paths, tmp_dir):
+    """ Merges runs in rounds of MAX_FAN_IN until at most MAX_FAN_IN remain, so
+        the final merge never holds more than MAX_FAN_IN open files.
+    """
+    round_id = itertools.count()
+    while len(run_paths) > MAX_FAN_IN:
+        merged_paths = []
+        for i in range(0, len(run_paths), MAX_FAN_IN):
+            group = run_paths[i:i + MAX_FAN_IN]
+            path = Path(tmp_dir) / f'merge_{next(round_id)}.pkl'
+            with open(path, 'wb') as f:
+                for record in _merge_runs(group):
+                    pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for run_path in group:
+                os.remove(run_path)
+            merged_paths.append(path)
+        run_paths = merged_paths
+    return run_paths
+
+
+def build_index(pairs, out_dir, name, folder=None, processes=None, chunk_docs=CHUNK_DOCS,
+                min_df=1, tmp_dir=None, backend=None, impact_name=None, k1=1.2, b=0.75, bits=16):
+    """ Builds an inverted index from (doc_id, text) pairs SPIMI style: chunks
+        of the pairs are tokenized by a pool of `processes` workers, each
+        writing an in-memory inverted run to disk, then all the runs are
+        merged one term at a time into `name`_XXX.bin posting files. Only
+        `chunk_docs` documents per worker and one posting list are in memory
+        at once, besides DL.
+
+        Writes `out_dir`/`name`.pkl with df, DL, term_total, posting_locs,
+        max_normalized_tf and doc_norms, and uploads it with the posting files
+        to `backend` under postings_gcp/`folder` when a backend is given. With
+        `impact_name`, a BM25 impact index (see ImpactQuantizer) is written
+        in the same pass as `impact_name`.pkl and `impact_name`_XXX.bin.
+    Returns:
+    --------
+      the InvertedIndex.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    folder = folder or out_dir.name
+    processes = processes or os.cpu_count()
+    index = InvertedIndex()
+    pairs = iter(pairs)
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        run_paths = []
+        dl = Counter()
+        with Pool(processes) as pool:
+            # at most two chunks per worker are in flight, so the corpus is
+            # never read ahead of the workers.
+            pending = deque()
+            chunks = iter(lambda: list(itertools.islice(pairs, chunk_docs)), [])
+            for i, chunk in enumerate(chunks):
+                if len(pending) >= 2 * processes:
+                    run_path, chunk_dl = pending.popleft().get()
+                    run_paths.append(run_path)
+                    dl.update(chunk_dl)
+                pending.append(pool.apply_async(_index_chunk, ((chunk, Path(tmp) / f'run_{i}.pkl'),)))
+            for result in pending:
+                run_path, chunk_dl = result.get()
+                run_paths.append(run_path)
+                dl.update(chunk_dl)
+        index.DL = dl
+        doc_lengths = DocColumn(np.array(sorted(dl), dtype=np.int64),
+                                np.array([dl[doc_id] for doc_id in sorted(dl)], dtype=np.float64))
+        run_paths = _reduce_runs(run_paths, tmp)
+        doc_norms = DocNorms(dl)
+        impact_index = InvertedIndex() if impact_name else None
+        quantizer = ImpactQuantizer(dl, k1, b, bits) if impact_name else None
+        writer = MultiFileWriter(out_dir, name, backend=backend)
+        impact_writer = MultiFileWriter(out_dir, impact_name, backend=backend) if impact_name else None
+        with closing(writer):
+            for w, doc_ids, tfs in _merge_runs(run_paths):
+                if len(doc_ids) < min_df:
+                    continue
+                records = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+                records['doc_id'] = doc_ids
+                records['tf'] = np.minimum(tfs, TF_MASK)
+                index.posting_locs[w].extend(writer.write(records.tobytes(), folder))
+                index.df[w] = len(doc_ids)
+                index.term_total[w] = int(tfs.sum())
+                index.max_normalized_tf[w] = float(np.max(tfs / np.maximum(doc_lengths.lookup(doc_ids), 1)))
+                doc_norms.add(doc_ids, records['tf'], len(doc_ids))
+                if impact_writer is not None:
+                    records['tf'] = quantizer.impacts(doc_ids, records['tf'], len(doc_ids))
+                    impact_index.posting_locs[w].extend(impact_writer.write(records.tobytes(), folder))
+        writer.upload_to_gcp(folder)
+        if impact_writer is not None:
+            impact_writer.close()
+            impact_writer.upload_to_gcp(folder)
+    index.doc_norms = doc_norms.norms()
+    written = [(index, name)]
+    if impact_index is not None:
+        for attribute in ('df', 'term_total', 'DL', 'max_normalized_tf', 'doc_norms'):
+            setattr(impact_index, attribute, getattr(index, attribute))
+        for attribute, value in quantizer.attributes().items():
+            setattr(impact_index, attribute, value)
+        written.append((impact_index, impact_name))
+    for written_index, written_name in written:
+        written_index.write_index(out_dir, written_name)
+        if backend is not None:
+            backend.upload(out_dir / f'{written_name}.pkl', f'postings_gcp/{folder}/{written_name}.pkl')
+    return index
+
+
+if __name__ == '__main__':
+    # usage: python index_builder.py enwiki-latest-pages-articles.xml.bz2 postings_gcp [title,text,anchor] [processes]
+    #        python index_builder.py corpus.jsonl postings_gcp
+    # writes postings_gcp/<field>/index_<field>.pkl and postings_gcp/<field>/<field>_XXX.bin
+    corpus, out_root = sys.argv[1:3]
+    fields = sys.argv[3].split(',') if len(sys.argv) > 3 else FIELDS
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    for field in fields:
+        # the body also gets a BM25 impact index, for /search_body?mode=bm25
+        build_index(iter_field(corpus, field), Path(out_root) / field, f'index_{field}',
+                    processes=processes, impact_name='impact_text' if field == 'text' else None)
@@ -1,27 +1,129 @@
+import os
+import copy
+import math
+import mmap
 import pickle
+import threading
 import itertools
+import metrics
+import numpy as np
+import bitmap_postings
+import compressed_postings
+from lexicon import Lexicon, TermColumn, PostingLocs
+from doc_store import DocColumn
 from pathlib import Path
 from contextlib import closing
-from google.cloud import storage
+from storage_backend import GCSBackend
 from collections import defaultdict
 from collections import Counter
 
 BLOCK_SIZE = 1999998
 TUPLE_SIZE = 6
 TF_MASK = 2 ** 16 - 1
+# a posting is a big-endian 4 bytes doc_id followed by a big-endian 2 bytes tf.
+POSTING_DTYPE = np.dtype([('doc_id', '>u4'), ('tf', '>u2')])
+
+
+def decode_posting_list(b, n_postings):
+    """ Decodes `n_postings` fixed-size records from the bytes-like `b` into
+        two NumPy arrays (doc_ids, tfs). The arrays are views over `b`, nothing
+        is copied.
+    """
+    records = np.frombuffer(b, dtype=POSTING_DTYPE, count=n_postings)
+    return records['doc_id'], records['tf']
+
+
+def _sorted_doc_lengths(DL):
+    doc_ids = np.array(sorted(DL.keys()), dtype=np.int64)
+    if hasattr(DL, 'lookup'):
+        return doc_ids, DL.lookup(doc_ids)
+    return doc_ids, np.array([DL[doc_id] for doc_id in doc_ids.tolist()], dtype=np.float64)
+
+
+def _find_docs(sorted_doc_ids, doc_ids):
+    """ Positions of `doc_ids` in `sorted_doc_ids`, and the mask of the doc ids
+        found there. Postings of other doc ids (e.g. the padding doc id 0) have
+        no document length.
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    positions = np.searchsorted(sorted_doc_ids, doc_ids)
+    found = positions < len(sorted_doc_ids)
+    found[found] = sorted_doc_ids[positions[found]] == doc_ids[found]
+    return positions, found
+
+
+class DocNorms:
+    """ Accumulates, one posting list at a time, the norm of the full tfidf 
+        vector of every document of an index. Weights are tf / DL * idf with 
+        the idf of Helper.get_idf, like at query time. Postings of doc ids
+        that are not in DL are skipped.
+    """
+    def __init__(self, DL):
+        self.doc_ids, lengths = _sorted_doc_lengths(DL)
+        self.lengths = np.maximum(lengths, 1)
+        self.squared = np.zeros(len(self.doc_ids))
+
+    def add(self, doc_ids, tfs, df):
+        idf = math.log(len(self.doc_ids) / (df + .0000001), 10)
+        positions, found = _find_docs(self.doc_ids, doc_ids)
+        positions = positions[found]
+        weights = np.asarray(tfs)[found] / self.lengths[positions] * idf
+        # doc ids are unique within a posting list
+        self.squared[positions] += weights * weights
+
+    def norms(self):
+        return DocColumn(self.doc_ids, np.sqrt(self.squared))
+
+
+class ImpactQuantizer:
+    """ Quantizes the BM25 score of every posting to an integer impact of 
+        `bits` bits, stored in place of the tf. The scale maps the largest
+        possible BM25 term score, idf(df=1) * (k1 + 1), to the largest impact,
+        so the sum of the impacts of a document ranks like its BM25 score.
+        16 bits fill the tf field of a posting; fewer bits give smaller 
+        compressed posting lists but tie the documents of very common terms.
+        Postings of doc ids that are not in DL get the impact 0, they add
+        nothing to a score.
+    """
+    def __init__(self, DL, k1=1.2, b=0.75, bits=16):
+        self.doc_ids, self.lengths = _sorted_doc_lengths(DL)
+        self.n_docs = len(self.doc_ids)
+        self.avgdl = max(float(self.lengths.mean()), 1.0) if self.n_docs else 1.0
+        self.k1, self.b, self.bits = k1, b, bits
+        self.scale = (2 ** bits - 1) / (self.idf(1) * (k1 + 1))
+
+    def idf(self, df):
+        return math.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+
+    def impacts(self, doc_ids, tfs, df):
+        positions, found = _find_docs(self.doc_ids, doc_ids)
+        tfs = np.asarray(tfs, dtype=np.float64)[found]
+        norm = self.k1 * (1 - self.b + self.b * self.lengths[positions[found]] / self.avgdl)
+        scores = self.idf(df) * tfs * (self.k1 + 1) / (tfs + norm)
+        impacts = np.zeros(len(found), dtype=np.uint16)
+        impacts[found] = np.clip(np.rint(scores * self.scale), 1, 2 ** self.bits - 1)
+        return impacts
+
+    def attributes(self):
+        return {'impact_scale': self.scale, 'impact_k1': self.k1, 'impact_b': self.b}
 
 
 class MultiFileWriter:
-    """ Sequential binary writer to multiple files of up to BLOCK_SIZE each. """
-    def __init__(self, base_dir, name, bucket_name):
+    """ Sequential binary writer to multiple files of up to BLOCK_SIZE each. 
+        Finished files are uploaded to `backend` (a storage_backend.StorageBackend),
+        or to the google storage bucket `bucket_name`. Without either they are 
+        only written locally.
+    """
+    def __init__(self, base_dir, name, bucket_name=None, backend=None):
         self._base_dir = Path(base_dir)
         self._name = name
         self._file_gen = (open(self._base_dir / f'{name}_{i:03}.bin', 'wb') 
                           for i in itertools.count())
         self._f = next(self._file_gen)
-        # Connecting to google storage bucket. 
-        self.client = storage.Client()
-        self.bucket = self.client.bucket(bucket_name)
+        if backend is None and bucket_name is not None:
+            # Connecting to google storage bucket. 
+            backend = GCSBackend(bucket_name)
+        self.backend = backend
 
     def write(self, b, folder):
         locs = []
@@ -35,7 +137,7 @@ class MultiFileWriter:
                 self._f = next(self._file_gen)
                 pos, remaining = 0, BLOCK_SIZE
             self._f.write(b[:remaining])
-            locs.append((self._f.name, pos))
+            locs.append((Path(self._f.name).name, pos))
             b = b[remaining:]
         return locs
 
@@ -44,11 +146,12 @@ class MultiFileWriter:
     
     def upload_to_gcp(self, folder):
         '''
-            The function saves the posting files into the right bucket in google storage.
+            The function saves the posting files into the right folder of the storage backend.
         '''
+        if self.backend is None:
+            return
         file_name = self._f.name
-        blob = self.bucket.blob(f"postings_gcp/{folder}/{file_name}")
-        blob.upload_from_filename(file_name)
+        self.backend.upload(file_name, f"postings_gcp/{folder}/{Path(file_name).name}")
         
 
 class MultiFileReader:
@@ -66,7 +169,7 @@ class MultiFileReader:
             n_read = min(n_bytes, BLOCK_SIZE - offset)
             b.append(f.read(n_read))
             n_bytes -= n_read
-            return b''.join(b)
+        return b''.join(b)
             
     def close(self):
         for f in self._open_files.values():
@@ -77,6 +180,80 @@ class MultiFileReader:
         return False
 
 
+class MappedFileReader:
+    """ Long-lived binary reader of multiple files of up to BLOCK_SIZE each.
+        Every file is memory-mapped once and posting lists are served as 
+        memoryview slices of the mapping, so reads do not copy unless a posting
+        list spans more than one file. A single reader can be shared by all the
+        indexes and by concurrent requests.
+    """
+    def __init__(self, folders=()):
+        self._maps = {}
+        self._lock = threading.Lock()
+        # number of posting bytes served, for benchmarks
+        self.bytes_read = 0
+        self._stats_lock = threading.Lock()
+        for folder in folders:
+            self.map_folder(folder)
+
+    def map_folder(self, folder):
+        """ Maps all the posting files of a folder ahead of the first query. """
+        for path in sorted(Path(folder).glob('*.bin')):
+            self._get(str(path))
+
+    def forget_folder(self, folder):
+        """ Drops the mappings of a folder whose files were deleted. Posting 
+            lists still in use keep their mapping alive until they are freed.
+        """
+        prefix = os.path.join(str(folder), '')
+        with self._lock:
+            self._maps = {path: view for path, view in self._maps.items() if not path.startswith(prefix)}
+
+    def _get(self, path):
+        view = self._maps.get(path)
+        if view is None:
+            with self._lock:
+                view = self._maps.get(path)
+                if view is None:
+                    with open(path, 'rb') as f:
+                        if os.fstat(f.fileno()).st_size == 0:
+                            view = memoryview(b'')
+                        else:
+                            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                    self._maps[path] = view
+        return view
+
+    def read(self, locs, n_bytes, folder):
+        b = []
+        for f_name, offset in locs:
+            if n_bytes <= 0:
+                break
+            view = self._get(os.path.join(folder, f_name))
+            n_read = min(n_bytes, BLOCK_SIZE - offset)
+            b.append(view[offset:offset + n_read])
+            n_bytes -= n_read
+        with self._stats_lock:
+            self.bytes_read += sum(len(part) for part in b)
+        if len(b) == 1:
+            return b[0]
+        return b''.join(b)
+
+    def close(self):
+        """ Unmaps all the files. Arrays that still point into a mapping keep 
+            it alive, in which case it is released by the garbage collector.
+        """
+        with self._lock:
+            for view in self._maps.values():
+                obj = view.obj
+                view.release()
+                try:
+                    if isinstance(obj, mmap.mmap):
+                        obj.close()
+                except BufferError:
+                    pass
+            self._maps = {}
+
+
 class InvertedIndex:  
     def __init__(self, docs={}):
         """ Initializes the inverted index and add documents to it (if provided).
@@ -100,6 +277,15 @@ class InvertedIndex:
         # starts. 
         self.posting_locs = defaultdict(list)
         self.DL = defaultdict(int)
+        # stores the maximal normalized tf (tf / document length) per term. It is
+        # an upper bound of the term's normalized tf in any document, used for
+        # dynamic pruning at query time.
+        self.max_normalized_tf = Counter()
+        # posting lists format: 1 is fixed-size (doc_id, tf) records, 2 is the 
+        # block compressed format of compressed_postings, whose byte length per
+        # term is kept in posting_sizes.
+        self.posting_format = 1
+        self.posting_sizes = Counter()
         for doc_id, tokens in docs.items():
             self.add_doc(doc_id, tokens)
 
@@ -113,6 +299,21 @@ class InvertedIndex:
         for w, cnt in w2cnt.items():
             self.df[w] = self.df.get(w, 0) + 1
             self._posting_list[w].append((doc_id, cnt))
+            self.max_normalized_tf[w] = max(self.max_normalized_tf[w], cnt / len(tokens))
+
+    def compute_upper_bounds(self, folder):
+        """ Computes `max_normalized_tf` for an index that was built without it,
+            by scanning all of its posting lists once. Requires `DL`.
+        """
+        self.max_normalized_tf = Counter()
+        for w, doc_ids, tfs in self.posting_lists_iter_arrays(folder, list(self.df.keys())):
+            mask = doc_ids != 0
+            doc_ids, tfs = doc_ids[mask], tfs[mask]
+            if len(doc_ids) == 0:
+                continue
+            dl = np.fromiter((self.DL.get(doc_id, 0) for doc_id in doc_ids.tolist()),
+                             dtype=np.float64, count=len(doc_ids))
+            self.max_normalized_tf[w] = float(np.max(tfs / np.maximum(dl, 1)))
 
     def write_index(self, base_dir, name):
         """ Write the in-memory index to disk. Results in the file: 
@@ -129,29 +330,170 @@ class InvertedIndex:
             from the object's state dictionary. 
         """
         state = self.__dict__.copy()
-        del state['_posting_list']
+        state.pop('_posting_list', None)
         return state
 
-    def posting_lists_iter(self, folder, query_tokens):
+    def posting_lists_iter(self, folder, query_tokens, reader=None):
         """ A generator that reads one posting list from disk and yields 
             a (word:str, [(doc_id:int, tf:int), ...]) tuple.
         """
-        with closing(MultiFileReader()) as reader:
-            for w in query_tokens:
-                locs = self.posting_locs[w]
-                b = reader.read(locs, self.df[w] * TUPLE_SIZE, folder)
-                posting_list = []
-                for i in range(self.df[w]):
-                    doc_id = int.from_bytes(b[i*TUPLE_SIZE:i*TUPLE_SIZE+4], 'big')
-                    tf = int.from_bytes(b[i*TUPLE_SIZE+4:(i+1)*TUPLE_SIZE], 'big')
-                    posting_list.append((doc_id, tf))
-                yield w, posting_list
+        for w, doc_ids, tfs in self.posting_lists_iter_arrays(folder, query_tokens, reader):
+            yield w, list(zip(doc_ids.tolist(), tfs.tolist()))
+
+    def posting_lists_iter_arrays(self, folder, query_tokens, reader=None):
+        """ A generator that reads one posting list from disk and yields 
+            a (word:str, doc_ids:np.ndarray, tfs:np.ndarray) tuple. When a
+            long-lived `reader` (e.g. a MappedFileReader) is given it is used
+            and left open, otherwise a MultiFileReader is opened for the call.
+        """
+        if reader is None:
+            with closing(MultiFileReader()) as reader:
+                yield from self.posting_lists_iter_arrays(folder, query_tokens, reader)
+            return
+        posting_format = getattr(self, 'posting_format', 1)
+        if posting_format == bitmap_postings.FORMAT_VERSION:
+            # bitmaps keep no tfs, every doc counts once
+            for w, bitmap in self.posting_bitmaps_iter(folder, query_tokens, reader):
+                with metrics.stage('decode'):
+                    doc_ids = bitmap.doc_ids()
+                yield w, doc_ids, np.ones(len(doc_ids), dtype=np.uint64)
+            return
+        compressed = posting_format == compressed_postings.FORMAT_VERSION
+        for w in query_tokens:
+            locs = self.posting_locs[w]
+            with metrics.stage('read'):
+                b = reader.read(locs, self.posting_sizes[w] if compressed else self.df[w] * TUPLE_SIZE, folder)
+            with metrics.stage('decode'):
+                if compressed:
+                    doc_ids, tfs = compressed_postings.decode_posting_list(b)
+                else:
+                    doc_ids, tfs = decode_posting_list(b, self.df[w])
+            yield w, doc_ids, tfs
+
+    def posting_bitmaps_iter(self, folder, query_tokens, reader):
+        """ A generator that reads the posting lists of an index converted by
+            convert_bitmaps and yields (word:str, bitmap_postings.Bitmap) 
+            tuples, views over the bytes read.
+        """
+        for w in query_tokens:
+            with metrics.stage('read'):
+                b = reader.read(self.posting_locs[w], self.posting_sizes[w], folder)
+            yield w, bitmap_postings.Bitmap(b)
+
+    def compute_doc_norms(self, folder):
+        """ Computes `doc_norms`, the norm of the full tfidf vector of every 
+            document, for an index that was built without it, by scanning all
+            of its posting lists once. Requires `DL`.
+        """
+        doc_norms = DocNorms(self.DL)
+        for w, doc_ids, tfs in self.posting_lists_iter_arrays(folder, list(self.df.keys())):
+            doc_norms.add(doc_ids, tfs, self.df[w])
+        self.doc_norms = doc_norms.norms()
+
+    def convert_impacts(self, folder, dst_folder, name, k1=1.2, b=0.75, bits=16):
+        """ Writes a BM25 impact index of this index into `dst_folder`, as 
+            `name`_XXX.bin files: the same posting lists with the quantized 
+            BM25 score of each posting in place of its tf. See ImpactQuantizer.
+        Returns:
+        --------
+          the impact InvertedIndex, whose `impact_scale` converts summed 
+          impacts back to BM25 scores.
+        """
+        quantizer = ImpactQuantizer(self.DL, k1, b, bits)
+        impact_index = copy.copy(self)
+        impact_index.posting_locs = defaultdict(list)
+        impact_index.posting_sizes = Counter()
+        impact_index.posting_format = 1
+        with closing(MultiFileWriter(dst_folder, name)) as writer:
+            for w, doc_ids, tfs in self.posting_lists_iter_arrays(folder, list(self.df.keys())):
+                records = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+                records['doc_id'] = doc_ids
+                records['tf'] = quantizer.impacts(doc_ids, tfs, self.df[w])
+                impact_index.posting_locs[w].extend(writer.write(records.tobytes(), dst_folder))
+        for attribute, value in quantizer.attributes().items():
+            setattr(impact_index, attribute, value)
+        return impact_index
+
+    def convert_postings(self, folder, dst_folder, name):
+        """ Rewrites the posting files of this index in the compressed format
+            into `dst_folder`, as `name`_XXX.bin files. Posting lists are 
+            converted one at a time.
+
+            The compressed format is opt-in: it is about half the bytes on
+            disk and in the page cache, but whole posting lists decode slower
+            than the fixed-size records, which are read as zero-copy views.
+            Indexes are served in the fixed-size format unless converted.
+        Returns:
+        --------
+          a new InvertedIndex with the same term statistics that reads the 
+          converted posting files.
+        """
+        converted = copy.copy(self)
+        converted.posting_locs = defaultdict(list)
+        converted.posting_sizes = Counter()
+        converted.posting_format = compressed_postings.FORMAT_VERSION
+        with closing(MultiFileWriter(dst_folder, name)) as writer:
+            for w, doc_ids, tfs in self.posting_lists_iter_arrays(folder, list(self.df.keys())):
+                b = compressed_postings.encode_posting_list(doc_ids, tfs)
+                converted.posting_locs[w].extend(writer.write(b, dst_folder))
+                converted.posting_sizes[w] = len(b)
+        return converted
+
+    def convert_bitmaps(self, folder, dst_folder, name):
+        """ Rewrites the posting files of this index as compressed bitmaps of
+            their doc ids into `dst_folder`, as `name`_XXX.bin files, for the
+            binary retrieval of the title and anchor indexes. Tfs are dropped,
+            see bitmap_postings.py.
+        Returns:
+        --------
+          a new InvertedIndex with the same term statistics that reads the 
+          bitmap posting files.
+        """
+        converted = copy.copy(self)
+        converted.posting_locs = defaultdict(list)
+        converted.posting_sizes = Counter()
+        converted.posting_format = bitmap_postings.FORMAT_VERSION
+        with closing(MultiFileWriter(dst_folder, name)) as writer:
+            for w, doc_ids, tfs in self.posting_lists_iter_arrays(folder, list(self.df.keys())):
+                b = bitmap_postings.encode_bitmap(doc_ids)
+                converted.posting_locs[w].extend(writer.write(b, dst_folder))
+                converted.posting_sizes[w] = len(b)
+        return converted
 
     @staticmethod
     def read_index(base_dir, name):
         with open(Path(base_dir) / f'{name}.pkl', 'rb') as f:
             return pickle.load(f)
 
+    def write_lexicon(self, base_dir, name):
+        """ Write the global term stats and posting locations as a memory-mapped
+            lexicon. Results in the directory `name`_lexicon.
+        """
+        Lexicon.write(self, Path(base_dir) / f'{name}_lexicon')
+
+    @staticmethod
+    def read_lexicon(base_dir, name):
+        """ Opens an index written by write_lexicon. The term stats, posting 
+            locations and DL are read-only views over the memory-mapped arrays.
+        """
+        lexicon = Lexicon(Path(base_dir) / f'{name}_lexicon')
+        index = InvertedIndex.__new__(InvertedIndex)
+        index.lexicon = lexicon
+        index.df = TermColumn(lexicon, lexicon.columns['df'])
+        index.term_total = TermColumn(lexicon, lexicon.columns['term_total'])
+        index.posting_locs = PostingLocs(lexicon)
+        index.DL = DocColumn(lexicon._load('dl_ids'), lexicon._load('dl'))
+        index.max_normalized_tf = TermColumn(lexicon, lexicon.columns['max_normalized_tf'], 1.0) \
+            if 'max_normalized_tf' in lexicon.columns else {}
+        index.posting_format = lexicon.meta['posting_format']
+        if 'doc_norm' in lexicon.meta.get('doc_columns', []):
+            index.doc_norms = DocColumn(lexicon._load('dl_ids'), lexicon._load('doc_norm'))
+        for attribute, value in lexicon.meta.get('attributes', {}).items():
+            setattr(index, attribute, value)
+        index.posting_sizes = TermColumn(lexicon, lexicon.columns['posting_sizes']) \
+            if 'posting_sizes' in lexicon.columns else Counter()
+        return index
+
     @staticmethod
     def delete_index(base_dir, name):
         path_globals = Path(base_dir) / f'{name}.pkl'
@@ -160,11 +502,13 @@ class InvertedIndex:
             p.unlink()
 
     @staticmethod
-    def write_a_posting_list(b_w_pl, bucket_name, folder):
+    def write_a_posting_list(b_w_pl, bucket_name, folder, backend=None):
         posting_locs = defaultdict(list)
         bucket_id, list_w_pl = b_w_pl
+        if backend is None:
+            backend = GCSBackend(bucket_name)
         
-        with closing(MultiFileWriter(".", bucket_id, bucket_name)) as writer:
+        with closing(MultiFileWriter(".", bucket_id, backend=backend)) as writer:
             for w, pl in list_w_pl: 
                 # convert to bytes
                 b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
@@ -174,16 +518,13 @@ class InvertedIndex:
                 # save file locations to index
                 posting_locs[w].extend(locs)
             writer.upload_to_gcp(folder) 
-            InvertedIndex._upload_posting_locs(bucket_id, posting_locs, bucket_name, folder)
+            InvertedIndex._upload_posting_locs(bucket_id, posting_locs, backend, folder)
         return bucket_id
 
     @staticmethod
-    def _upload_posting_locs(bucket_id, posting_locs, bucket_name, folder):
+    def _upload_posting_locs(bucket_id, posting_locs, backend, folder):
         with open(f"{bucket_id}_posting_locs.pickle", "wb") as f:
             pickle.dump(posting_locs, f)
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        blob_posting_locs = bucket.blob(f"postings_gcp/{folder}/{bucket_id}_posting_locs.pickle")
-        blob_posting_locs.upload_from_filename(f"{bucket_id}_posting_locs.pickle")
+        backend.upload(f"{bucket_id}_posting_locs.pickle", f"postings_gcp/{folder}/{bucket_id}_posting_locs.pickle")
     
 
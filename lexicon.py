@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import mmap
+import pickle
+import numpy as np
+from pathlib import Path
+from collections.abc import Mapping
+
+LEXICON_VERSION = 1
+# scalar attributes of an index kept in meta.json, e.g. the scale of an impact index
+IMPACT_ATTRIBUTES = ('impact_scale', 'impact_k1', 'impact_b')
+
+
+class Lexicon:
+    """ Read-only, memory-mapped term dictionary of an inverted index.
+
+        Terms are stored UTF-8 encoded and sorted in a single string heap,
+        with an offsets array delimiting them; a term's position in that order
+        is its term id. Term statistics and posting locations are arrays indexed
+        by term id, so opening a lexicon maps files instead of unpickling
+        millions of objects, and a lookup is a binary search over the heap.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / 'meta.json') as f:
+            self.meta = json.load(f)
+        self._heap = b''
+        if os.path.getsize(self.path / 'terms.bin') > 0:
+            with open(self.path / 'terms.bin', 'rb') as f:
+                self._heap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = self._load('term_offsets')
+        self.files = self.meta['files']
+        self.columns = {name: self._load(name) for name in self.meta['columns']}
+        self._loc_start = self._load('loc_start')
+        self._loc_file = self._load('loc_file')
+        self._loc_offset = self._load('loc_offset')
+
+    def _load(self, name):
+        return np.load(self.path / f'{name}.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def term(self, term_id):
+        return self._heap[int(self._offsets[term_id]):int(self._offsets[term_id + 1])].decode('utf-8')
+
+    def term_id(self, term):
+        """ Returns the id of `term`, or -1 if it is not in the lexicon. """
+        key = term.encode('utf-8')
+        heap, offsets = self._heap, self._offsets
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if heap[int(offsets[mid]):int(offsets[mid + 1])] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and heap[int(offsets[lo]):int(offsets[lo + 1])] == key:
+            return lo
+        return -1
+
+    def posting_locs(self, term_id):
+        start, end = int(self._loc_start[term_id]), int(self._loc_start[term_id + 1])
+        return [(self.files[int(self._loc_file[i])], int(self._loc_offset[i])) for i in range(start, end)]
+
+    @staticmethod
+    def write(inverted_index, path):
+        """ Writes the term statistics and posting locations of an InvertedIndex
+            as a lexicon directory at `path`.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        encoded = sorted(term.encode('utf-8') for term in inverted_index.df.keys())
+        terms = [term.decode('utf-8') for term in encoded]
+        with open(path / 'terms.bin', 'wb') as f:
+            f.write(b''.join(encoded))
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        np.cumsum([len(term) for term in encoded], out=offsets[1:])
+        np.save(path / 'term_offsets.npy', offsets)
+
+        columns = {'df': (inverted_index.df, np.uint32, 0),
+                   'term_total': (inverted_index.term_total, np.uint64, 0)}
+        # tf / DL never exceeds 1, which is the bound of indexes built without max_normalized_tf
+        if getattr(inverted_index, 'max_normalized_tf', None):
+            columns['max_normalized_tf'] = (inverted_index.max_normalized_tf, np.float64, 1.0)
+        if getattr(inverted_index, 'posting_sizes', None):
+            columns['posting_sizes'] = (inverted_index.posting_sizes, np.uint64, 0)
+        for name, (values, dtype, default) in columns.items():
+            np.save(path / f'{name}.npy', np.array([values.get(term, default) for term in terms], dtype=dtype))
+
+        files, file_ids = [], {}
+        loc_start = np.zeros(len(terms) + 1, dtype=np.int64)
+        loc_file, loc_offset = [], []
+        for i, term in enumerate(terms):
+            locs = inverted_index.posting_locs.get(term, [])
+            for f_name, offset in locs:
+                if f_name not in file_ids:
+                    file_ids[f_name] = len(files)
+                    files.append(f_name)
+                loc_file.append(file_ids[f_name])
+                loc_offset.append(offset)
+            loc_start[i + 1] = loc_start[i] + len(locs)
+        np.save(path / 'loc_start.npy', loc_start)
+        np.save(path / 'loc_file.npy', np.array(loc_file, dtype=np.uint32))
+        np.save(path / 'loc_offset.npy', np.array(loc_offset, dtype=np.uint32))
+
+        doc_ids = np.array(sorted(inverted_index.DL.keys()), dtype=np.int64)
+        np.save(path / 'dl_ids.npy', doc_ids)
+        np.save(path / 'dl.npy', np.array([inverted_index.DL[doc_id] for doc_id in doc_ids.tolist()],
+                                          dtype=np.uint32))
+        doc_columns = []
+        doc_norms = getattr(inverted_index, 'doc_norms', None)
+        if doc_norms:
+            norms = doc_norms.lookup(doc_ids) if hasattr(doc_norms, 'lookup') else \
+                np.array([doc_norms.get(doc_id, 0.0) for doc_id in doc_ids.tolist()], dtype=np.float64)
+            np.save(path / 'doc_norm.npy', norms)
+            doc_columns.append('doc_norm')
+
+        meta = {'version': LEXICON_VERSION,
+                'posting_format': getattr(inverted_index, 'posting_format', 1),
+                'files': files,
+                'columns': list(columns.keys()),
+                'doc_columns': doc_columns,
+                'attributes': {name: getattr(inverted_index, name) for name in IMPACT_ATTRIBUTES
+                               if hasattr(inverted_index, name)}}
+        with open(path / 'meta.json', 'w') as f:
+            json.dump(meta, f)
+
+
+class TermColumn(Mapping):
+    """ dict-like view of one term statistic of a Lexicon. Like a Counter,
+        missing terms read as `default` instead of raising KeyError.
+    """
+    def __init__(self, lexicon, values, default=0):
+        self._lexicon = lexicon
+        self._values = values
+        self._default = default
+
+    def __getitem__(self, term):
+        term_id = self._lexicon.term_id(term)
+        if term_id < 0:
+            return self._default
+        return self._values[term_id].item()
+
+    def get(self, term, default=None):
+        term_id = self._lexicon.term_id(term)
+        if term_id < 0:
+            return default
+        return self._values[term_id].item()
+
+    def __contains__(self, term):
+        return self._lexicon.term_id(term) >= 0
+
+    def __iter__(self):
+        return (self._lexicon.term(i) for i in range(len(self._lexicon)))
+
+    def __len__(self):
+        return len(self._lexicon)
+
+
+class PostingLocs(TermColumn):
+    """ dict-like view of the posting locations of a Lexicon. """
+    def __init__(self, lexicon):
+        super().__init__(lexicon, None, [])
+
+    def __getitem__(self, term):
+        term_id = self._lexicon.term_id(term)
+        if term_id < 0:
+            return []
+        return self._lexicon.posting_locs(term_id)
+
+    def get(self, term, default=None):
+        term_id = self._lexicon.term_id(term)
+        if term_id < 0:
+            return default
+        return self._lexicon.posting_locs(term_id)
+
+
+def convert_index_pickle(pickle_path, name=None):
+    """ One-shot converter of an `index_*.pkl` file to a lexicon directory,
+        written next to it as `name`_lexicon.
+    """
+    pickle_path = Path(pickle_path)
+    name = name or pickle_path.stem
+    with open(pickle_path, 'rb') as f:
+        inverted_index = pickle.load(f)
+    Lexicon.write(inverted_index, pickle_path.parent / f'{name}_lexicon')
+
+
+if __name__ == '__main__':
+    # usage: python lexicon.py /home/igalfernand/postings_gcp/text/index_text.pkl [...]
+    for pickle_path in sys.argv[1:]:
+        convert_index_pickle(pickle_path)
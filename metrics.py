@@ -0,0 +1,175 @@
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# latency buckets in seconds, from 100us to 10s
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+REGISTRY = []
+slow_query_log = logging.getLogger('slow_queries')
+
+
+class Counter:
+    """ A monotonic counter with labels, rendered in the Prometheus text format. """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _labels(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{self._labels(labels)} {value}'
+
+
+class Histogram(Counter):
+    """ A histogram of observations with cumulative buckets, their sum and
+        count per label values, rendered in the Prometheus text format.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{self._labels(labels)} {counts[-1]}'
+            yield f'{self.name}_count{self._labels(labels)} {cumulative}'
+
+
+REQUEST_SECONDS = Histogram('search_request_seconds', 'Request latency.', ('endpoint',))
+STAGE_SECONDS = Histogram('search_stage_seconds', 'Time spent in each stage of a request.', ('endpoint', 'stage'))
+POSTINGS_READ = Counter('search_postings_read_total', 'Postings read from the posting files.', ('endpoint', 'index'))
+BYTES_READ = Counter('search_bytes_read_total', 'Bytes read from the posting files.', ('endpoint', 'index'))
+SLOW_QUERIES = Counter('search_slow_queries_total', 'Requests over the slow query threshold.', ('endpoint',))
+
+
+class RequestTimings:
+    """ Per-stage time breakdown of one request. Stages that run in several
+        threads at once add up.
+    """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+_request = contextvars.ContextVar('request_timings', default=None)
+
+
+def start_request(endpoint):
+    """ Starts timing a request of `endpoint` in the current context.
+    Returns:
+    --------
+      a token for end_request.
+    """
+    return _request.set(RequestTimings(endpoint))
+
+
+def end_request(token, slow_query_seconds=None, details=None):
+    """ Records the latency of the request started with `token`, and logs its
+        stage breakdown to slow_query_log when it took more than
+        `slow_query_seconds`.
+    """
+    timings = _request.get()
+    _request.reset(token)
+    if timings is None:
+        return None
+    seconds = time.perf_counter() - timings.start
+    REQUEST_SECONDS.observe(seconds, (timings.endpoint,))
+    if slow_query_seconds is not None and seconds > slow_query_seconds:
+        SLOW_QUERIES.inc(1, (timings.endpoint,))
+        slow_query_log.warning(json.dumps(dict(endpoint=timings.endpoint, total_ms=round(seconds * 1000, 3),
+                                               stages_ms={stage: round(value * 1000, 3)
+                                                          for stage, value in timings.stages.items()},
+                                               **(details or {}))))
+    return seconds
+
+
+def current_endpoint():
+    timings = _request.get()
+    return timings.endpoint if timings is not None else ''
+
+
+def record_stage(name, seconds):
+    timings = _request.get()
+    STAGE_SECONDS.observe(seconds, (timings.endpoint if timings is not None else '', name))
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    """ Times the enclosed block as stage `name` of the current request. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def count_postings(index, n_postings, n_bytes):
+    labels = (current_endpoint(), index)
+    POSTINGS_READ.inc(n_postings, labels)
+    BYTES_READ.inc(n_bytes, labels)
+
+
+def propagate(fn):
+    """ Wraps `fn` to run in a copy of the caller's context, so that stages
+        timed in a thread pool are attributed to the caller's request.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def render():
+    """ All the metrics in the Prometheus text exposition format. """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,298 @@
+import os
+import bz2
+import sys
+import gzip
+import shutil
+import logging
+import tempfile
+import itertools
+import numpy as np
+from pathlib import Path
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+import consts
+from helper import Helper
+from doc_store import DocStore
+from index_builder import iter_links
+
+log = logging.getLogger('pagerank_pipeline')
+# links buffered in memory before they are written to a run file
+CHUNK_EDGES = 10 ** 7
+# edges gathered per block of rows of a power iteration step, which bounds the memory of each thread
+BLOCK_EDGES = 1 << 22
+# page view records parsed before they are summed
+CHUNK_VIEWS = 10 ** 7
+DAMPING = 0.85
+
+
+def iter_edges(path):
+    """ (source id, target id) pairs of the link graph of a corpus: each
+        document linked to by a document once, without self links.
+    """
+    source, targets = None, set()
+    for source_id, target_id, anchor in iter_links(path):
+        if source_id != source:
+            source, targets = source_id, set()
+        if target_id != source_id and target_id not in targets:
+            targets.add(target_id)
+            yield source_id, target_id
+
+
+def write_edge_runs(edges, tmp_dir, chunk_edges=CHUNK_EDGES):
+    """ Writes (source, target) pairs to `tmp_dir` as .npy runs of at most
+        `chunk_edges` edges, so only one run is in memory at once.
+    Returns:
+    --------
+      the paths of the runs.
+    """
+    edges = iter(edges)
+    run_paths = []
+    while True:
+        run = np.fromiter(itertools.chain.from_iterable(itertools.islice(edges, chunk_edges)), dtype=np.int64)
+        if len(run) == 0:
+            return run_paths
+        run_paths.append(Path(tmp_dir) / f'edges_{len(run_paths)}.npy')
+        np.save(run_paths[-1], run.reshape(-1, 2))
+
+
+class LinkGraph:
+    """ The link graph as the CSR matrix of its transpose: the wiki ids of the
+        nodes are sorted in `nodes`, and row i of `indices`, from indptr[i] to
+        indptr[i + 1], holds the node numbers of the documents linking to node
+        i, so that a power iteration step pulls the ranks of the in-links of a
+        block of rows. A graph written to disk is opened with mmap.
+    """
+    def __init__(self, nodes, indptr, indices, out_degree):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+        self.out_degree = out_degree
+
+    @staticmethod
+    def open(path):
+        path = Path(path)
+        return LinkGraph(*[np.load(path / f'{name}.npy', mmap_mode='r')
+                           for name in ('nodes', 'indptr', 'indices', 'out_degree')])
+
+    @staticmethod
+    def build(run_paths, path):
+        """ Builds the graph of edge runs (see write_edge_runs) at `path`, in
+            three passes over the runs: collecting the nodes, rewriting the
+            runs with node numbers while counting the degrees, then scattering
+            the sources of every run into `indices`, which is written through
+            a memory-mapped file.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        # wiki ids are dense enough for a presence array, which is cheaper than sorting the runs
+        present = np.zeros(0, dtype=bool)
+        for run_path in run_paths:
+            edges = np.load(run_path)
+            if len(edges) and edges.max() >= len(present):
+                present = np.concatenate([present, np.zeros(int(edges.max()) + 1 - len(present), dtype=bool)])
+            present[edges.ravel()] = True
+        nodes = np.flatnonzero(present).astype(np.int64)
+        del present
+        n = len(nodes)
+        in_degree = np.zeros(n, dtype=np.int64)
+        out_degree = np.zeros(n, dtype=np.int64)
+        for run_path in run_paths:
+            edges = np.searchsorted(nodes, np.load(run_path)).astype(np.int32)
+            out_degree += np.bincount(edges[:, 0], minlength=n)
+            in_degree += np.bincount(edges[:, 1], minlength=n)
+            np.save(run_path, edges)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(in_degree, out=indptr[1:])
+        indices = np.lib.format.open_memmap(path / 'indices.npy', mode='w+', dtype=np.int32, shape=(int(indptr[-1]),))
+        fill = indptr[:-1].copy()
+        for run_path in run_paths:
+            edges = np.load(run_path)
+            edges = edges[np.argsort(edges[:, 1], kind='stable')]
+            counts = np.bincount(edges[:, 1], minlength=n)
+            # position of each edge among the edges of the run to the same target
+            rank = np.arange(len(edges)) - (np.cumsum(counts) - counts)[edges[:, 1]]
+            indices[fill[edges[:, 1]] + rank] = edges[:, 0]
+            fill += counts
+        indices.flush()
+        del indices
+        np.save(path / 'nodes.npy', nodes)
+        np.save(path / 'indptr.npy', indptr)
+        np.save(path / 'out_degree.npy', out_degree)
+        return LinkGraph.open(path)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _blocks(self, block_edges):
+        """ Row boundaries of blocks of about `block_edges` edges. """
+        cuts = np.searchsorted(self.indptr, np.arange(block_edges, int(self.indptr[-1]), block_edges))
+        return np.unique(np.concatenate(([0], cuts, [len(self)]))).tolist()
+
+    def _pull(self, contributions, out, start, end):
+        """ Sums the contributions of the in-links of rows start to end into
+            `out`.
+        """
+        lo, hi = int(self.indptr[start]), int(self.indptr[end])
+        out[start:end] = 0
+        if hi == lo:
+            return
+        offsets = np.asarray(self.indptr[start:end + 1]) - lo
+        nonempty = np.diff(offsets) > 0
+        gathered = contributions[np.asarray(self.indices[lo:hi])]
+        out[start:end][nonempty] = np.add.reduceat(gathered, offsets[:-1][nonempty])
+
+    def pagerank(self, damping=DAMPING, tol=1e-6, max_iter=100, threads=None, block_edges=BLOCK_EDGES):
+        """ PageRank by power iteration, the rank of dangling nodes being spread
+            over all nodes. Each step pulls the blocks of rows on `threads`
+            threads (one per core by default), and stops once the L1 norm of
+            the change of the ranks is below `tol`, logging it every step.
+        Returns:
+        --------
+          the ranks of the nodes, scaled to a mean of 1 like GraphFrames
+          PageRank, and the L1 change of every step.
+        """
+        n = len(self)
+        if n == 0:
+            return np.empty(0), []
+        out_degree = np.asarray(self.out_degree)
+        dangling = out_degree == 0
+        inverse_degree = np.where(dangling, 0.0, 1.0 / np.maximum(out_degree, 1))
+        bounds = self._blocks(block_edges)
+        ranks = np.full(n, 1.0 / n)
+        pulled = np.empty(n)
+        residuals = []
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+            for step in range(max_iter):
+                contributions = ranks * inverse_degree
+                list(executor.map(lambda block: self._pull(contributions, pulled, *block), zip(bounds, bounds[1:])))
+                updated = damping * pulled + (damping * ranks[dangling].sum() + 1 - damping) / n
+                residuals.append(float(np.abs(updated - ranks).sum()))
+                ranks = updated
+                log.info('step %d: L1 change %.3g', step + 1, residuals[-1])
+                if residuals[-1] < tol:
+                    break
+            else:
+                log.warning('PageRank did not converge in %d steps, L1 change %.3g', max_iter, residuals[-1])
+        return ranks * n, residuals
+
+
+def _open_dump(path):
+    path = str(path)
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _sum_views(ids, views):
+    """ Sorted unique ids and the sum of their views. """
+    order = np.argsort(ids, kind='stable')
+    ids, views = ids[order], views[order]
+    starts = np.flatnonzero(np.diff(ids, prepend=ids[:1] - 1))
+    return ids[starts], np.add.reduceat(views, starts) if len(ids) else views
+
+
+def _aggregate_dump(args):
+    """ Worker: the page views of one dump file, see aggregate_pageviews. """
+    path, domain, chunk_views = args
+    domain = domain.encode('utf-8')
+    ids, views = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    with _open_dump(path) as f:
+        while True:
+            chunk = []
+            for line in itertools.islice(f, chunk_views):
+                fields = line.split(b' ', 5)
+                if len(fields) > 4 and fields[0] == domain and fields[2].isdigit() and fields[4].isdigit():
+                    chunk.append((int(fields[2]), int(fields[4])))
+            if not chunk:
+                return ids, views
+            chunk = np.array(chunk, dtype=np.int64)
+            ids, views = _sum_views(np.concatenate([ids, chunk[:, 0]]), np.concatenate([views, chunk[:, 1]]))
+
+
+def aggregate_pageviews(paths, domain='en.wikipedia', processes=None, chunk_views=CHUNK_VIEWS):
+    """ Sums the page views of pageview_complete dump files (plain, gzip or
+        bz2), e.g. pageviews-202108-user.bz2, whose lines are
+        `domain title page_id access views hourly_views`. Files are read by a
+        pool of `processes` workers, each streaming `chunk_views` lines at a
+        time, and only the views of `domain` with a page id are counted.
+    Returns:
+    --------
+      the sorted page ids and their views.
+    """
+    ids, views = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    with Pool(min(processes or os.cpu_count(), max(len(paths), 1))) as pool:
+        for file_ids, file_views in pool.imap_unordered(_aggregate_dump, [(path, domain, chunk_views) for path in paths]):
+            ids, views = _sum_views(np.concatenate([ids, file_ids]), np.concatenate([views, file_views]))
+    return ids, views
+
+
+def write_doc_store(path, node_ids, ranks, view_ids, views, doc_map=None):
+    """ Writes the PageRank and page views of documents as the doc store the
+        server loads, keyed by the internal ids of `doc_map` when the indexes
+        were renumbered (see reorder.py). The store is written aside and then
+        swapped in, so that a running server keeps its mapped files.
+    Returns:
+    --------
+      the DocStore.
+    """
+    path = Path(path)
+    doc_ids = np.union1d(node_ids, view_ids)
+    pagerank = np.zeros(len(doc_ids), dtype=np.float64)
+    pagerank[np.searchsorted(doc_ids, node_ids)] = ranks
+    pageviews = np.zeros(len(doc_ids), dtype=np.int64)
+    pageviews[np.searchsorted(doc_ids, view_ids)] = views
+    if doc_map is not None:
+        doc_ids = doc_map.to_internal(doc_ids)
+        order = np.argsort(doc_ids)
+        doc_ids, pagerank, pageviews = doc_ids[order], pagerank[order], pageviews[order]
+    store = DocStore(doc_ids, {'pagerank': pagerank, 'pageviews': pageviews})
+    new_path = path.with_name(path.name + '_new')
+    store.write(new_path)
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(new_path, path)
+    return store
+
+
+def run(corpus, postings_folder=consts.POSTINGS_FOLDER, pageview_paths=(), tmp_dir=None):
+    """ Recomputes the static scores of a postings_gcp tree: extracts the link
+        graph of `corpus` (see index_builder.py) to other/link_graph, runs
+        PageRank on it, sums the page views of `pageview_paths`, and writes
+        both to other/doc_store. Without page view files, the page views of the
+        current doc store or pickles are kept. The server loads the new scores
+        when restarted.
+    Returns:
+    --------
+      the LinkGraph and the L1 change of every PageRank step.
+    """
+    other = Path(postings_folder) / 'other'
+    helper = Helper(folder=None)
+    doc_map = helper.get_doc_map(other)
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        graph = LinkGraph.build(write_edge_runs(iter_edges(corpus), tmp), other / 'link_graph')
+    log.info('link graph of %d documents and %d links', len(graph), int(graph.indptr[-1]))
+    ranks, residuals = graph.pagerank()
+    if pageview_paths:
+        view_ids, views = aggregate_pageviews(list(pageview_paths))
+    else:
+        docs = helper.get_doc_store(other)
+        view_ids, views = np.asarray(docs.doc_ids, dtype=np.int64), np.asarray(docs.columns['pageviews'])
+        if doc_map is not None:
+            view_ids = doc_map.to_wiki(view_ids)
+            order = np.argsort(view_ids)
+            view_ids, views = view_ids[order], views[order]
+    write_doc_store(other / 'doc_store', np.asarray(graph.nodes), ranks, view_ids, views, doc_map)
+    return graph, residuals
+
+
+if __name__ == '__main__':
+    # usage: python pagerank_pipeline.py corpus.jsonl postings_gcp [pageviews-202108-user.bz2 ...]
+    #        python pagerank_pipeline.py enwiki-latest-pages-articles.xml.bz2 postings_gcp [pageviews ...]
+    # then restart the server, which loads postings_gcp/other/doc_store
+    logging.basicConfig(level=logging.INFO)
+    graph, residuals = run(sys.argv[1], sys.argv[2], sys.argv[3:])
+    print(f'{len(graph)} documents, {int(graph.indptr[-1])} links, '
+          f'PageRank converged to an L1 change of {residuals[-1]:.3g} in {len(residuals)} steps' if residuals
+          else 'no links')
@@ -0,0 +1,244 @@
+import gc
+import os
+import sys
+import mmap
+import heapq
+import signal
+import socket
+import logging
+import threading
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Response
+import consts
+from lexicon import convert_index_pickle
+from doc_store import convert_pickles
+from title_store import convert_pickle
+
+log = logging.getLogger('prefork')
+INDEX_NAMES = (('title', 'index_title'), ('text', 'index_text'), ('text', 'impact_text'), ('anchor', 'index_anchor'))
+
+
+def prepare(postings_folder=consts.POSTINGS_FOLDER):
+    """ Converts what is still pickled in a postings_gcp tree to the memory-
+        mapped formats: index pickles to lexicons, and the PageRank, page views
+        and titles pickles to a doc store and a title store. Pickled data is
+        unpickled into the heap of every process, where reference counting
+        dirties the pages forked workers share; mapped files stay shared.
+    Returns:
+    --------
+      the paths written.
+    """
+    root = Path(postings_folder)
+    written = []
+    for field, name in INDEX_NAMES:
+        pickle_path = root / field / f'{name}.pkl'
+        if pickle_path.exists() and not (root / field / f'{name}_lexicon').is_dir():
+            convert_index_pickle(pickle_path, name)
+            written.append(root / field / f'{name}_lexicon')
+    other = root / 'other'
+    if not (other / 'doc_store').is_dir() and (other / 'pr.pkl').exists():
+        convert_pickles(other / 'pr.pkl', other / 'pageviews-202108-user.pkl', other / 'doc_store')
+        written.append(other / 'doc_store')
+    if not (other / 'title_store').is_dir() and (other / 'doctitles.pkl').exists():
+        convert_pickle(other / 'doctitles.pkl', other / 'title_store')
+        written.append(other / 'title_store')
+    return written
+
+
+def mapped_arrays(frontend):
+    """ The arrays and mappings behind the doc store, title store, doc map,
+        suggest index and the lexicon and document columns of every index of
+        `frontend`.
+    """
+    helper = frontend.helper
+    for store in (getattr(helper, 'DOCS', None), getattr(helper, 'TITLES', None), helper.DOC_MAP):
+        if store is not None:
+            for value in vars(store).values():
+                yield from value.values() if isinstance(value, dict) else [value]
+    if frontend.SUGGEST_INDEX is not None:
+        yield from vars(frontend.SUGGEST_INDEX).values()
+    for inverted_index in (frontend.TITLE_INDEX, frontend.TEXT_INDEX, frontend.ANCHOR_INDEX, frontend.TEXT_IMPACT_INDEX):
+        if inverted_index is None:
+            continue
+        lexicon = getattr(inverted_index, 'lexicon', None)
+        if lexicon is not None:
+            yield lexicon._heap
+            yield lexicon._offsets
+            yield from lexicon.columns.values()
+            yield from (lexicon._loc_start, lexicon._loc_file, lexicon._loc_offset)
+        for column in (inverted_index.DL, getattr(inverted_index, 'doc_norms', None)):
+            if hasattr(column, '_values'):
+                yield column._doc_ids
+                yield column._values
+
+
+def touch_pages(buffer):
+    """ Reads one byte per page of `buffer`, so that its pages are in the page
+        cache and mapped before the first query.
+    Returns:
+    --------
+      the size of the buffer in bytes, 0 for anything that is not one.
+    """
+    if not isinstance(buffer, (np.ndarray, mmap.mmap, memoryview)) or len(buffer) == 0:
+        return 0
+    try:
+        data = np.frombuffer(buffer, dtype=np.uint8)
+    except (ValueError, TypeError):
+        return 0
+    int(data[::mmap.PAGESIZE].sum())
+    return len(data)
+
+
+def advise_pages(mapping):
+    """ Asks the kernel to read the pages of a posting file mapping into the
+        page cache ahead of the first query, by madvise(MADV_WILLNEED) where
+        available and by touching its pages otherwise.
+    Returns:
+    --------
+      the size of the mapping in bytes.
+    """
+    if isinstance(mapping, mmap.mmap) and hasattr(mmap, 'MADV_WILLNEED'):
+        mapping.madvise(mmap.MADV_WILLNEED)
+        return len(mapping)
+    return touch_pages(mapping)
+
+
+def hot_terms(inverted_index, n):
+    """ The `n` terms of the index with the longest posting lists. """
+    lexicon = getattr(inverted_index, 'lexicon', None)
+    if lexicon is not None:
+        df = np.asarray(lexicon.columns['df'])
+        return [lexicon.term(int(term_id)) for term_id in np.argsort(-df, kind='stable')[:n]]
+    return heapq.nlargest(n, inverted_index.df, key=inverted_index.df.get)
+
+
+def warm_up(frontend, n_terms=consts.PREFORK_WARMUP_TERMS):
+    """ Pre-touches the pages of all the mapped arrays of `frontend` and
+        advises the posting file mappings of its reader, then decodes the
+        posting lists of the `n_terms` most frequent terms of each index into
+        native arrays of the posting cache, up to half of its budget so that
+        workers have room for their own queries. Posting lists are read one at
+        a time, so no fetch thread is started before forking.
+    Returns:
+    --------
+      the number of bytes touched or advised and of decoded posting list bytes.
+    """
+    helper = frontend.helper
+    touched = sum(touch_pages(buffer) for buffer in mapped_arrays(frontend))
+    touched += sum(advise_pages(view.obj) for view in list(helper.reader._maps.values()))
+    cache = helper.posting_cache
+    for index_name, (inverted_index, folder) in frontend.INDEXES.items():
+        if inverted_index is None:
+            continue
+        for term in hot_terms(inverted_index, n_terms):
+            if cache.n_bytes >= cache.max_bytes // 2:
+                break
+            helper.cache_postings(inverted_index, folder, [term])
+    return touched, cache.n_bytes
+
+
+def _loading_app(environ, start_response):
+    # answers while the parent loads the indexes, before any worker serves
+    return Response('{"ready": false}', status=503, mimetype='application/json')(environ, start_response)
+
+
+def _after_fork(frontend):
+    """ Runs in a worker right after the fork: thread pools of the parent have
+        no threads in the child, so they are replaced, and objects created from
+        now on are garbage collected as usual.
+    """
+    frontend.helper.executor = ThreadPoolExecutor(max_workers=consts.POSTING_FETCH_THREADS)
+    frontend.field_executor = ThreadPoolExecutor(max_workers=len(frontend.field_scorers))
+    if frontend.shards is not None:
+        frontend.shards.executor = ThreadPoolExecutor(max_workers=4 * len(frontend.shards.addresses))
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+def _spawn(frontend, sock, host, port):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _after_fork(frontend)
+            make_server(host, port, frontend.app, threaded=True, fd=sock.fileno()).serve_forever()
+        finally:
+            os._exit(1)
+    return pid
+
+
+def serve(host='0.0.0.0', port=8080, workers=consts.PREFORK_WORKERS):
+    """ Pre-fork serving: binds the port, loads the indexes once in this
+        process while /ready (and any other request) answers 503, warms them
+        up, freezes the loaded objects out of the garbage collector, then forks
+        `workers` processes (one per core by default) that accept on the same
+        socket. Workers share the memory-mapped files and the pages of the
+        parent copy-on-write, so memory does not grow with their count; run
+        `prepare` first so that nothing is left in pickles.
+
+        Incremental indexing is disabled, as the segments of /index_documents
+        live in the memory of a single process. Caches and /metrics are per
+        worker. A worker that dies is replaced.
+    """
+    workers = workers or os.cpu_count()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    loading = make_server(host, port, _loading_app, fd=sock.fileno())
+    loading_thread = threading.Thread(target=loading.serve_forever, daemon=True)
+    loading_thread.start()
+
+    consts.SEGMENTS_FOLDER = None
+    import search_frontend as frontend
+    for field, name in INDEX_NAMES:
+        if os.path.exists(os.path.join(consts.POSTINGS_FOLDER, field, f'{name}.pkl')) and \
+                not os.path.isdir(os.path.join(consts.POSTINGS_FOLDER, field, f'{name}_lexicon')):
+            log.warning('%s is loaded from a pickle, whose pages are not shared by the workers: '
+                        'run python prefork.py prepare', name)
+    touched, decoded = warm_up(frontend)
+    log.info('warmed up %.1f MB of mapped arrays and posting files and %.1f MB of posting lists',
+             touched / 1024 ** 2, decoded / 1024 ** 2)
+    loading.shutdown()
+    loading_thread.join()
+    loading.server_close()
+    gc.collect()
+    gc.freeze()
+
+    children = {_spawn(frontend, sock, host, port) for _ in range(workers)}
+    log.info('serving on %s:%d with %d workers', host, port, workers)
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            log.warning('worker %d exited with status %d, replacing it', pid, status)
+            children.add(_spawn(frontend, sock, host, port))
+    sock.close()
+
+
+if __name__ == '__main__':
+    # usage: python prefork.py prepare [postings_gcp]
+    #        python prefork.py [workers] [port]
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:2] == ['prepare']:
+        for path in prepare(*sys.argv[2:3]):
+            print(path)
+    else:
+        serve(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8080,
+              workers=int(sys.argv[1]) if len(sys.argv) > 1 else consts.PREFORK_WORKERS)
@@ -0,0 +1,96 @@
+import sys
+from collections import Counter
+from cache import LRUCache
+
+
+class AnalyzedQuery:
+    """ A query string analyzed once: its tokens, in order and with repeats,
+        and the tokens followed by their synonym expansions.
+    """
+    __slots__ = ('text', 'tokens', 'expanded')
+
+    def __init__(self, text, tokens, expanded):
+        self.text = text
+        self.tokens = tokens
+        self.expanded = expanded
+
+
+class BoundQuery:
+    """ Query tokens bound to one index: the distinct terms that the index has,
+        in query order, their query tf and idf. Terms the index does not have
+        are dropped before any posting list is read.
+    """
+    __slots__ = ('tokens', 'terms', 'tf', 'idf')
+
+    def __init__(self, tokens, terms, tf, idf):
+        self.tokens = tokens
+        self.terms = terms
+        self.tf = tf
+        self.idf = idf
+
+    def tfidf_vector(self):
+        """ Same as Helper.generate_query_tfidf_vector. """
+        return {term: self.tf[term] / len(self.tokens) * self.idf[term] for term in self.terms}
+
+
+class QueryAnalyzer:
+    """ Query analysis built once at startup and shared by all the endpoints:
+        tokenization with an LRU cache of analyzed query strings, synonym
+        expansion with a precomputed reverse synonym map, and a per-index cache
+        of the idf of the terms seen in queries (None for terms the index does
+        not have), so the lexicon is searched once per term.
+    """
+    def __init__(self, synonyms_dict, tokenize, idf, cache_size=10000, term_cache_size=100000):
+        # a synonym expands to the first top title word it is the synonym of
+        self.reverse_synonyms = {}
+        for word, synonym in synonyms_dict.items():
+            if synonym:
+                self.reverse_synonyms.setdefault(sys.intern(synonym), sys.intern(word))
+        self.tokenize = tokenize
+        self.idf = idf
+        self.queries = LRUCache(cache_size)
+        self.terms = LRUCache(term_cache_size)
+
+    def analyze(self, text):
+        """ The AnalyzedQuery of a query string, cached. """
+        query = self.queries.get(text)
+        if query is None:
+            tokens = [sys.intern(token) for token in self.tokenize(text)]
+            query = AnalyzedQuery(text, tokens, self.expand(tokens))
+            self.queries.put(text, query)
+        return query
+
+    def expand(self, tokens):
+        """ The tokens followed by the synonym chain of each token: its reverse
+            synonym, the reverse synonym of that, and so on until a term repeats.
+        """
+        expanded = list(tokens)
+        for token in tokens:
+            seen = {token}
+            synonym = self.reverse_synonyms.get(token)
+            while synonym is not None and synonym not in seen:
+                expanded.append(synonym)
+                seen.add(synonym)
+                synonym = self.reverse_synonyms.get(synonym)
+        return expanded
+
+    def bind(self, tokens, inverted_index):
+        """ The BoundQuery of `tokens` in `inverted_index`. The idf of a term
+            is cached per index name (given by Helper.get_index) and generation
+            of a segmented index, it is not cached for an index without a name.
+        """
+        name = getattr(inverted_index, 'name', None)
+        index_key = (name, getattr(inverted_index, 'generation', None))
+        tf = Counter(tokens)
+        terms, idf = [], {}
+        for term in tf:
+            key = index_key + (term,)
+            entry = self.terms.get(key) if name is not None else None
+            if entry is None:
+                entry = (self.idf(inverted_index, term),) if term in inverted_index.df else (None,)
+                if name is not None:
+                    self.terms.put(key, entry)
+            if entry[0] is not None:
+                terms.append(term)
+                idf[term] = entry[0]
+        return BoundQuery(tokens, terms, tf, idf)
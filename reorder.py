@@ -0,0 +1,133 @@
+import sys
+import numpy as np
+from pathlib import Path
+from collections import Counter, defaultdict
+from contextlib import closing
+import compressed_postings
+from helper import Helper
+from lexicon import IMPACT_ATTRIBUTES
+from doc_store import DocStore, DocMap, DocColumn
+from title_store import TitleStore
+from inverted_index_gcp import InvertedIndex, MultiFileWriter, POSTING_DTYPE
+
+# (folder, name) of the indexes renumbered when they exist
+INDEXES = (('title', 'index_title'), ('text', 'index_text'), ('text', 'impact_text'), ('anchor', 'index_anchor'))
+
+
+def _exists(folder, name):
+    return (folder / f'{name}.pkl').exists() or (folder / f'{name}_lexicon').is_dir()
+
+
+def _doc_ids(mapping):
+    return np.fromiter(iter(mapping), dtype=np.int64, count=len(mapping))
+
+
+def _values(mapping, doc_ids):
+    if hasattr(mapping, 'lookup'):
+        return mapping.lookup(doc_ids)
+    return np.array([mapping[doc_id] for doc_id in doc_ids.tolist()], dtype=np.float64)
+
+
+def pagerank_order(doc_store, doc_ids=()):
+    """ The wiki ids of the doc store and `doc_ids` in descending PageRank
+        order, ties by wiki id like the (matches, PageRank) sort of /search.
+        Documents without a PageRank come last.
+    """
+    wiki_ids = np.union1d(np.asarray(doc_store.doc_ids, dtype=np.int64), np.asarray(doc_ids, dtype=np.int64))
+    wiki_ids = wiki_ids[wiki_ids != 0]
+    pagerank = doc_store.lookup('pagerank', wiki_ids)
+    return wiki_ids[np.lexsort((wiki_ids, -pagerank))]
+
+
+def reorder_index(index, folder, dst_folder, name, doc_map):
+    """ Rewrites the posting lists of `index` with internal doc ids, sorted by
+        them, into `dst_folder` as `name`_XXX.bin files, in the posting format
+        of `index`. DL and doc_norms are renumbered, term statistics are kept.
+    Returns:
+    --------
+      the renumbered InvertedIndex and the compressed size of its posting
+      lists before and after the renumbering.
+    """
+    reordered = InvertedIndex()
+    reordered.df = index.df
+    reordered.term_total = index.term_total
+    reordered.max_normalized_tf = getattr(index, 'max_normalized_tf', {})
+    reordered.posting_format = getattr(index, 'posting_format', 1)
+    for attribute in IMPACT_ATTRIBUTES:
+        if hasattr(index, attribute):
+            setattr(reordered, attribute, getattr(index, attribute))
+    wiki_ids = _doc_ids(index.DL)
+    reordered.DL = Counter(dict(zip(doc_map.to_internal(wiki_ids).tolist(), _values(index.DL, wiki_ids).tolist())))
+    if hasattr(index, 'doc_norms'):
+        wiki_ids = _doc_ids(index.doc_norms)
+        doc_ids = doc_map.to_internal(wiki_ids)
+        order = np.argsort(doc_ids)
+        reordered.doc_norms = DocColumn(doc_ids[order], _values(index.doc_norms, wiki_ids)[order])
+    reordered.posting_locs = defaultdict(list)
+    reordered.posting_sizes = Counter()
+    size_before, size_after = 0, 0
+    with closing(MultiFileWriter(dst_folder, name)) as writer:
+        for w, wiki_ids, tfs in index.posting_lists_iter_arrays(folder, list(index.df.keys())):
+            doc_ids = doc_map.to_internal(wiki_ids)
+            order = np.argsort(doc_ids, kind='stable')
+            doc_ids, tfs = doc_ids[order], tfs[order]
+            size_before += len(compressed_postings.encode_posting_list(wiki_ids, tfs[np.argsort(order)]))
+            b = compressed_postings.encode_posting_list(doc_ids, tfs)
+            size_after += len(b)
+            if reordered.posting_format != compressed_postings.FORMAT_VERSION:
+                records = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+                records['doc_id'] = doc_ids
+                records['tf'] = tfs
+                b = records.tobytes()
+            else:
+                reordered.posting_sizes[w] = len(b)
+            reordered.posting_locs[w].extend(writer.write(b, dst_folder))
+    return reordered, size_before, size_after
+
+
+def reorder(src_root, dst_root):
+    """ Renumbers the documents of the postings_gcp tree at `src_root` in
+        descending PageRank order into a new tree at `dst_root`: the posting
+        files and DL of every index, and the doc store and title store of
+        other/, whose title fragments keep the wiki ids so that responses are
+        translated back for free. other/doc_map maps wiki ids to internal ids
+        (see DocMap). Posting lists of documents added later stay in their
+        own segments, so pending segments should be merged into a rebuild
+        first.
+    Returns:
+    --------
+      {index name: (compressed posting bytes before, after)}.
+    """
+    src_root, dst_root = Path(src_root), Path(dst_root)
+    helper = Helper(folder=None)
+    docs = helper.get_doc_store(src_root / 'other')
+    titles = helper.get_title_store(src_root / 'other')
+    indexes = {(field, name): helper.get_index(src_root / field, name)
+               for field, name in INDEXES if _exists(src_root / field, name)}
+    indexed_ids = [_doc_ids(index.DL) for index in indexes.values()]
+    wiki_ids = pagerank_order(docs, np.concatenate([np.asarray(titles.doc_ids, dtype=np.int64)] + indexed_ids))
+    doc_map = DocMap(wiki_ids)
+    other = dst_root / 'other'
+    doc_map.write(other / 'doc_map')
+    internal_ids = np.arange(1, len(wiki_ids) + 1, dtype=np.int64)
+    DocStore(internal_ids, {column: docs.lookup(column, wiki_ids) for column in docs.columns}).write(other / 'doc_store')
+    TitleStore.from_fragments(internal_ids, [titles.fragment(wiki_id) for wiki_id in wiki_ids.tolist()]) \
+        .write(other / 'title_store')
+    sizes = {}
+    for (field, name), index in indexes.items():
+        dst_folder = dst_root / field
+        dst_folder.mkdir(parents=True, exist_ok=True)
+        reordered, size_before, size_after = reorder_index(index, f'{src_root / field}/', dst_folder, name, doc_map)
+        if hasattr(index, 'lexicon'):
+            reordered.write_lexicon(dst_folder, name)
+        else:
+            reordered.write_index(dst_folder, name)
+        sizes[name] = (size_before, size_after)
+    return sizes
+
+
+if __name__ == '__main__':
+    # usage: python reorder.py postings_gcp postings_gcp_reordered
+    # then serve postings_gcp_reordered (POSTINGS_FOLDER)
+    for name, (size_before, size_after) in reorder(*sys.argv[1:3]).items():
+        print(f'{name}: compressed postings {size_before / 1024 ** 2:.1f} MB -> {size_after / 1024 ** 2:.1f} MB')
@@ -1,6 +1,17 @@
-from helper import Helper
-from flask import Flask, request, jsonify
+from helper import Helper, BODY_MODES
+from flask import Flask, Response, request, jsonify, g
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from cache import LRUCache
+from sharding import ShardCoordinator
+from segments import SegmentedIndex
+from suggest import SuggestIndex
+import numpy as np
+import base64
+import os
 import consts
+import logging
+import metrics
 
 class MyFlaskApp(Flask):
     def run(self, host=None, port=None, debug=None, **options):
@@ -11,9 +22,309 @@ app = MyFlaskApp(__name__)
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 # helper
 helper = Helper()
-TITLE_INDEX = helper.get_pickle('/home/igalfernand/postings_gcp/title/index_title.pkl')
-TEXT_INDEX = helper.get_pickle('/home/igalfernand/postings_gcp/text/index_text.pkl')
-ANCHOR_INDEX = helper.get_pickle('/home/igalfernand/postings_gcp/anchor/index_anchor.pkl')
+TITLE_FOLDER = os.path.join(consts.POSTINGS_FOLDER, 'title/')
+TEXT_FOLDER = os.path.join(consts.POSTINGS_FOLDER, 'text/')
+ANCHOR_FOLDER = os.path.join(consts.POSTINGS_FOLDER, 'anchor/')
+if consts.SHARD_ADDRESSES:
+    # sharded mode: the shard workers hold the indexes, this process only 
+    # fans the queries out and merges the results
+    shards = ShardCoordinator(consts.SHARD_ADDRESSES)
+    TITLE_INDEX = TEXT_INDEX = ANCHOR_INDEX = TEXT_IMPACT_INDEX = None
+    BITMAP_INDEXES = {}
+else:
+    shards = None
+    TITLE_INDEX = helper.get_index(TITLE_FOLDER, 'index_title')
+    TEXT_INDEX = helper.get_index(TEXT_FOLDER, 'index_text')
+    ANCHOR_INDEX = helper.get_index(ANCHOR_FOLDER, 'index_anchor')
+    # the BM25 impact index of the body, built by index_builder.py, for mode=bm25
+    TEXT_IMPACT_INDEX = helper.get_index(TEXT_FOLDER, 'impact_text') \
+        if any(os.path.exists(os.path.join(TEXT_FOLDER, f'impact_text{suffix}')) for suffix in ('.pkl', '_lexicon')) \
+        else None
+    # bitmap title and anchor indexes, built by bitmap_postings.py, see consts.BITMAP_POSTINGS
+    BITMAP_INDEXES = {name: helper.get_index(folder, f'bitmap_{name}')
+                      for name, folder in (('title', TITLE_FOLDER), ('anchor', ANCHOR_FOLDER))
+                      if consts.BITMAP_POSTINGS and any(os.path.exists(os.path.join(folder, f'bitmap_{name}{suffix}'))
+                                                        for suffix in ('.pkl', '_lexicon'))}
+    # map the posting files once, they are then shared by all requests
+    for folder in (TITLE_FOLDER, TEXT_FOLDER, ANCHOR_FOLDER):
+        helper.reader.map_folder(folder)
+    if consts.SEGMENTS_FOLDER:
+        # documents indexed since the build are searched too, see /index_documents
+        TITLE_INDEX, TEXT_INDEX, ANCHOR_INDEX = [
+            SegmentedIndex(index, folder, os.path.join(consts.SEGMENTS_FOLDER, name), reader=helper.reader)
+            for index, folder, name in ((TITLE_INDEX, TITLE_FOLDER, 'title'), (TEXT_INDEX, TEXT_FOLDER, 'text'),
+                                        (ANCHOR_INDEX, ANCHOR_FOLDER, 'anchor'))]
+INDEXES = {'title': (TITLE_INDEX, TITLE_FOLDER),
+           'text': (TEXT_INDEX, TEXT_FOLDER),
+           'anchor': (ANCHOR_INDEX, ANCHOR_FOLDER)}
+# title prefix completions, built by suggest.py
+SUGGEST_FOLDER = os.path.join(consts.POSTINGS_FOLDER, 'other', 'suggest')
+SUGGEST_INDEX = SuggestIndex.open(SUGGEST_FOLDER) if os.path.isdir(SUGGEST_FOLDER) else None
+# responses of repeated queries
+result_cache = LRUCache(consts.RESULT_CACHE_SIZE, consts.RESULT_CACHE_TTL)
+if consts.SLOW_QUERY_LOG:
+    metrics.slow_query_log.addHandler(logging.FileHandler(consts.SLOW_QUERY_LOG))
+
+
+@app.before_request
+def start_request_timer():
+    ''' Times every request, per stage, see metrics.py. '''
+    g.metrics_token = metrics.start_request(request.url_rule.rule if request.url_rule else 'unknown')
+
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def stop_request_timer(exc):
+    ''' Records the latency of every request, also of those that raised
+        before a response was made, and resets the metrics context. '''
+    if 'metrics_token' in g:
+        status = 500 if exc is not None else g.pop('response_status', 500)
+        metrics.end_request(g.pop('metrics_token'), consts.SLOW_QUERY_SECONDS,
+                            {'query': request.args.get('query', ''), 'status': status})
+
+
+def titles_response(doc_ids):
+    ''' A JSON response of (wiki_id, title) pairs, assembled from the title 
+        store's pre-encoded fragments instead of jsonify. '''
+    return Response(helper.get_doc_title_json(doc_ids), mimetype='application/json')
+
+
+def cached_response(endpoint, query_tokens, compute):
+    ''' Serves a search response from the result cache. On a miss, `compute` 
+        returns the ranked doc ids and extra response headers, and the encoded
+        response is cached under (endpoint, multiset of query tokens, indexes
+        generation), so that indexed documents show up right away. '''
+    generation = tuple(getattr(inverted_index, 'generation', 0) for inverted_index, folder in INDEXES.values())
+    key = (endpoint, tuple(sorted(Counter(query_tokens).items())), generation)
+    cached = result_cache.get(key)
+    if cached is None:
+        doc_ids, headers = compute()
+        cached = (helper.get_doc_title_json(doc_ids), headers)
+        result_cache.put(key, cached)
+    body, headers = cached
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+def expand_synonyms(query_tokens):
+    ''' The query tokens followed by the top title words they are synonyms of,
+        see QueryAnalyzer.expand. '''
+    return helper.analyzer.expand(query_tokens)
+
+
+def frequency_scores(index_name, query_tokens, min_match=1):
+    ''' Doc ids matching at least `min_match` distinct query tokens in the 
+        'title' or 'anchor' index and the number of distinct query tokens each
+        one matches. '''
+    if shards is not None:
+        return shards.frequency_scores(index_name, query_tokens, min_match)
+    inverted_index, folder = INDEXES[index_name]
+    bitmap_index = BITMAP_INDEXES.get(index_name)
+    if bitmap_index is not None and not hasattr(helper.get_snapshot(inverted_index), 'segments'):
+        # the bitmaps hold the documents of the build only, not the ones indexed since
+        return helper.bitmap_frequency_scores(query_tokens, bitmap_index, folder, min_match)
+    return helper.frequency_scores(query_tokens, inverted_index, folder, min_match)
+
+
+def body_ranking(query_tokens, mode='cosine', N=100):
+    ''' Ranked (doc_id, score) pairs of the body index and the postings 
+        statistics, see Helper.body_ranking. '''
+    if mode not in BODY_MODES:
+        raise ValueError(f'unknown ranking mode {mode}, expected one of {", ".join(BODY_MODES)}')
+    if shards is not None:
+        if mode == 'bm25':
+            raise ValueError('bm25 ranking is not served by shards')
+        return shards.body_ranking(query_tokens, mode, N)
+    inverted_index = TEXT_IMPACT_INDEX if mode == 'bm25' else TEXT_INDEX
+    return helper.body_ranking(query_tokens, inverted_index, TEXT_FOLDER, mode, N)
+
+
+def search_results(query_tokens, fields=('title',), expanded_tokens=None):
+    ''' Ranked doc ids of /search. With the title field only, these are the 
+        title matches of the query and its synonyms, by number of distinct 
+        matched terms and then PageRank. With several fields, the fields are 
+        evaluated in parallel and their scores fused with PageRank. '''
+    if expanded_tokens is None:
+        expanded_tokens = expand_synonyms(query_tokens)
+    if tuple(fields) != ('title',):
+        field_scores = dict(zip(fields, field_executor.map(
+            metrics.propagate(lambda field: field_scorers[field](query_tokens, expanded_tokens)), fields)))
+        return [doc_id for doc_id, score in helper.fuse_scores(field_scores, consts.FIELD_WEIGHTS)]
+    if helper.DOC_MAP is not None and shards is None:
+        # doc ids are in PageRank order, see reorder.py
+        return helper.top_k_by_count(expanded_tokens, TITLE_INDEX, TITLE_FOLDER, 100).tolist()
+    doc_ids, counts = frequency_scores('title', expanded_tokens)
+    return title_pagerank_results(doc_ids, counts)
+
+
+def title_pagerank_results(doc_ids, counts):
+    ''' The top 100 title matches, by number of distinct matched terms and 
+        then PageRank. '''
+    if helper.DOC_MAP is not None:
+        # doc ids are in PageRank order, see reorder.py
+        return doc_ids[np.lexsort((doc_ids, -counts))][:100].tolist()
+    docs_ids_scores = list(zip(doc_ids.tolist(), counts.tolist()))
+    pageranks = helper.get_page_ranks([doc_id for doc_id, score in docs_ids_scores]).tolist()
+    docs_ids_scores_pagerank = [(doc_id, score, pagerank) for (doc_id, score), pagerank in zip(docs_ids_scores, pageranks)]
+    ranking_results_sorted_by_score_then_pr = sorted(docs_ids_scores_pagerank, key=lambda x: (x[1], x[2]), reverse=True)[:100]
+    return [doc_id for doc_id, score, pagerank in ranking_results_sorted_by_score_then_pr]
+
+
+def body_scores(query_tokens):
+    ''' Cosine similarity of all the body candidates of the query. '''
+    ranking, stats = body_ranking(query_tokens, N=None)
+    if len(ranking) == 0:
+        return [], []
+    doc_ids, scores = zip(*ranking)
+    return np.array(doc_ids), np.array(scores)
+
+
+# per field scorers of a multi-field /search, given the query tokens and the 
+# tokens expanded with synonyms
+field_scorers = {
+    'title': lambda tokens, expanded: frequency_scores('title', expanded),
+    'body': lambda tokens, expanded: body_scores(tokens),
+    'anchor': lambda tokens, expanded: frequency_scores('anchor', expanded),
+}
+field_executor = ThreadPoolExecutor(max_workers=len(field_scorers))
+
+
+def batch_frequency_scores(index_name, queries_tokens, min_matches=None):
+    ''' frequency_scores of a batch of queries, see Helper.batch_frequency_scores. '''
+    min_matches = min_matches or [1] * len(queries_tokens)
+    if shards is not None:
+        return [shards.frequency_scores(index_name, query_tokens, min_match)
+                for query_tokens, min_match in zip(queries_tokens, min_matches)]
+    inverted_index, folder = INDEXES[index_name]
+    return helper.batch_frequency_scores(queries_tokens, inverted_index, folder, min_matches)
+
+
+def batch_body_ranking(queries_tokens, mode='cosine', N=100):
+    ''' body_ranking of a batch of queries, see Helper.batch_body_ranking. '''
+    if shards is not None:
+        return [body_ranking(query_tokens, mode, N) for query_tokens in queries_tokens]
+    inverted_index = TEXT_IMPACT_INDEX if mode == 'bm25' else TEXT_INDEX
+    return helper.batch_body_ranking(queries_tokens, inverted_index, TEXT_FOLDER, mode, N)
+
+
+def batch_search(queries, endpoint='search', mode=None):
+    ''' Python API of /batch_search: the ranked wiki ids of every query, as
+        `endpoint` returns them: 'search' (with its default title field), 
+        'search_body', 'search_title' or 'search_anchor'. `mode` is the 
+        ranking mode of /search_body, or 'and' for /search_title and 
+        /search_anchor. The posting list of every distinct term of the batch
+        is read once. '''
+    return [helper.to_wiki_ids(doc_ids).tolist() for doc_ids in batch_rankings(queries, endpoint, mode)]
+
+
+def batch_rankings(queries, endpoint='search', mode=None):
+    ''' The ranked doc ids of every query of a batch, see batch_search. '''
+    analyzed = [helper.analyzer.analyze(query) for query in queries]
+    if endpoint == 'search_body':
+        rankings = batch_body_ranking([query.tokens for query in analyzed], mode or 'cosine')
+        return [[doc_id for doc_id, score in ranking] for ranking, stats in rankings]
+    if endpoint == 'search':
+        results = batch_frequency_scores('title', [query.expanded for query in analyzed])
+        return [title_pagerank_results(doc_ids, counts) for doc_ids, counts in results]
+    if endpoint in ('search_title', 'search_anchor'):
+        min_matches = [max(len(set(query.tokens)), 1) if mode == 'and' else 1 for query in analyzed]
+        results = batch_frequency_scores(endpoint.split('_')[1], [query.tokens for query in analyzed], min_matches)
+        return [doc_ids[np.lexsort((doc_ids, -counts))] for doc_ids, counts in results]
+    raise ValueError(f'unknown endpoint {endpoint}')
+
+
+def search_body_results(query_tokens, mode='cosine'):
+    ''' Ranked doc ids of /search_body and the postings statistics of the 
+        ranking `mode`. '''
+    top_n_id_score, stats = body_ranking(query_tokens, mode)
+    return [doc_id for doc_id, score in top_n_id_score], stats
+
+
+def match_threshold(query_tokens):
+    ''' The minimal number of distinct query tokens a result must match, from
+        the `mode` (or: any token, and: all of them) and `min_match` arguments
+        of /search_title and /search_anchor. '''
+    if request.args.get('mode', 'or') == 'and':
+        return len(set(query_tokens))
+    min_match = int(request.args.get('min_match', 1))
+    if min_match < 1:
+        raise ValueError('min_match must be positive')
+    return min(min_match, len(set(query_tokens))) if query_tokens else 1
+
+
+def frequency_results(query_tokens, index_name, min_match=1):
+    ''' Ranked doc ids of /search_title and /search_anchor: all the matches,
+        by number of distinct matched terms, then doc id. '''
+    doc_ids, counts = frequency_scores(index_name, query_tokens, min_match)
+    return doc_ids[np.lexsort((doc_ids, -counts))]
+
+
+def encode_cursor(cursor):
+    ''' An opaque continuation token of a (count, doc_id) cursor. '''
+    return base64.urlsafe_b64encode(f'{cursor[0]}:{cursor[1]}'.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(token):
+    count, doc_id = base64.urlsafe_b64decode(token.encode('ascii')).decode('ascii').split(':')
+    return int(count), int(doc_id)
+
+
+def page_arguments():
+    ''' (limit, offset, cursor) of a paged request, None to return all the
+        results. Raises ValueError on invalid arguments. '''
+    if not any(name in request.args for name in ('limit', 'offset', 'cursor')):
+        return None
+    limit = int(request.args.get('limit', 100))
+    offset = int(request.args.get('offset', 0))
+    if limit < 1 or offset < 0:
+        raise ValueError('limit must be positive and offset not negative')
+    token = request.args.get('cursor')
+    return limit, offset, decode_cursor(token) if token else None
+
+
+def stream_titles(doc_id_chunks):
+    ''' Generator of the JSON list of (wiki_id, title) pairs of the chunks of
+        doc ids, encoded one chunk at a time. '''
+    yield b'['
+    separator = b''
+    for chunk in doc_id_chunks:
+        pairs = helper.get_doc_title_json(chunk)[1:-1]
+        if pairs:
+            yield separator + pairs
+            separator = b','
+    yield b']'
+
+
+def frequency_response(index_name, query_tokens):
+    ''' The response of /search_title and /search_anchor: all the results, a
+        page of them or all of them streamed, see search_title. '''
+    try:
+        min_match = match_threshold(query_tokens)
+        page = page_arguments()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    endpoint = f'search_{index_name}:{min_match}'
+    if request.args.get('stream', '0') not in ('', '0', 'false'):
+        doc_ids, counts = frequency_scores(index_name, query_tokens, min_match)
+        return Response(stream_titles(helper.iter_by_count(doc_ids, counts, consts.STREAM_CHUNK)),
+                        mimetype='application/json', headers={'X-Total-Results': len(doc_ids)})
+    if page is None:
+        return cached_response(endpoint, query_tokens,
+                               lambda: (frequency_results(query_tokens, index_name, min_match), {}))
+    limit, offset, after = page
+
+    def compute():
+        doc_ids, counts = frequency_scores(index_name, query_tokens, min_match)
+        page_doc_ids, last = helper.page_by_count(doc_ids, counts, limit, offset, after)
+        headers = {'X-Total-Results': len(doc_ids)}
+        if last is not None:
+            headers['X-Next-Cursor'] = encode_cursor(last)
+        return page_doc_ids, headers
+    return cached_response(f'{endpoint}:{limit}:{offset}:{after}', query_tokens, compute)
 
 
 @app.route("/search")
@@ -29,26 +340,22 @@ def search():
          http://YOUR_SERVER_DOMAIN/search?query=hello+world
         where YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+
+        By default only titles are searched. An optional `fields` argument, 
+        e.g. fields=title,body,anchor, evaluates several fields in parallel and
+        fuses their scores with PageRank (weights in consts.FIELD_WEIGHTS).
     Returns:
     --------
         list of up to 100 search results, ordered from best to worst where each 
         element is a tuple (wiki_id, title).
     '''
-    res = []
     query = request.args.get('query', '')
-    if len(query) == 0:
-        return jsonify(res)
-    query_tokens = helper.get_tokens(query)
-    synonyms_dict = consts.synonyms_dict
-    for query in query_tokens:
-        key = list(filter(lambda x: synonyms_dict[x] == query, synonyms_dict))
-        if key:
-            query_tokens.append(key[0])
-    docs_ids_scores = helper.frequency_ranking(query_tokens, inverted_index=TITLE_INDEX, folder='/home/igalfernand/postings_gcp/title/')
-    docs_ids_scores_pagerank = [(doc_id, score, helper.get_page_rank_by_id(doc_id)) for doc_id, score in docs_ids_scores]
-    ranking_results_sorted_by_score_then_pr = sorted(docs_ids_scores_pagerank, key=lambda x: (x[1], x[2]), reverse=True)[:100]
-    res = helper.get_doc_title_pairs_from_items(ranking_results_sorted_by_score_then_pr)
-    return jsonify(res)
+    fields = [field for field in request.args.get('fields', 'title').split(',') if field in field_scorers]
+    if len(query) == 0 or len(fields) == 0:
+        return jsonify([])
+    analyzed = helper.analyzer.analyze(query)
+    return cached_response(f'search:{",".join(fields)}', analyzed.tokens,
+                           lambda: (search_results(analyzed.tokens, fields, analyzed.expanded), {}))
 
 
 @app.route("/search_body")
@@ -62,32 +369,33 @@ def search_body():
          http://YOUR_SERVER_DOMAIN/search_body?query=hello+world
         where YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+
+        An optional `mode` argument selects the ranking: `cosine` (default),
+        `cosine_full` (cosine against the full document vectors, normalized by
+        the index-time document norms), `tfidf` (exhaustive tfidf dot product),
+        `maxscore` (the same tfidf ranking with MaxScore dynamic pruning) or
+        `bm25` (BM25 from the precomputed impact index). The number of postings
+        and of skipped postings is reported in the X-Postings and 
+        X-Postings-Skipped response headers. An unknown mode, or a mode the 
+        loaded indexes cannot serve, is a 400 error.
     Returns:
     --------
         list of up to 100 search results, ordered from best to worst where each 
         element is a tuple (wiki_id, title).
     '''
-    res = []
     query = request.args.get('query', '')
+    mode = request.args.get('mode', 'cosine')
     if len(query) == 0:
-        return jsonify(res)
-    query_tokens = helper.get_tokens(query)
-    index_terms = set(TEXT_INDEX.df.keys())
-    distinct_tokens = set(query_tokens)
-    query_tokens_that_exists_in_index = [term for term in distinct_tokens if
-                                         term in index_terms]
-    if len(query_tokens_that_exists_in_index) == 0:
         return jsonify([])
-    Q = helper.generate_query_tfidf_vector(original_query_to_search=query_tokens,
-                                           processed_query_to_search=query_tokens_that_exists_in_index,
-                                           inverted_index=TEXT_INDEX)
-    words, pls = helper.get_posting_iter(TEXT_INDEX, '/home/igalfernand/postings_gcp/text/',
-                                         query_tokens=query_tokens_that_exists_in_index)
-    D = helper.generate_document_tfidf_matrix(query_tokens_that_exists_in_index, TEXT_INDEX, words, pls)
-    sim_dict = helper.cosine_similarity(D, Q)
-    top_n_id_score = helper.get_top_n(sim_dict)
-    res = helper.get_doc_title_pairs_from_items(top_n_id_score)
-    return jsonify(res)
+    query_tokens = helper.analyzer.analyze(query).tokens
+
+    def compute():
+        doc_ids, stats = search_body_results(query_tokens, mode)
+        return doc_ids, {'X-Postings': stats['postings'], 'X-Postings-Skipped': stats['postings_skipped']}
+    try:
+        return cached_response(f'search_body:{mode}', query_tokens, compute)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
 
 @app.route("/search_title")
@@ -106,20 +414,26 @@ def search_title():
          http://YOUR_SERVER_DOMAIN/search_title?query=hello+world
         where YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+
+        An optional `mode=and` argument returns only the results that match
+        all the query words, and `min_match=k` those that match at least k 
+        distinct query words; both skip counting the union of the posting 
+        lists (see Helper.min_match_scores).
+
+        Results can be paged with `limit` and `offset`: the X-Next-Cursor 
+        response header is then the `cursor` argument of the next page, and
+        X-Total-Results the number of results. `stream=1` streams all the 
+        results, encoded a chunk at a time.
     Returns:
     --------
         list of ALL (not just top 100) search results, ordered from best to 
         worst where each element is a tuple (wiki_id, title).
     '''
-    res = []
     query = request.args.get('query', '')
     if len(query) == 0:
-        return jsonify(res)
-    query_tokens = helper.get_tokens(query)
-    docs_ids_scores = helper.frequency_ranking(query_tokens, inverted_index=TITLE_INDEX, folder='/home/igalfernand/postings_gcp/title/')
-    sorted_ranking_results_docs_ids = sorted(docs_ids_scores, key=lambda item: item[1], reverse=True)
-    res = helper.get_doc_title_pairs_from_items(sorted_ranking_results_docs_ids)
-    return jsonify(res)
+        return jsonify([])
+    query_tokens = helper.analyzer.analyze(query).tokens
+    return frequency_response('title', query_tokens)
 
 
 @app.route("/search_anchor")
@@ -138,20 +452,165 @@ def search_anchor():
          http://YOUR_SERVER_DOMAIN/search_anchor?query=hello+world
         where YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+
+        An optional `mode=and` argument returns only the results that match
+        all the query words, and `min_match=k` those that match at least k 
+        distinct query words; both skip counting the union of the posting 
+        lists (see Helper.min_match_scores).
+
+        Results can be paged with `limit` and `offset`: the X-Next-Cursor 
+        response header is then the `cursor` argument of the next page, and
+        X-Total-Results the number of results. `stream=1` streams all the 
+        results, encoded a chunk at a time.
     Returns:
     --------
         list of ALL (not just top 100) search results, ordered from best to 
         worst where each element is a tuple (wiki_id, title).
     '''
-    res = []
     query = request.args.get('query', '')
     if len(query) == 0:
-        return jsonify(res)
-    query_tokens = helper.get_tokens(query)
-    docs_ids_scores = helper.frequency_ranking(query_tokens, inverted_index=ANCHOR_INDEX, folder='/home/igalfernand/postings_gcp/anchor/')
-    sorted_ranking_results_docs_ids = sorted(docs_ids_scores, key=lambda item: item[1], reverse=True)
-    res = helper.get_doc_title_pairs_from_items(sorted_ranking_results_docs_ids)
-    return jsonify(res)
+        return jsonify([])
+    query_tokens = helper.analyzer.analyze(query).tokens
+    return frequency_response('anchor', query_tokens)
+
+
+@app.route("/suggest")
+def suggest():
+    ''' Returns the titles starting with `prefix`, case insensitively, best 
+        PageRank first (or page views, see suggest.py), for autocompletion:
+         http://YOUR_SERVER_DOMAIN/suggest?prefix=hello+wo
+        `limit` caps the number of titles, at most consts.SUGGEST_TOP_K. The
+        completions come from the suggest index, not from the inverted 
+        index, so documents indexed since it was built are not suggested.
+    Returns:
+    --------
+        list of up to 10 titles, ordered from best to worst where each element
+        is a tuple (wiki_id, title).
+    '''
+    if SUGGEST_INDEX is None:
+        return jsonify({'error': 'no suggest index, run python suggest.py'}), 400
+    try:
+        limit = int(request.args.get('limit', consts.SUGGEST_TOP_K))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    with metrics.stage('suggest'):
+        doc_ids = SUGGEST_INDEX.complete(request.args.get('prefix', ''), max(limit, 0))
+    return titles_response(doc_ids)
+
+
+@app.route("/batch_search", methods=['POST'])
+def batch_search_endpoint():
+    ''' Returns the search results of many queries at once, reading every 
+        posting list once for the whole batch instead of once per request.
+
+        Issue a POST request with a json payload like:
+          {"queries": ["hello world", "python"], "endpoint": "search_body",
+           "mode": "cosine", "limit": 100}
+        where `endpoint` is search (default), search_body, search_title or 
+        search_anchor, `mode` its ranking mode (see search_body) or "and" for
+        search_title and search_anchor, and the optional `limit` caps the 
+        results of every query.
+    Returns:
+    --------
+        a list with the list of (wiki_id, title) results of every query, in
+        the order of the queries.
+    '''
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('queries'), list) \
+            or not all(isinstance(query, str) for query in payload['queries']):
+        return jsonify({'error': 'the payload must be an object with a list of query strings in "queries"'}), 400
+    queries = payload['queries']
+    if len(queries) > consts.MAX_BATCH_QUERIES:
+        return jsonify({'error': f'at most {consts.MAX_BATCH_QUERIES} queries per batch'}), 400
+    limit = payload.get('limit')
+    if limit is not None:
+        try:
+            limit = max(int(limit), 0)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'limit must be an integer'}), 400
+    try:
+        results = batch_rankings(queries, payload.get('endpoint', 'search'), payload.get('mode'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    body = b'[' + b','.join(helper.get_doc_title_json(doc_ids[:limit]) for doc_ids in results) + b']'
+    return Response(body, mimetype='application/json')
+
+
+@app.route("/index_documents", methods=['POST'])
+def index_documents():
+    ''' Adds, replaces or deletes documents without rebuilding the indexes. 
+        Documents are searchable once the request returns.
+
+        Issue a POST request with a json payload like:
+          {"documents": [{"id": 12, "title": "...", "text": "...", "anchor": "..."}],
+           "deleted": [8]}
+        where the optional `anchor` is the anchor text of the links pointing to
+        the document, which keeps its previous anchor text when it is missing.
+        Only available when consts.SEGMENTS_FOLDER is set.
+    Returns:
+    --------
+        the number of indexed and deleted documents.
+    '''
+    if not isinstance(TEXT_INDEX, SegmentedIndex):
+        return jsonify({'error': 'incremental indexing is disabled'}), 400
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('documents', []), list) \
+            or not isinstance(payload.get('deleted', []), list) \
+            or not all(isinstance(doc, dict) and 'id' in doc and
+                       all(isinstance(doc.get(field, ''), str) for field in ('title', 'text', 'anchor'))
+                       for doc in payload.get('documents', [])):
+        return jsonify({'error': 'the payload must be an object with a list of documents in "documents" and a '
+                                 'list of doc ids in "deleted"'}), 400
+    documents = payload.get('documents', [])
+    try:
+        wiki_ids = [int(doc['id']) for doc in documents]
+        deleted_wiki_ids = [int(doc_id) for doc_id in payload.get('deleted', [])]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'doc ids must be integers'}), 400
+    # the indexes may be keyed by internal doc ids, see reorder.py
+    doc_ids = helper.to_internal_ids(wiki_ids).tolist()
+    deleted = helper.to_internal_ids(deleted_wiki_ids).tolist()
+    if documents:
+        TITLE_INDEX.add_documents({doc_id: helper.get_tokens(doc.get('title', '')) for doc_id, doc in zip(doc_ids, documents)})
+        TEXT_INDEX.add_documents({doc_id: helper.get_tokens(doc.get('text', '')) for doc_id, doc in zip(doc_ids, documents)})
+        anchors = {doc_id: helper.get_tokens(doc['anchor']) for doc_id, doc in zip(doc_ids, documents) if 'anchor' in doc}
+        if anchors:
+            ANCHOR_INDEX.add_documents(anchors)
+        for doc_id, wiki_id, doc in zip(doc_ids, wiki_ids, documents):
+            helper.TITLES.add(doc_id, doc.get('title', ''), wiki_id)
+    if deleted:
+        for inverted_index in (TITLE_INDEX, TEXT_INDEX, ANCHOR_INDEX):
+            inverted_index.delete_documents(deleted)
+    return jsonify({'indexed': len(documents), 'deleted': len(deleted)})
+
+
+@app.route("/cache_stats")
+def cache_stats():
+    ''' Returns the hit, miss and eviction counters of the query result cache 
+        and of the posting list cache, for sizing them.
+    '''
+    return jsonify({'results': result_cache.stats(), 'postings': helper.posting_cache.stats()})
+
+
+@app.route("/metrics")
+def get_metrics():
+    ''' Returns the request and per-stage latency histograms and the postings
+        and bytes read counters, by endpoint and index, in the Prometheus text
+        format.
+    '''
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/ready")
+def ready():
+    ''' Readiness probe: answers once the indexes are loaded, as they are
+        loaded when this module is imported. Under prefork.py, the probe
+        answers 503 until the indexes are warmed up and the workers forked.
+    Returns:
+    --------
+        {"ready": true, "pid": the id of the serving process}
+    '''
+    return jsonify({'ready': True, 'pid': os.getpid()})
 
 
 @app.route("/get_pagerank", methods=['POST'])
@@ -175,8 +634,9 @@ def get_pagerank():
     if len(wiki_ids) == 0:
         return jsonify(res)
     else:
-        res = [helper.get_page_rank_by_id(doc_id) for doc_id in wiki_ids]
-        return jsonify(res)
+        res = helper.get_page_ranks(helper.to_internal_ids(wiki_ids)).tolist()
+        with metrics.stage('encode'):
+            return jsonify(res)
 
 
 @app.route("/get_pageview", methods=['POST'])
@@ -202,8 +662,9 @@ def get_pageview():
     if len(wiki_ids) == 0:
         return jsonify(res)
     else:
-        res = [helper.get_page_view_by_id(doc_id) for doc_id in wiki_ids]
-        return jsonify(res)
+        res = helper.get_page_views(helper.to_internal_ids(wiki_ids)).tolist()
+        with metrics.stage('encode'):
+            return jsonify(res)
 
 
 if __name__ == '__main__':
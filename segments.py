@@ -0,0 +1,406 @@
+import os
+import json
+import math
+import shutil
+import threading
+import numpy as np
+from pathlib import Path
+from contextlib import closing
+from collections.abc import Mapping
+from inverted_index_gcp import InvertedIndex, MultiFileWriter, MappedFileReader, POSTING_DTYPE, TF_MASK
+
+# a tier holds segments of up to MERGE_FACTOR ** tier documents, MERGE_FACTOR
+# adjacent segments of a tier are merged into one segment of the next tier.
+MERGE_FACTOR = 10
+MANIFEST = 'segments.json'
+
+
+def _lookup(mapping, doc_ids):
+    if hasattr(mapping, 'lookup'):
+        return mapping.lookup(doc_ids)
+    return np.fromiter((mapping.get(doc_id, 0) for doc_id in doc_ids.tolist()), dtype=np.float64,
+                       count=len(doc_ids))
+
+
+def _write_postings(index, postings, folder, name):
+    """ Writes (term, doc_ids, tfs) posting lists sorted by doc id to posting
+        files of `folder` and fills the term stats of `index`.
+    """
+    dl = index.DL
+    with closing(MultiFileWriter(folder, name)) as writer:
+        for w, doc_ids, tfs in postings:
+            if len(doc_ids) == 0:
+                continue
+            records = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+            records['doc_id'] = doc_ids
+            records['tf'] = np.minimum(tfs, TF_MASK)
+            index.posting_locs[w].extend(writer.write(records.tobytes(), folder))
+            index.df[w] = len(doc_ids)
+            index.term_total[w] = int(tfs.sum())
+            lengths = np.maximum(_lookup(dl, np.asarray(doc_ids)), 1)
+            index.max_normalized_tf[w] = float(np.max(tfs / lengths))
+
+
+class Segment:
+    """ An immutable index over one batch of documents, with its own posting
+        files in `folder`. `seq` orders the segments and tombstones: a
+        tombstone (doc_id, seq) deletes the doc from the segments older than
+        `seq`.
+    """
+    def __init__(self, seq, folder, index):
+        self.seq = seq
+        self.folder = str(folder)
+        self.index = index
+        self.doc_ids = np.array(sorted(index.DL.keys()), dtype=np.int64)
+        self.dl = _lookup(index.DL, self.doc_ids)
+
+    @staticmethod
+    def write(seq, docs, folder):
+        """ Writes a segment of the {doc_id: tokens} documents `docs`. """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        index = InvertedIndex(docs)
+        # documents without tokens still replace their previous version
+        for doc_id, tokens in docs.items():
+            index.DL[doc_id] = len(tokens)
+        postings = ((w, *map(np.array, zip(*sorted(index._posting_list[w]))))
+                    for w in sorted(index._posting_list))
+        _write_postings(index, postings, folder, 'segment')
+        index.seq = seq
+        index.write_index(folder, 'segment')
+        return Segment(seq, folder, index)
+
+    @staticmethod
+    def open(folder):
+        index = InvertedIndex.read_index(folder, 'segment')
+        return Segment(index.seq, folder, index)
+
+    def contains(self, doc_ids):
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(self.doc_ids) == 0:
+            return np.zeros(len(doc_ids), dtype=bool), np.zeros(len(doc_ids), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.doc_ids, doc_ids), len(self.doc_ids) - 1)
+        return self.doc_ids[positions] == doc_ids, positions
+
+
+class SegmentColumn(Mapping):
+    """ dict-like view of a term statistic over all the segments of a
+        snapshot, combined with `combine` (sum for df, max for bounds).
+    """
+    def __init__(self, columns, combine=sum, default=0):
+        self._columns = columns
+        self._combine = combine
+        self._default = default
+
+    def __getitem__(self, w):
+        values = [column[w] for column in self._columns if w in column]
+        if not values:
+            raise KeyError(w)
+        return self._combine(values)
+
+    def get(self, w, default=None):
+        try:
+            return self[w]
+        except KeyError:
+            return self._default if default is None else default
+
+    def __contains__(self, w):
+        return any(w in column for column in self._columns)
+
+    def __iter__(self):
+        seen = set()
+        for column in self._columns:
+            for w in column:
+                if w not in seen:
+                    seen.add(w)
+                    yield w
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class SegmentDL:
+    """ Document lengths of the live version of each document. """
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def lookup(self, doc_ids):
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        lengths = np.zeros(len(doc_ids), dtype=np.float64)
+        # newer segments hold the newer versions
+        for segment in self._snapshot.segments:
+            found, positions = segment.contains(doc_ids)
+            lengths[found] = segment.dl[positions[found]]
+        return lengths
+
+    def get(self, doc_id, default=0):
+        return self.lookup([doc_id])[0].item() if doc_id in self else default
+
+    def __getitem__(self, doc_id):
+        if doc_id not in self:
+            raise KeyError(doc_id)
+        return self.lookup([doc_id])[0].item()
+
+    def __contains__(self, doc_id):
+        return bool(self._snapshot.live([doc_id])[0])
+
+    def __len__(self):
+        return self._snapshot.N
+
+
+class Snapshot:
+    """ A consistent, read-only view of a segmented index: its segments and
+        tombstones at one generation. It has the query-time interface of an
+        InvertedIndex, so Helper scores it like any other index.
+    """
+    def __init__(self, segments, deleted_ids, deleted_seqs, generation, N, name=None):
+        self.segments = tuple(segments)
+        # the name of the base index, see Helper.get_posting_key
+        self.name = name
+        self.deleted_ids = deleted_ids
+        self.deleted_seqs = deleted_seqs
+        self.generation = generation
+        self.N = N
+        self.df = SegmentColumn([segment.index.df for segment in self.segments])
+        self.term_total = SegmentColumn([segment.index.term_total for segment in self.segments])
+        # the largest bound of the segments bounds the merged postings
+        self.max_normalized_tf = SegmentColumn([getattr(segment.index, 'max_normalized_tf', {})
+                                                for segment in self.segments], max, 1.0)
+        self.DL = SegmentDL(self)
+
+    def deleted_since(self, doc_ids, seq):
+        """ Tells which of `doc_ids` have a tombstone newer than `seq`. """
+        if len(self.deleted_ids) == 0:
+            return np.zeros(len(doc_ids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.deleted_ids, doc_ids), len(self.deleted_ids) - 1)
+        return (self.deleted_ids[positions] == doc_ids) & (self.deleted_seqs[positions] > seq)
+
+    def live(self, doc_ids):
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        live = np.zeros(len(doc_ids), dtype=bool)
+        for segment in self.segments:
+            found, positions = segment.contains(doc_ids)
+            live |= found & ~self.deleted_since(doc_ids, segment.seq)
+        return live
+
+    def posting_lists_iter_arrays(self, folder, query_tokens, reader=None):
+        """ Yields (word, doc_ids, tfs) merged over the segments, without the
+            postings of deleted or replaced documents. `folder` is ignored,
+            every segment reads its own folder.
+        """
+        for w in query_tokens:
+            doc_ids, tfs = [], []
+            for segment in self.segments:
+                if w not in segment.index.df:
+                    continue
+                _, segment_doc_ids, segment_tfs = next(
+                    segment.index.posting_lists_iter_arrays(segment.folder, [w], reader))
+                live = ~self.deleted_since(segment_doc_ids.astype(np.int64), segment.seq)
+                doc_ids.append(segment_doc_ids[live])
+                tfs.append(segment_tfs[live])
+            if len(doc_ids) == 1:
+                yield w, doc_ids[0], tfs[0]
+                continue
+            doc_ids = np.concatenate(doc_ids) if doc_ids else np.empty(0, dtype=np.uint32)
+            tfs = np.concatenate(tfs) if tfs else np.empty(0, dtype=np.uint16)
+            order = np.argsort(doc_ids, kind='stable')
+            yield w, doc_ids[order], tfs[order]
+
+
+class SegmentedIndex:
+    """ An index that is updated incrementally. Added documents are written to
+        a new immutable segment and deleted ones get a tombstone; both are
+        searchable once the call returns. The base index (e.g. the index built
+        by index_builder.py) is the oldest segment. A background thread merges
+        adjacent segments of the same size tier (tiered merging) while queries
+        keep using the snapshot they started with.
+
+        The segments and tombstones are listed in `segments_dir`/segments.json,
+        replaced atomically on every change.
+    """
+    def __init__(self, base_index, base_folder, segments_dir, merge_factor=MERGE_FACTOR, reader=None):
+        self.base = Segment(0, base_folder, base_index)
+        self.segments_dir = Path(segments_dir)
+        self.segments_dir.mkdir(parents=True, exist_ok=True)
+        self.merge_factor = merge_factor
+        # the mapped posting files of dropped segments are forgotten by reader
+        self.reader = reader
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._changed = threading.Condition()
+        # set on every commit, so that a change made while the merger is busy is merged too
+        self._pending = True
+        self._closed = False
+        segments, tombstones, self.seq, self.generation = [], {}, 0, 0
+        manifest_path = self.segments_dir / MANIFEST
+        if manifest_path.exists():
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            segments = [Segment.open(self.segments_dir / name) for name in manifest['segments']]
+            tombstones = {int(doc_id): seq for doc_id, seq in manifest['tombstones']}
+            self.seq, self.generation = manifest['seq'], manifest['generation']
+        self._segments = segments
+        self._tombstones = tombstones
+        self._snapshot = self._make_snapshot()
+        self._merger = threading.Thread(target=self._merge_loop, daemon=True)
+        self._merger.start()
+
+    def snapshot(self):
+        """ The current snapshot, or the base index itself when there are no
+            segments nor tombstones, which is then searched as before.
+        """
+        snapshot = self._snapshot
+        if len(snapshot.segments) == 1 and len(snapshot.deleted_ids) == 0:
+            return self.base.index
+        return snapshot
+
+    def _make_snapshot(self):
+        segments = [self.base] + self._segments
+        deleted = sorted(self._tombstones.items())
+        deleted_ids = np.array([doc_id for doc_id, seq in deleted], dtype=np.int64)
+        deleted_seqs = np.array([seq for doc_id, seq in deleted], dtype=np.int64)
+        # a tombstone deletes the doc from every older segment that has it
+        n_docs = 0
+        for segment in segments:
+            found, positions = segment.contains(deleted_ids)
+            n_docs += len(segment.doc_ids) - int(np.count_nonzero(found & (deleted_seqs > segment.seq)))
+        return Snapshot(segments, deleted_ids, deleted_seqs, self.generation, n_docs, getattr(self.base.index, 'name', None))
+
+    def _commit(self):
+        """ Writes the manifest and publishes a new snapshot. Requires _lock. """
+        self.generation += 1
+        manifest = {'segments': [Path(segment.folder).name for segment in self._segments],
+                    'tombstones': sorted(self._tombstones.items()),
+                    'seq': self.seq, 'generation': self.generation}
+        tmp_path = self.segments_dir / f'{MANIFEST}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.segments_dir / MANIFEST)
+        self._snapshot = self._make_snapshot()
+        with self._changed:
+            self._pending = True
+            self._changed.notify()
+
+    def add_documents(self, docs):
+        """ Adds or replaces documents, given as {doc_id: tokens}. """
+        with self._lock:
+            seq = self.seq + 1
+            segment = Segment.write(seq, docs, self.segments_dir / f'seg_{seq:08}')
+            self.seq = seq
+            self._segments.append(segment)
+            for doc_id in docs:
+                self._tombstones[doc_id] = seq
+            self._commit()
+
+    def delete_documents(self, doc_ids):
+        with self._lock:
+            self.seq += 1
+            for doc_id in doc_ids:
+                self._tombstones[doc_id] = self.seq
+            self._commit()
+
+    def _tier(self, segment):
+        return int(math.log(max(len(segment.doc_ids), 1), self.merge_factor))
+
+    def _find_merge(self, segments):
+        """ The first run of merge_factor adjacent segments of the same tier.
+            Only adjacent segments are merged, so that the merged segment can
+            take the seq of the newest one without resurrecting documents that
+            a segment in between replaced. Past 2 * merge_factor segments the
+            adjacent run with the fewest documents is merged whatever their
+            tiers, which bounds the number of segments a query reads.
+        """
+        run = []
+        for segment in segments:
+            if run and self._tier(run[-1]) != self._tier(segment):
+                run = []
+            run.append(segment)
+            if len(run) == self.merge_factor:
+                return run
+        if len(segments) > 2 * self.merge_factor:
+            sizes = [sum(len(segment.doc_ids) for segment in segments[i:i + self.merge_factor])
+                     for i in range(len(segments) - self.merge_factor + 1)]
+            start = sizes.index(min(sizes))
+            return segments[start:start + self.merge_factor]
+        return None
+
+    def maybe_merge(self):
+        """ Merges segments until no tier has merge_factor adjacent segments.
+            Returns the number of merges.
+        """
+        n_merges = 0
+        with self._merge_lock:
+            while True:
+                with self._lock:
+                    run = self._find_merge(self._segments)
+                    snapshot = self._snapshot
+                if run is None:
+                    return n_merges
+                merged = self._merge(run, snapshot)
+                with self._lock:
+                    start = self._segments.index(run[0])
+                    self._segments[start:start + len(run)] = [merged]
+                    self._compact_tombstones()
+                    self._commit()
+                for segment in run:
+                    self._drop(segment)
+                n_merges += 1
+
+    def _compact_tombstones(self):
+        """ Drops the tombstones that no longer delete anything: no segment
+            older than the tombstone has its doc, e.g. once a merge dropped the
+            postings of the deleted doc. Requires _lock.
+        """
+        if not self._tombstones:
+            return
+        deleted = sorted(self._tombstones.items())
+        deleted_ids = np.array([doc_id for doc_id, seq in deleted], dtype=np.int64)
+        deleted_seqs = np.array([seq for doc_id, seq in deleted], dtype=np.int64)
+        needed = np.zeros(len(deleted), dtype=bool)
+        for segment in [self.base] + self._segments:
+            found, positions = segment.contains(deleted_ids)
+            needed |= found & (deleted_seqs > segment.seq)
+        self._tombstones = {doc_id: seq for (doc_id, seq), keep in zip(deleted, needed.tolist()) if keep}
+
+    def _merge(self, run, snapshot):
+        """ Writes one segment with the live postings of the `run` segments.
+            Tombstones committed during the merge are newer than all of them
+            and still apply to the merged segment.
+        """
+        seq = run[-1].seq
+        folder = self.segments_dir / f'seg_{seq:08}_{snapshot.generation}'
+        folder.mkdir(parents=True, exist_ok=True)
+        index = InvertedIndex()
+        index.seq = seq
+        for segment in run:
+            live = ~snapshot.deleted_since(segment.doc_ids, segment.seq)
+            for doc_id, length in zip(segment.doc_ids[live].tolist(), segment.dl[live].tolist()):
+                index.DL[doc_id] = int(length)
+        terms = sorted(set(w for segment in run for w in segment.index.df))
+        view = Snapshot(run, snapshot.deleted_ids, snapshot.deleted_seqs, snapshot.generation, 0)
+        with closing(MappedFileReader()) as reader:
+            postings = ((w, doc_ids.astype(np.int64), tfs.astype(np.int64))
+                        for w, doc_ids, tfs in view.posting_lists_iter_arrays(None, terms, reader))
+            _write_postings(index, postings, folder, 'segment')
+        index.write_index(folder, 'segment')
+        return Segment(seq, folder, index)
+
+    def _drop(self, segment):
+        if self.reader is not None:
+            self.reader.forget_folder(segment.folder)
+        # open mappings keep the unlinked files readable for in-flight queries
+        shutil.rmtree(segment.folder, ignore_errors=True)
+
+    def _merge_loop(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._pending or self._closed)
+                if self._closed:
+                    return
+                self._pending = False
+            self.maybe_merge()
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            self._changed.notify()
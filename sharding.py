@@ -0,0 +1,220 @@
+import os
+import sys
+import queue
+import threading
+import numpy as np
+from pathlib import Path
+from contextlib import closing, ExitStack
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import ThreadPoolExecutor
+from helper import Helper
+from inverted_index_gcp import InvertedIndex, MultiFileWriter, POSTING_DTYPE, TF_MASK
+
+# indexes a shard can hold, each in a sub folder of the shard's folder.
+INDEX_NAMES = ('title', 'text', 'anchor')
+
+
+def load_authkey(authkey=None):
+    """ The secret shard workers and the coordinator authenticate each other
+        with: `authkey` when given, otherwise the SHARD_AUTHKEY environment
+        variable, otherwise the contents of the file named by the
+        SHARD_AUTHKEY_FILE environment variable. There is no default: the
+        shard protocol unpickles what clients send, so whoever knows the
+        secret and reaches a shard runs code on it.
+    Returns:
+    --------
+      the secret as bytes, a RuntimeError is raised when it is not set.
+    """
+    if authkey is None:
+        authkey = os.environ.get('SHARD_AUTHKEY')
+    if not authkey and os.environ.get('SHARD_AUTHKEY_FILE'):
+        with open(os.environ['SHARD_AUTHKEY_FILE'], 'rb') as f:
+            authkey = f.read().strip()
+    if not authkey:
+        raise RuntimeError('the shard protocol needs a secret: set SHARD_AUTHKEY or SHARD_AUTHKEY_FILE')
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def split_index(inverted_index, folder, n_shards, out_dir, index_name):
+    """ Partitions an index by doc id into `n_shards` indexes, doc_id % n_shards
+        being the shard of a document. Shard i is written to
+        `out_dir`/shard_i/`index_name`/index_`index_name`.pkl with its own
+        posting files. Posting lists are split one at a time.
+
+        Shards keep the collection-wide N and df, so the idf and therefore the
+        scores they compute are the same as those of the unsharded index.
+    """
+    shards = [InvertedIndex() for _ in range(n_shards)]
+    shard_dirs = [Path(out_dir) / f'shard_{i}' / index_name for i in range(n_shards)]
+    for shard_dir in shard_dirs:
+        shard_dir.mkdir(parents=True, exist_ok=True)
+    global_df = dict(inverted_index.df.items())
+    for doc_id, length in inverted_index.DL.items():
+        shards[doc_id % n_shards].DL[doc_id] = length
+    max_normalized_tf = getattr(inverted_index, 'max_normalized_tf', {})
+    with ExitStack() as stack:
+        writers = [stack.enter_context(closing(MultiFileWriter(shard_dir, f'{index_name}_{i}')))
+                   for i, shard_dir in enumerate(shard_dirs)]
+        for w, doc_ids, tfs in inverted_index.posting_lists_iter_arrays(folder, list(global_df.keys())):
+            shard_of_doc = doc_ids % n_shards
+            for i, shard in enumerate(shards):
+                mask = shard_of_doc == i
+                if not mask.any():
+                    continue
+                records = np.empty(int(mask.sum()), dtype=POSTING_DTYPE)
+                records['doc_id'] = doc_ids[mask]
+                records['tf'] = tfs[mask] & TF_MASK
+                shard.posting_locs[w].extend(writers[i].write(records.tobytes(), shard_dirs[i]))
+                shard.df[w] = len(records)
+                shard.term_total[w] = int(tfs[mask].sum())
+                # the bound of the whole index is still a bound of every shard
+                shard.max_normalized_tf[w] = max_normalized_tf.get(w, 1.0)
+    for shard, shard_dir in zip(shards, shard_dirs):
+        shard.N = len(inverted_index.DL)
+        shard.global_df = global_df
+        shard.write_index(shard_dir, f'index_{index_name}')
+
+
+class ShardEngine:
+    """ Scores queries against the indexes of one shard. """
+    def __init__(self, shard_dir):
+        self.helper = Helper(folder=None)
+        self.indexes = {}
+        for name in INDEX_NAMES:
+            folder = Path(shard_dir) / name
+            if folder.is_dir():
+                self.indexes[name] = (self.helper.get_index(str(folder), f'index_{name}'), str(folder))
+                self.helper.reader.map_folder(folder)
+
+    def handle(self, request):
+        kind = request[0]
+        if kind == 'frequency':
+            _, index_name, query_tokens, min_match = request
+            inverted_index, folder = self.indexes[index_name]
+            return self.helper.frequency_scores(query_tokens, inverted_index, folder, min_match)
+        if kind == 'body':
+            _, query_tokens, mode, N = request
+            inverted_index, folder = self.indexes['text']
+            return self.helper.body_ranking(query_tokens, inverted_index, folder, mode, N)
+        raise ValueError(f'unknown request {kind!r}')
+
+
+def _serve_connection(engine, conn):
+    with conn:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+            try:
+                conn.send(('ok', engine.handle(request)))
+            except Exception as ex:
+                conn.send(('error', repr(ex)))
+
+
+def serve_shard(shard_dir, address, authkey=None, ready=None):
+    """ Runs a shard worker: loads the shard's indexes and answers the
+        coordinator's requests on `address`, one thread per connection. The
+        listening address is sent on the `ready` connection when given.
+
+        Requests are unpickled, so shards must only be reachable on a trusted
+        network, and the secret (see load_authkey) must be kept private.
+    """
+    authkey = load_authkey(authkey)
+    engine = ShardEngine(shard_dir)
+    with Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                continue
+            threading.Thread(target=_serve_connection, args=(engine, conn), daemon=True).start()
+
+
+def start_local_shards(out_dir, n_shards, authkey=None):
+    """ Starts one worker process per shard of `out_dir` on localhost.
+    Returns:
+    --------
+      the processes and the (host, port) addresses they listen on.
+    """
+    authkey = load_authkey(authkey)
+    processes, addresses = [], []
+    for i in range(n_shards):
+        parent, child = Pipe()
+        process = Process(target=serve_shard, args=(str(Path(out_dir) / f'shard_{i}'), ('localhost', 0), authkey, child),
+                          daemon=True)
+        process.start()
+        addresses.append(parent.recv())
+        processes.append(process)
+    return processes, addresses
+
+
+class ShardCoordinator:
+    """ Fans requests out to all the shard workers concurrently and merges
+        their results. Connections to every shard are pooled and reused.
+        The shards must only be reachable on a trusted network, see
+        serve_shard.
+    """
+    def __init__(self, addresses, authkey=None):
+        self.addresses = [tuple(address) for address in addresses]
+        self.authkey = load_authkey(authkey)
+        self._pools = [queue.LifoQueue() for _ in self.addresses]
+        self.executor = ThreadPoolExecutor(max_workers=4 * len(self.addresses))
+
+    def _call(self, shard, request):
+        try:
+            conn = self._pools[shard].get_nowait()
+        except queue.Empty:
+            conn = Client(self.addresses[shard], authkey=self.authkey)
+        try:
+            conn.send(request)
+            status, result = conn.recv()
+        except Exception:
+            conn.close()
+            raise
+        self._pools[shard].put(conn)
+        if status != 'ok':
+            raise RuntimeError(f'shard {self.addresses[shard]} failed: {result}')
+        return result
+
+    def scatter(self, request):
+        return list(self.executor.map(lambda shard: self._call(shard, request), range(len(self.addresses))))
+
+    def frequency_scores(self, index_name, query_tokens, min_match=1):
+        """ Same as Helper.frequency_scores over the whole index. A doc lives
+            in a single shard, so its count is complete there.
+        """
+        results = self.scatter(('frequency', index_name, list(query_tokens), min_match))
+        doc_ids = np.concatenate([doc_ids for doc_ids, counts in results])
+        counts = np.concatenate([counts for doc_ids, counts in results])
+        order = np.argsort(doc_ids, kind='stable')
+        return doc_ids[order], counts[order]
+
+    def body_ranking(self, query_tokens, mode='cosine', N=100):
+        """ Same as Helper.body_ranking over the whole index: the global top N
+            is among the union of the shards' top N.
+        """
+        results = self.scatter(('body', list(query_tokens), mode, N))
+        stats = {'postings': sum(stats['postings'] for ranking, stats in results),
+                 'postings_skipped': sum(stats['postings_skipped'] for ranking, stats in results)}
+        ranking = [pair for shard_ranking, shard_stats in results for pair in shard_ranking]
+        if N is None:
+            return ranking, stats
+        return sorted(ranking, key=lambda x: (-x[1], x[0]))[:N], stats
+
+
+if __name__ == '__main__':
+    # usage: python sharding.py split /home/igalfernand/postings_gcp/text/ text 4 shards
+    #        SHARD_AUTHKEY=<secret> python sharding.py serve shards/shard_0 6000 [host, localhost by default]
+    if sys.argv[1] == 'split':
+        folder, index_name, n_shards, out_dir = sys.argv[2:6]
+        index = Helper(folder=None).get_index(folder, f'index_{index_name}')
+        split_index(index, folder, int(n_shards), out_dir, index_name)
+    elif sys.argv[1] == 'serve':
+        shard_dir, port = sys.argv[2:4]
+        host = sys.argv[4] if len(sys.argv) > 4 else 'localhost'
+        serve_shard(shard_dir, (host, int(port)))
@@ -0,0 +1,61 @@
+import shutil
+from pathlib import Path
+
+
+class StorageBackend:
+    """ Destination of the finished posting files and posting locations of an
+        index build. Files are written locally first, then `upload`ed.
+    """
+    def upload(self, local_path, remote_path):
+        raise NotImplementedError
+
+    def download(self, remote_path, local_path):
+        raise NotImplementedError
+
+
+class LocalBackend(StorageBackend):
+    """ Copies the files under a local root folder. Files already in place are
+        left as they are.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def upload(self, local_path, remote_path):
+        target = self.root / remote_path
+        if Path(local_path).resolve() == target.resolve():
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(local_path, target)
+
+    def download(self, remote_path, local_path):
+        shutil.copyfile(self.root / remote_path, local_path)
+
+
+class MemoryBackend(StorageBackend):
+    """ Keeps the uploaded files' content in a dictionary, for tests and
+        benchmarks that should not touch any storage.
+    """
+    def __init__(self):
+        self.blobs = {}
+
+    def upload(self, local_path, remote_path):
+        with open(local_path, 'rb') as f:
+            self.blobs[remote_path] = f.read()
+
+    def download(self, remote_path, local_path):
+        with open(local_path, 'wb') as f:
+            f.write(self.blobs[remote_path])
+
+
+class GCSBackend(StorageBackend):
+    """ Uploads to a google storage bucket. """
+    def __init__(self, bucket_name):
+        from google.cloud import storage
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+
+    def upload(self, local_path, remote_path):
+        self.bucket.blob(remote_path).upload_from_filename(str(local_path))
+
+    def download(self, remote_path, local_path):
+        self.bucket.blob(remote_path).download_to_filename(str(local_path))
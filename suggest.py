@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import mmap
+import numpy as np
+from pathlib import Path
+import consts
+from helper import Helper
+
+SUGGEST_VERSION = 1
+
+
+def normalize(title):
+    """ The key a title is completed by: lowercased, with runs of whitespace
+        collapsed to one space.
+    """
+    return ' '.join(title.lower().split())
+
+
+def _bisect(heap, offsets, n, key):
+    """ The position of the first of the `n` sorted strings of `heap` that is
+        not smaller than `key`.
+    """
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if heap[int(offsets[mid]):int(offsets[mid + 1])] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _encode(strings):
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+    return b''.join(strings), offsets
+
+
+def _top(ranks, k):
+    """ Positions of the `k` smallest ranks, in rank order. """
+    if len(ranks) > k:
+        positions = np.argpartition(ranks, k)[:k]
+        return positions[np.argsort(ranks[positions])]
+    return np.argsort(ranks)
+
+
+class SuggestIndex:
+    """ Title prefix completion. Normalized titles are sorted in one string
+        heap with an offsets array, so the titles starting with a prefix are
+        the range found by two binary searches over the heap. Each title has
+        the rank of its document by PageRank (or page views) over all titles.
+
+        Every prefix matching more than `scan` titles has its best `k`
+        completions precomputed at build time, in a sorted table of those
+        prefixes; the ranks of the titles of any other prefix are few enough
+        to be selected at query time. Neither lookup reads the inverted index,
+        and an index written to disk is opened with mmap.
+    """
+    def __init__(self, meta, heap, offsets, doc_ids, ranks, prefix_heap, prefix_offsets, top_doc_ids):
+        self.meta = meta
+        self.heap = heap
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.ranks = ranks
+        self.prefix_heap = prefix_heap
+        self.prefix_offsets = prefix_offsets
+        self.top_doc_ids = top_doc_ids
+
+    @staticmethod
+    def _map(path):
+        if os.path.getsize(path) == 0:
+            return b''
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def open(path):
+        path = Path(path)
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+        arrays = [np.load(path / f'{name}.npy', mmap_mode='r')
+                  for name in ('offsets', 'doc_ids', 'ranks', 'prefix_offsets', 'top_doc_ids')]
+        return SuggestIndex(meta, SuggestIndex._map(path / 'titles.bin'), *arrays[:3],
+                            SuggestIndex._map(path / 'prefixes.bin'), *arrays[3:])
+
+    @staticmethod
+    def build(titles, docs, column='pagerank', k=consts.SUGGEST_TOP_K, scan=consts.SUGGEST_SCAN_TITLES):
+        """ Builds an in-memory index of the titles of a TitleStore, ranked by
+            a column of a DocStore with the same doc ids.
+        """
+        scan = max(scan, k)
+        doc_ids = np.asarray(titles.doc_ids, dtype=np.int64)
+        keys = [normalize(json.loads(titles.fragment(doc_id))[1]).encode('utf-8') for doc_id in doc_ids.tolist()]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        keys = [keys[i] for i in order]
+        doc_ids = doc_ids[order]
+        n = len(keys)
+        # rank by descending score, ties in title order
+        ranks = np.empty(n, dtype=np.int64)
+        ranks[np.lexsort((np.arange(n), -docs.lookup(column, doc_ids).astype(np.float64)))] = np.arange(n)
+        lengths = np.fromiter((len(key) for key in keys), dtype=np.int64, count=n)
+        # length of the common prefix of each title and the previous one
+        lcp = np.full(n, -1, dtype=np.int64)
+        lcp[1:] = [len(os.path.commonprefix(pair)) for pair in zip(keys, keys[1:])]
+        prefixes = {}
+        depth = 0
+        while True:
+            # titles sharing their first `depth` bytes are contiguous
+            starts = np.flatnonzero(lcp < depth)
+            ends = np.append(starts[1:], n)
+            heavy = (ends - starts > scan) & (lengths[starts] >= depth)
+            if not heavy.any():
+                break
+            for start, end in zip(starts[heavy].tolist(), ends[heavy].tolist()):
+                prefixes[keys[start][:depth]] = doc_ids[start + _top(ranks[start:end], k)]
+            depth += 1
+        prefix_keys = sorted(prefixes)
+        heap, offsets = _encode(keys)
+        prefix_heap, prefix_offsets = _encode(prefix_keys)
+        top_doc_ids = np.array([prefixes[prefix] for prefix in prefix_keys], dtype=np.int64).reshape(-1, k)
+        meta = {'version': SUGGEST_VERSION, 'k': k, 'scan': scan, 'column': column}
+        return SuggestIndex(meta, heap, offsets, doc_ids, ranks, prefix_heap, prefix_offsets, top_doc_ids)
+
+    def write(self, path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        with open(path / 'meta.json', 'w') as f:
+            json.dump(self.meta, f)
+        for name in ('offsets', 'doc_ids', 'ranks', 'prefix_offsets', 'top_doc_ids'):
+            np.save(path / f'{name}.npy', np.asarray(getattr(self, name)))
+        with open(path / 'titles.bin', 'wb') as f:
+            f.write(self.heap)
+        with open(path / 'prefixes.bin', 'wb') as f:
+            f.write(self.prefix_heap)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def complete(self, prefix, limit=None):
+        """ The doc ids of the best titles starting with `prefix` (normalized,
+            a trailing space is kept), best first.
+        Returns:
+        --------
+          NumPy array of at most `limit` doc ids, the precomputed k by default.
+        """
+        k = self.meta['k']
+        limit = k if limit is None else min(limit, k)
+        key = normalize(prefix)
+        if key and prefix[-1:].isspace():
+            key += ' '
+        key = key.encode('utf-8')
+        lo = _bisect(self.heap, self.offsets, len(self), key)
+        # no UTF-8 byte is 0xff, every title starting with `key` is before key + 0xff
+        hi = _bisect(self.heap, self.offsets, len(self), key + b'\xff')
+        if hi - lo > self.meta['scan']:
+            row = _bisect(self.prefix_heap, self.prefix_offsets, len(self.top_doc_ids), key)
+            return np.asarray(self.top_doc_ids[row][:limit])
+        return np.asarray(self.doc_ids[lo + _top(np.asarray(self.ranks[lo:hi]), limit)])
+
+
+def build(postings_folder=consts.POSTINGS_FOLDER, column='pagerank'):
+    """ Builds the suggest index of the titles of a postings_gcp tree into
+        other/suggest, ranked by the `column` ('pagerank' or 'pageviews') of
+        its doc store.
+    Returns:
+    --------
+      the SuggestIndex.
+    """
+    other = Path(postings_folder) / 'other'
+    helper = Helper(folder=None)
+    index = SuggestIndex.build(helper.get_title_store(other), helper.get_doc_store(other), column)
+    index.write(other / 'suggest')
+    return index
+
+
+if __name__ == '__main__':
+    # usage: python suggest.py [postings_gcp] [pagerank|pageviews]
+    # then /suggest?prefix=... completes titles
+    index = build(*sys.argv[1:3])
+    print(f'{len(index)} titles, {len(index.top_doc_ids)} precomputed prefixes')
@@ -0,0 +1,46 @@
+import sys
+from pathlib import Path
+from collections import Counter
+from contextlib import closing
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import bitmap_postings
+from bitmap_postings import check_bitmap_index
+from inverted_index_gcp import InvertedIndex, MultiFileWriter, POSTING_DTYPE
+
+rng = np.random.default_rng(0)
+POSTINGS = {
+    # more doc ids of the container key 0 than DENSE_CARD: a bitmap container, counted bit-sliced
+    'dense': np.arange(1, 6001),
+    'even': np.concatenate([np.arange(2, 6001, 2), 2 ** 16 + np.arange(0, 900, 3)]),
+    'sparse': np.sort(rng.choice(np.arange(1, 3 * 2 ** 16), 300, replace=False)),
+    'far': 3 * 2 ** 16 + np.arange(1, 50),
+    'single': np.array([5]),
+}
+
+
+def build_index(folder):
+    index = InvertedIndex()
+    with closing(MultiFileWriter(folder, 'index_title')) as writer:
+        for w, doc_ids in POSTINGS.items():
+            records = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+            records['doc_id'] = doc_ids
+            records['tf'] = rng.integers(1, 4, len(doc_ids))
+            index.posting_locs[w].extend(writer.write(records.tobytes(), 'title'))
+            index.df[w] = len(doc_ids)
+            index.term_total[w] = int(records['tf'].sum())
+    index.DL = Counter({doc_id: 1 for doc_id in np.concatenate(list(POSTINGS.values())).tolist()})
+    return index
+
+
+def test_bitmap_index_matches_frequency_ranking(tmp_path, monkeypatch):
+    assert len(POSTINGS['dense']) > bitmap_postings.DENSE_CARD
+    dense_calls = []
+    count_dense = bitmap_postings._count_dense
+    monkeypatch.setattr(bitmap_postings, '_count_dense', lambda *args: dense_calls.append(1) or count_dense(*args))
+    folder = f'{tmp_path}/'
+    index = build_index(tmp_path)
+    bitmap_index = index.convert_bitmaps(folder, tmp_path, 'bitmap_title')
+    assert check_bitmap_index(index, bitmap_index, folder, n_queries=200) == 0
+    assert dense_calls
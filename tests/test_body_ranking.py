@@ -0,0 +1,70 @@
+import sys
+from pathlib import Path
+from collections import Counter
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from helper import Helper
+
+N_DOCS, N_TERMS, N_QUERIES = 3000, 60, 200
+
+
+class Index:
+    """ In-memory stand-in for the term statistics of a body index. """
+    def __init__(self, rng):
+        self.DL = Counter({doc_id: int(length) for doc_id, length in
+                           zip(range(1, N_DOCS + 1), rng.integers(20, 400, N_DOCS))})
+        self.df = Counter()
+        self.max_normalized_tf = {}
+        self.postings = {}
+        for i in range(N_TERMS):
+            term = f't{i}'
+            # Zipf-like document frequencies, some lists padded with the doc id 0
+            df = max(int(N_DOCS / (i + 1) ** 0.8), 2)
+            doc_ids = np.sort(rng.choice(np.arange(1, N_DOCS + 1), df, replace=False))
+            tfs = rng.integers(1, 20, df)
+            if i % 3 == 0:
+                doc_ids, tfs = np.append(0, doc_ids), np.append(0, tfs)
+            self.postings[term] = (doc_ids.astype('>u4'), tfs.astype('>u2'))
+            self.df[term] = len(doc_ids)
+            self.max_normalized_tf[term] = max(tf / self.DL[doc_id] for doc_id, tf in zip(doc_ids.tolist(), tfs.tolist())
+                                               if doc_id != 0)
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    rng = np.random.default_rng(0)
+    index = Index(rng)
+    queries = [[f't{i}' for i in rng.integers(0, N_TERMS, rng.integers(1, 6))] for _ in range(N_QUERIES)]
+    return Helper(folder=None), index, queries
+
+
+def bind(helper, index, tokens):
+    terms = list(dict.fromkeys(tokens))
+    words = tuple(terms)
+    pls = tuple(index.postings[term] for term in terms)
+    return terms, helper.generate_query_tfidf_vector(tokens, terms, index), words, pls
+
+
+def test_cosine_matches_the_dataframe_ranking(corpus):
+    helper, index, queries = corpus
+    # the DataFrame path fills one cell at a time, a quarter of the queries is enough
+    for tokens in queries[:N_QUERIES // 4]:
+        terms, Q, words, pls = bind(helper, index, tokens)
+        D = helper.generate_document_tfidf_matrix(terms, index, words, pls)
+        expected = helper.get_top_n(helper.cosine_similarity(D, Q), 100)
+        assert helper.cosine_similarity_top_n(terms, Q, index, words, pls, 100) == expected
+
+
+@pytest.mark.parametrize('N', [10, 100])
+def test_maxscore_matches_tfidf(corpus, N):
+    helper, index, queries = corpus
+    skipped = 0
+    for tokens in queries:
+        terms, Q, words, pls = bind(helper, index, tokens)
+        ranking, stats = helper.maxscore_top_n(terms, Q, index, words, pls, N)
+        assert ranking == helper.tfidf_top_n(terms, Q, index, words, pls, N)[0]
+        skipped += stats['postings_skipped']
+    # the corpus is large enough for MaxScore to prune
+    assert skipped > 0
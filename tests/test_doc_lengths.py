@@ -0,0 +1,29 @@
+import sys
+from pathlib import Path
+from collections import Counter
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from inverted_index_gcp import DocNorms, ImpactQuantizer
+
+DL = Counter({1: 2, 5: 4, 7: 8})
+# the padding doc id 0, and doc ids below, between and above those of DL
+DOC_IDS = np.array([0, 1, 3, 5, 9], dtype='>u4')
+TFS = np.array([0, 1, 1, 2, 3], dtype='>u2')
+KNOWN = np.array([False, True, False, True, False])
+
+
+def test_doc_norms_skip_unknown_doc_ids():
+    norms, expected = DocNorms(DL), DocNorms(DL)
+    norms.add(DOC_IDS, TFS, 2)
+    expected.add(DOC_IDS[KNOWN], TFS[KNOWN], 2)
+    assert np.array_equal(norms.norms()._values, expected.norms()._values)
+    assert norms.norms()._values[-1] == 0
+
+
+def test_impacts_of_unknown_doc_ids_are_zero():
+    quantizer = ImpactQuantizer(DL)
+    impacts = quantizer.impacts(DOC_IDS, TFS, 2)
+    assert impacts[~KNOWN].tolist() == [0, 0, 0]
+    assert np.array_equal(impacts[KNOWN], quantizer.impacts(DOC_IDS[KNOWN], TFS[KNOWN], 2))
+    assert (impacts[KNOWN] > 0).all()
@@ -0,0 +1,61 @@
+import sys
+import pickle
+from pathlib import Path
+from collections import Counter
+from contextlib import closing
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from helper import Helper
+from reorder import reorder
+from inverted_index_gcp import InvertedIndex, MultiFileWriter, POSTING_DTYPE
+
+PAGERANK = {10: 3.0, 20: 2.0, 30: 1.0}
+# lists padded with the doc id 0, like the lists of the GCP build
+TITLE_POSTINGS = {'apple': [(0, 0), (10, 1)],
+                  'banana': [(0, 0), (20, 1), (30, 1)],
+                  'cherry': [(10, 1), (20, 1), (30, 1)]}
+
+
+def write_tree(root):
+    folder = root / 'title'
+    folder.mkdir(parents=True)
+    index = InvertedIndex()
+    with closing(MultiFileWriter(folder, 'index_title')) as writer:
+        for w, postings in TITLE_POSTINGS.items():
+            records = np.array(postings, dtype=POSTING_DTYPE)
+            index.posting_locs[w].extend(writer.write(records.tobytes(), 'title'))
+            index.df[w] = len(postings)
+            index.term_total[w] = int(records['tf'].sum())
+    index.DL = Counter({doc_id: 1 for doc_id in PAGERANK})
+    index.write_index(folder, 'index_title')
+    other = root / 'other'
+    other.mkdir()
+    for name, value in (('pr.pkl', PAGERANK), ('pageviews-202108-user.pkl', {10: 1, 20: 2, 30: 3}),
+                        ('doctitles.pkl', {doc_id: f'title {doc_id}' for doc_id in PAGERANK})):
+        with open(other / name, 'wb') as f:
+            pickle.dump(value, f)
+
+
+def title_ranking(helper, root, tokens):
+    index = helper.get_index(root / 'title', 'index_title')
+    return helper.to_wiki_ids(helper.top_k_by_count(tokens, index, f'{root / "title"}/', 100)).tolist()
+
+
+def test_reorder_keeps_padded_posting_lists(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    write_tree(src)
+    reorder(src, dst)
+    before, after = Helper(folder=None), Helper(folder=None)
+    after.DOC_MAP = after.get_doc_map(dst / 'other')
+    src_index = before.get_index(src / 'title', 'index_title')
+    dst_index = after.get_index(dst / 'title', 'index_title')
+    for w in TITLE_POSTINGS:
+        src_ids = next(src_index.posting_lists_iter_arrays(f'{src / "title"}/', [w]))[1]
+        dst_ids = next(dst_index.posting_lists_iter_arrays(f'{dst / "title"}/', [w]))[1]
+        assert sorted(after.to_wiki_ids(dst_ids[dst_ids != 0]).tolist()) == sorted(src_ids[src_ids != 0].tolist())
+    for tokens in (['apple'], ['banana'], ['apple', 'banana'], ['apple', 'cherry']):
+        doc_ids, counts = before.frequency_scores(tokens, src_index, f'{src / "title"}/')
+        pagerank = np.array([PAGERANK[doc_id] for doc_id in doc_ids.tolist()])
+        expected = doc_ids[np.lexsort((-pagerank, -counts))].tolist()
+        assert title_ranking(after, dst, tokens) == expected
@@ -0,0 +1,126 @@
+import sys
+import json
+import pickle
+import numpy as np
+from pathlib import Path
+
+
+class TitleStore:
+    """ Document titles stored as one byte heap of pre-encoded JSON fragments,
+        `[wiki_id,"title"]` per document, with an offsets array delimiting them
+        and a sorted wiki ids array. Responses are assembled by gathering byte
+        slices of the heap, without building or encoding Python strings.
+        A store written to disk is opened with mmap. Titles of documents
+        indexed since (see segments.py) are kept in `added`.
+    """
+    def __init__(self, doc_ids, offsets, heap):
+        self.doc_ids = doc_ids
+        self.offsets = offsets
+        self.heap = heap
+        self.added = {}
+
+    @staticmethod
+    def open(path):
+        path = Path(path)
+        doc_ids = np.load(path / 'doc_ids.npy', mmap_mode='r')
+        offsets = np.load(path / 'offsets.npy', mmap_mode='r')
+        heap = np.memmap(path / 'titles.bin', dtype=np.uint8, mode='r') if offsets[-1] > 0 \
+            else np.empty(0, dtype=np.uint8)
+        return TitleStore(doc_ids, offsets, heap)
+
+    @staticmethod
+    def from_dict(titles):
+        """ Builds an in-memory store from a {wiki_id: title} mapping. """
+        doc_ids = np.array(sorted(titles.keys()), dtype=np.int64)
+        fragments = [json.dumps([doc_id, titles[doc_id]], separators=(',', ':')).encode('utf-8')
+                     for doc_id in doc_ids.tolist()]
+        return TitleStore.from_fragments(doc_ids, fragments)
+
+    @staticmethod
+    def from_fragments(doc_ids, fragments):
+        """ Builds an in-memory store from sorted doc ids and their encoded
+            fragments, which may hold another id than the doc id (see 
+            reorder.py).
+        """
+        offsets = np.zeros(len(fragments) + 1, dtype=np.int64)
+        np.cumsum([len(fragment) for fragment in fragments], out=offsets[1:])
+        heap = np.frombuffer(b''.join(fragments), dtype=np.uint8)
+        return TitleStore(doc_ids, offsets, heap)
+
+    def write(self, path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / 'doc_ids.npy', np.asarray(self.doc_ids, dtype=np.int64))
+        np.save(path / 'offsets.npy', np.asarray(self.offsets, dtype=np.int64))
+        with open(path / 'titles.bin', 'wb') as f:
+            f.write(np.asarray(self.heap).tobytes())
+
+    def positions(self, doc_ids):
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(self.doc_ids) == 0:
+            return np.zeros(len(doc_ids), dtype=np.int64), np.zeros(len(doc_ids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.doc_ids, doc_ids), len(self.doc_ids) - 1)
+        return positions, self.doc_ids[positions] == doc_ids
+
+    def add(self, doc_id, title, wiki_id=None):
+        """ Adds or replaces the title of a document, whose fragment holds 
+            `wiki_id` when its doc id is an internal one.
+        """
+        wiki_id = doc_id if wiki_id is None else wiki_id
+        self.added[int(doc_id)] = json.dumps([int(wiki_id), title], separators=(',', ':')).encode('utf-8')
+
+    def fragment(self, doc_id):
+        """ The JSON encoding of the (wiki_id, title) pair of a document, with
+            0 in place of the title of unknown documents like before.
+        """
+        if self.added and int(doc_id) in self.added:
+            return self.added[int(doc_id)]
+        positions, found = self.positions([doc_id])
+        if not found[0]:
+            return f'[{int(doc_id)},0]'.encode('utf-8')
+        position = int(positions[0])
+        return self.heap[int(self.offsets[position]):int(self.offsets[position + 1])].tobytes()
+
+    def get(self, doc_id, default=None):
+        positions, found = self.positions([doc_id])
+        if not found[0] and int(doc_id) not in self.added:
+            return default
+        return json.loads(self.fragment(doc_id))[1]
+
+    def json_pairs(self, doc_ids):
+        """ JSON array of the (wiki_id, title) pairs of `doc_ids`, in order, as
+            bytes. Equivalent to json encoding get_doc_title_pairs_from_id.
+        """
+        if len(doc_ids) == 0:
+            return b'[]'
+        positions, found = self.positions(doc_ids)
+        if not found.all() or (self.added and any(int(doc_id) in self.added for doc_id in doc_ids)):
+            return b'[' + b','.join(self.fragment(doc_id) for doc_id in doc_ids) + b']'
+        starts = np.asarray(self.offsets[positions], dtype=np.int64)
+        lengths = np.asarray(self.offsets[positions + 1], dtype=np.int64) - starts
+        # every fragment is followed by one separator byte
+        out_lengths = lengths + 1
+        out_ends = np.cumsum(out_lengths)
+        gather = np.repeat(starts - (out_ends - out_lengths), out_lengths) + np.arange(out_ends[-1])
+        gather[out_ends - 1] = 0
+        out = self.heap[gather]
+        out[out_ends - 1] = ord(',')
+        out[-1] = ord(']')
+        return b'[' + out.tobytes()
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+
+def convert_pickle(titles_path, path):
+    """ One-shot converter of the doctitles pickle to a title store directory
+        at `path`.
+    """
+    with open(titles_path, 'rb') as f:
+        titles = dict(pickle.load(f))
+    TitleStore.from_dict(titles).write(path)
+
+
+if __name__ == '__main__':
+    # usage: python title_store.py doctitles.pkl title_store
+    convert_pickle(*sys.argv[1:3])